@@ -0,0 +1,49 @@
+import socket
+import sys
+from photo_tools.hashing import hash_file_or_none
+from photo_tools.plan import apply_plan, print_plan_failures, read_plan_header
+from photo_tools.reference_index import add_moved_file, open_reference_index
+
+
+def calculate_hash(file_path):
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path)
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != '--any-host']
+    if len(args) != 1:
+        print("Usage: python apply_plan.py <plan> [--any-host]")
+        return
+
+    plan_path = args[0]
+    header = read_plan_header(plan_path)
+    # Plans merged from several hosts' digest tables only make sense on the host they were made for
+    host = header.get('host')
+    if host and host != socket.gethostname() and '--any-host' not in sys.argv:
+        print(f"This plan is for host '{host}', not '{socket.gethostname()}'. "
+              f"Run it there, or pass --any-host if the host was named otherwise when it was scanned.")
+        return
+    print(f"Applying the {header['name']} plan '{plan_path}'...")
+
+    # Plans that move files into an indexed library keep its reference index up to date
+    reference_index = None
+    on_moved = None
+    if header.get('reference_index'):
+        reference_index = open_reference_index(header['reference_index'])
+    if reference_index is not None:
+        on_moved = lambda op: add_moved_file(reference_index, op['hash'], op['dest'], calculate_hash)
+
+    failures = apply_plan(plan_path, on_moved)
+
+    if reference_index is not None:
+        reference_index.compact()
+        reference_index.close()
+
+    print_plan_failures(failures)
+    if not failures:
+        print("\nAll operations were applied successfully!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import os
+import random
+
+# File size distributions, as (median bytes, spread) of a lognormal distribution
+SIZE_PROFILES = {
+    'tiny': (16 * 1024, 0.5),
+    'small': (256 * 1024, 0.8),
+    'photos': (2560 * 1024, 0.6),
+}
+
+# Extensions of the generated photos and videos, picked at random
+PHOTO_EXTENSIONS = ['.jpg', '.jpg', '.jpg', '.heic', '.png', '.mov', '.mp4']
+
+# Documents and clutter put in numbered and misc folders for the cleanup scripts
+DOCUMENT_EXTENSIONS = ['.pdf', '.docx', '.txt', '.xlsx']
+JUNK_NAMES = ['Thumbs.db', 'IMG_0001.AAE', 'facetile_1a2b.jpeg']
+
+EVENT_NAMES = ['Christmas', 'December', 'feb', 'Summer trip', 'Birthday']
+
+
+class _Writer:
+    """Write generated files and keep count of them."""
+
+    def __init__(self, rng, size_profile):
+        self.rng = rng
+        self.median, self.spread = SIZE_PROFILES[size_profile]
+        self.files = 0
+        self.total_bytes = 0
+        self.written = []
+
+    def random_size(self):
+        return max(1, int(self.rng.lognormvariate(0, self.spread) * self.median))
+
+    def write(self, path, data=None, size=None):
+        if data is None:
+            data = self.rng.randbytes(size if size is not None else self.random_size())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.files += 1
+        self.total_bytes += len(data)
+        self.written.append(path)
+        return data
+
+
+def _nested_dir(rng, base_dir, depth):
+    """Return a random folder between one and depth levels below base_dir."""
+    parts = [f"folder {rng.randrange(20)}" for _ in range(rng.randint(1, max(1, depth)))]
+    return os.path.join(base_dir, *parts)
+
+
+def generate_library(root_dir, files=2000, size_profile='small', duplicate_ratio=0.2, same_size_ratio=0.05,
+                     depth=3, thumbnail_folders=5, date_folders=5, numbered_folders=5, seed=0):
+    """Generate a synthetic drive below root_dir shaped like the one the scripts expect.
+
+    Half of the photos go in final/ (the existing library) and half in transfer/ (new
+    photos), where duplicate_ratio of them are copies of final/ files and
+    same_size_ratio share a size but not content with one, so every grouping stage is
+    exercised. photos/ gets originals with copies elsewhere for final_check.py and
+    'Event YYYY' folders for reorganize_years.py. Thumbnail, date-named and numbered
+    folders, misc_from_internet/ clutter and documents/ nesting are added for the
+    cleanup scripts. The same seed always generates the same library.
+    Returns a dict describing the generated directories and how much was written.
+    """
+    rng = random.Random(seed)
+    writer = _Writer(rng, size_profile)
+    final_dir = os.path.join(root_dir, 'final')
+    transfer_dir = os.path.join(root_dir, 'transfer')
+    photos_dir = os.path.join(root_dir, 'photos')
+    misc_dir = os.path.join(root_dir, 'misc_from_internet')
+    documents_dir = os.path.join(root_dir, 'documents')
+
+    def photo_name(index):
+        return f"IMG_{index:06d}{rng.choice(PHOTO_EXTENSIONS)}"
+
+    # Existing library and new photos
+    library = []
+    existing_count = files // 2
+    for index in range(existing_count):
+        path = os.path.join(_nested_dir(rng, final_dir, depth), photo_name(index))
+        library.append(writer.write(path))
+    for index in range(existing_count, files):
+        path = os.path.join(_nested_dir(rng, transfer_dir, depth), photo_name(index))
+        roll = rng.random()
+        if library and roll < duplicate_ratio:
+            writer.write(path, rng.choice(library))
+        elif library and roll < duplicate_ratio + same_size_ratio:
+            writer.write(path, size=len(rng.choice(library)))
+        else:
+            writer.write(path)
+
+    # Originals with copies elsewhere, and event folders named by year
+    for index in range(max(1, files // 20)):
+        data = writer.write(os.path.join(photos_dir, 'originals', photo_name(index)))
+        if rng.random() < 0.5:
+            event = f"{rng.choice(EVENT_NAMES)} {rng.randint(1995, 2023)}"
+            writer.write(os.path.join(photos_dir, event, photo_name(index)), data)
+
+    # Thumbnail folders: 22 characters without spaces or underscores
+    for index in range(thumbnail_folders):
+        folder = os.path.join(final_dir, f"{rng.getrandbits(80):020x}{index:02d}"[-22:])
+        for thumb in range(rng.randint(1, 10)):
+            writer.write(os.path.join(folder, f"thumb{thumb}.jpg"), size=rng.randint(2000, 20000))
+
+    # Date-named folders like 20160714-124524
+    for index in range(date_folders):
+        folder = os.path.join(root_dir, f"{rng.randint(2005, 2023)}{rng.randint(1, 12):02d}"
+                                        f"{rng.randint(1, 28):02d}-{rng.randrange(240000):06d}")
+        for photo in range(rng.randint(1, 10)):
+            writer.write(os.path.join(folder, photo_name(photo)))
+
+    # Numbered folders downloaded from the internet, holding photos and documents
+    for index in range(numbered_folders):
+        folder = os.path.join(root_dir, f"{index + 1}.{rng.randint(1, 9)}")
+        for item in range(rng.randint(1, 6)):
+            extension = rng.choice(PHOTO_EXTENSIONS + DOCUMENT_EXTENSIONS)
+            writer.write(os.path.join(folder, f"download_{index}_{item}{extension}"))
+
+    # Clutter and empty folders in misc, and redundant nesting in documents
+    for name in JUNK_NAMES:
+        writer.write(os.path.join(misc_dir, 'old album', name), size=512)
+    os.makedirs(os.path.join(misc_dir, 'empty', 'nested'), exist_ok=True)
+    for index in range(3):
+        writer.write(os.path.join(documents_dir, 'Taxes', 'Taxes', f"return_{index}.pdf"))
+
+    return {
+        'root_dir': root_dir,
+        'final_dir': final_dir,
+        'transfer_dir': transfer_dir,
+        'photos_dir': photos_dir,
+        'misc_dir': misc_dir,
+        'documents_dir': documents_dir,
+        'files': writer.files,
+        'total_bytes': writer.total_bytes,
+    }
@@ -0,0 +1,242 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Benchmarks measure the scripts themselves, not the persistent hash cache
+os.environ['PHOTO_HASH_CACHE'] = ''
+
+from benchmarks.library import SIZE_PROFILES, generate_library
+
+RESULTS_VERSION = 1
+
+# Directory results are written to by default, one JSON file per run
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+class PhaseTimer:
+    """Record the wall and CPU time of named phases, silencing the scripts' output while they run."""
+
+    def __init__(self, verbose=False):
+        self.phases = {}
+        self.verbose = verbose
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with open(os.devnull, 'w') as devnull, contextlib.ExitStack() as stack:
+            if not self.verbose:
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+                stack.enter_context(contextlib.redirect_stderr(devnull))
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            yield
+            self.phases[name] = {
+                'seconds': round(time.perf_counter() - start, 6),
+                'cpu_seconds': round(time.process_time() - cpu_start, 6),
+            }
+        print(f"  {name:<28} {self.phases[name]['seconds']:>9.3f} s")
+
+
+def redirect_state_dirs(state_dir):
+    """Keep plans, journals and checkpoints of the benchmark out of the home directory."""
+    from photo_tools import checkpoint, mover, plan
+    checkpoint.CHECKPOINT_DIR = os.path.join(state_dir, 'checkpoints')
+    mover.JOURNAL_DIR = os.path.join(state_dir, 'journals')
+    plan.PLAN_DIR = os.path.join(state_dir, 'plans')
+
+
+def bench_find_duplicates(library, timer):
+    import find_duplicates
+    find_duplicates.ROOT_DIR = library['final_dir']
+    find_duplicates.TRANSFER_DIR = library['transfer_dir']
+    find_duplicates.FINAL_DIR = library['final_dir']
+
+    with timer.phase('walk'):
+        for root_dir in (library['final_dir'], library['transfer_dir']):
+            for _ in find_duplicates.iter_files(root_dir):
+                pass
+    # Walking and hashing are streamed into each other, so this phase includes a second walk
+    with timer.phase('walk + hash + group'):
+        existing, transfer = find_duplicates.find_files_by_hash([library['final_dir'], library['transfer_dir']])
+    with timer.phase('plan + move'):
+        find_duplicates.move_unique_files(existing, transfer)
+
+
+def bench_final_check(library, timer):
+    import final_check
+    originals_dir = os.path.join(library['photos_dir'], 'originals')
+    copies_dir = os.path.join(library['photos_dir'], 'copies')
+
+    with timer.phase('walk + hash + group'):
+        files_by_hash = final_check.find_all_photos_with_hashes(library['photos_dir'])
+    with timer.phase('plan + move'):
+        final_check.move_duplicates_from_originals(files_by_hash, originals_dir, copies_dir)
+
+
+def bench_cleanup_scripts(library, timer):
+    import cleanup_misc_internet
+    import document_mover
+    import file_folder_cleanup
+    import flatten_redundant_folders
+    import move_dates
+    import reorganize_years
+    import thumbnail_cleaner
+    root_dir = library['root_dir']
+    final_dir = library['final_dir']
+
+    with timer.phase('cleanup_misc_internet'):
+        cleanup_misc_internet.move_files_to_misc(root_dir, library['misc_dir'])
+    with timer.phase('thumbnail_cleaner'):
+        thumbnail_cleaner.move_files_from_thumbnail_folders(final_dir, os.path.join(final_dir, 'thumbnails'))
+    with timer.phase('move_dates'):
+        move_dates.move_files_by_date(root_dir, final_dir)
+    with timer.phase('document_mover'):
+        document_mover.move_documents(library['misc_dir'], library['documents_dir'])
+    with timer.phase('file_folder_cleanup'):
+        file_folder_cleanup.delete_unwanted_files(library['misc_dir'])
+        file_folder_cleanup.delete_empty_folders(library['misc_dir'])
+    with timer.phase('flatten_redundant_folders'):
+        flatten_redundant_folders.flatten_redundant_subfolders(library['documents_dir'])
+    with timer.phase('reorganize_years'):
+        reorganize_years.move_folders_by_year(library['photos_dir'])
+
+
+def bench_organize(library, timer):
+    import organize
+    organize.ROOT_DIR = library['root_dir']
+    organize.FINAL_DIR = library['final_dir']
+    organize.THUMBNAILS_DIR = os.path.join(library['final_dir'], 'thumbnails')
+    organize.MISC_DIR = library['misc_dir']
+    organize.DOCUMENTS_DIR = library['documents_dir']
+    organize.PHOTOS_DIR = library['photos_dir']
+
+    with timer.phase('single pass'):
+        organize.organize(library['root_dir'])
+
+
+SCENARIOS = {
+    'find_duplicates': bench_find_duplicates,
+    'final_check': bench_final_check,
+    'cleanup_scripts': bench_cleanup_scripts,
+    'organize': bench_organize,
+}
+
+
+def drop_caches():
+    """Flush and drop the page cache so the scenario reads the generated library from disk (needs root)."""
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError as e:
+        print(f"Could not drop the page cache, reads may be served from memory: {e}")
+
+
+def git_commit():
+    """Return the commit being benchmarked, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print how each phase changed relative to an earlier results file."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} ({baseline.get('commit') or 'unknown commit'}):")
+    for scenario, phases in results['scenarios'].items():
+        for name, timing in phases.items():
+            old = baseline.get('scenarios', {}).get(scenario, {}).get(name)
+            if old and old['seconds']:
+                print(f"  {scenario + ' / ' + name:<45} {timing['seconds'] / old['seconds']:>6.2f}x")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time the scripts on a generated photo library.")
+    parser.add_argument('--files', type=int, default=2000, help="number of photos in final/ and transfer/")
+    parser.add_argument('--size-profile', choices=sorted(SIZE_PROFILES), default='small')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--same-size-ratio', type=float, default=0.05)
+    parser.add_argument('--depth', type=int, default=3, help="maximum folder depth of the photos")
+    parser.add_argument('--thumbnail-folders', type=int, default=5)
+    parser.add_argument('--date-folders', type=int, default=5)
+    parser.add_argument('--numbered-folders', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument('--work-dir', help="where to generate libraries (default: a temporary directory)")
+    parser.add_argument('--output', help="results file (default: benchmarks/results/<time>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--read-order', choices=['fifo', 'inode', 'physical'], default='fifo',
+                        help="order hashing reads are served in (PHOTO_READ_ORDER)")
+    parser.add_argument('--adaptive-reads', action='store_true', help="adapt read sizes to throughput")
+    parser.add_argument('--drop-caches', action='store_true',
+                        help="drop the page cache after generating each library (Linux, needs root)")
+    parser.add_argument('--verbose', action='store_true', help="show the scripts' own output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Read by photo_tools when it is first imported, which happens below
+    os.environ['PHOTO_READ_ORDER'] = args.read_order
+    os.environ['PHOTO_ADAPTIVE_READS'] = '1' if args.adaptive_reads else ''
+    parameters = {
+        'files': args.files,
+        'size_profile': args.size_profile,
+        'duplicate_ratio': args.duplicate_ratio,
+        'same_size_ratio': args.same_size_ratio,
+        'depth': args.depth,
+        'thumbnail_folders': args.thumbnail_folders,
+        'date_folders': args.date_folders,
+        'numbered_folders': args.numbered_folders,
+        'seed': args.seed,
+    }
+    results = {
+        'version': RESULTS_VERSION,
+        'timestamp': time.time(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'io': {'read_order': args.read_order, 'adaptive_reads': args.adaptive_reads,
+               'drop_caches': args.drop_caches},
+        'library': None,
+        'scenarios': {},
+    }
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        redirect_state_dirs(os.path.join(work_dir, 'state'))
+        for name in args.scenario or SCENARIOS:
+            # Every scenario moves files around, so each one gets a freshly generated library
+            library_dir = os.path.join(work_dir, name)
+            library = generate_library(library_dir, **parameters)
+            if args.drop_caches:
+                drop_caches()
+            results['library'] = {'files': library['files'], 'total_bytes': library['total_bytes']}
+            print(f"{name} ({library['files']} files, {library['total_bytes'] / 1024 / 1024:.1f} MB):")
+            timer = PhaseTimer(args.verbose)
+            SCENARIOS[name](library, timer)
+            results['scenarios'][name] = timer.phases
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import os
-import shutil
 import re
+from photo_tools.dest_names import DestinationNames
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path, print_plan_failures
+from photo_tools.walker import make_prune, new_walk_stats, print_walk_stats, walk_entries
 
 # Root directory containing the numbered folders
 ROOT_DIR = '/Volumes/Photo backup'
@@ -9,32 +11,52 @@ DEST_DIR = '/Volumes/Photo backup/misc_from_internet'
 # Regular expression to match folder names like 1.5, 2.1.2, 3.4, etc.
 PATTERN = re.compile(r'^\d+(\.\d+)*$')
 
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
 
-def move_files_to_misc(root_dir, dest_dir):
-    """Move all files from specific subfolders (matching the pattern) into the destination folder."""
-    os.makedirs(dest_dir, exist_ok=True)  # Create the destination directory if it doesn't exist
 
-    for dirpath, dirnames, filenames in os.walk(root_dir, topdown=False):
+def plan_files_to_misc(root_dir, dest_dir, plan):
+    """Plan moving all files from specific subfolders (matching the pattern) into the destination folder."""
+    walk_stats = new_walk_stats()
+    # Folders that will be empty once the plan has run, children before their parents
+    emptied_folders = []
+    emptied = set()
+    names = DestinationNames()
+
+    for dirpath, dir_entries, file_entries in walk_entries(root_dir, prune=make_prune(), topdown=False,
+                                                           stats=walk_stats):
         folder_name = os.path.basename(dirpath)
 
         # Only process folders that match the pattern
         if PATTERN.match(folder_name):
-            for filename in filenames:
-                src_path = os.path.join(dirpath, filename)
-                dest_path = os.path.join(dest_dir, filename)
-                try:
-                    shutil.move(src_path, dest_path)
-                    print(f"Moved: {src_path} -> {dest_path}")
-                except Exception as e:
-                    print(f"Error moving {src_path}: {e}")
+            # Files already in the destination folder under the same name stay where they are
+            remaining = 0
+            for entry in file_entries:
+                dest = names.destination(entry.path, dest_dir)
+                if dest is None:
+                    remaining += 1
+                else:
+                    plan.move(entry.path, dest)
 
             # Delete the folder if it's empty after moving the files
-            if not os.listdir(dirpath):
-                try:
-                    os.rmdir(dirpath)
-                    print(f"Deleted empty folder: {dirpath}")
-                except Exception as e:
-                    print(f"Error deleting folder {dirpath}: {e}")
+            if not remaining and all(entry.path in emptied for entry in dir_entries):
+                emptied_folders.append(dirpath)
+                emptied.add(dirpath)
+
+    print_walk_stats(walk_stats)
+    for folder in emptied_folders:
+        plan.rmdir(folder)
+
+
+def move_files_to_misc(root_dir, dest_dir):
+    """Move all files from numbered subfolders, applying the plan unless this is a dry run."""
+    plan_path = default_plan_path('cleanup_misc_internet')
+    with PlanWriter(plan_path, 'cleanup_misc_internet') as plan:
+        plan_files_to_misc(root_dir, dest_dir, plan)
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
+        return
+    print_plan_failures(apply_plan(plan_path))
 
 
 def main():
@@ -44,4 +66,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
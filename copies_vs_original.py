@@ -1,57 +1,86 @@
 import os
 import shutil
-import xxhash
+import tempfile
 from collections import defaultdict
 from tqdm import tqdm
+from photo_tools.dest_names import DestinationNames
+from photo_tools.hashing import estimate_file_count, hash_file_or_none
+from photo_tools.media import MEDIA_EXTENSIONS, has_extension
+from photo_tools.metrics import log, log_error
+from photo_tools.parallel import background_iter, device_of, imap_ordered
+from photo_tools.sorted_runs import merge_join, sort_into_runs
+from photo_tools.walker import iter_file_entries, make_prune
 
 # Folder paths
 COPIES_DIR = '/Volumes/Photo backup/photos/copies'
 ORIGINALS_DIR = '/Volumes/Photo backup/photos/originals'
 
+# Compare the folders through sorted runs of (hash, size, path) on disk instead of a set of
+# every original's hash, for folders of millions of photos. Runs go to MERGE_WORK_DIR, or
+# the system temp directory if None.
+EXTERNAL_MERGE = False
+MERGE_WORK_DIR = None
+
 # List of photo and video file extensions (case insensitive)
-PHOTO_EXTENSIONS = {
-    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.webp',
-    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.mpeg', '.3gp', '.mts', '.m4v', '.mpg'
-}
+PHOTO_EXTENSIONS = MEDIA_EXTENSIONS
 
 
 def is_photo(filename):
     """Check if a file is a photo based on its extension."""
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in PHOTO_EXTENSIONS
+    return has_extension(filename, PHOTO_EXTENSIONS)
 
 
 def calculate_hash(file_path):
-    """Calculate xxHash of a file."""
-    hash_xx = xxhash.xxh64()
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path)
+
+
+def hash_entry(entry):
+    """Return the hash and size of a scanned photo, or None for both if it can't be read."""
     try:
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hash_xx.update(chunk)
-        return hash_xx.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        return None
+        size = entry.stat().st_size
+    except OSError as e:
+        log_error(f"Error hashing {entry.path}: {e}")
+        return None, None
+    return calculate_hash(entry.path), size
+
+
+def hash_photos(folder, desc):
+    """Scan and hash the photos in a folder concurrently, yielding (path, hash, size) in scan order."""
+    entries = iter_file_entries(folder, is_photo, prune=make_prune(), with_stat=True)
+    device = device_of(folder)
+    results = imap_ordered(hash_entry, background_iter(entries), device=lambda _: device)
+    for entry, (file_hash, size) in tqdm(results, total=estimate_file_count([folder]), desc=desc, unit="file"):
+        yield entry.path, file_hash, size
 
 
 def get_hashes_from_folder(folder):
     """Calculate hashes for all photos in the folder with a progress bar."""
-    hashes = set()
-    file_list = []
+    return {file_hash for _, file_hash, _ in hash_photos(folder, f"Hashing files in {folder}") if file_hash}
+
+
+def hash_to_runs(folder, work_dir):
+    """Hash the photos in a folder into sorted runs of (hash, size, path)."""
+    records = ((file_hash, size, file_path)
+               for file_path, file_hash, size in hash_photos(folder, f"Hashing files in {folder}"))
+    return sort_into_runs(records, work_dir)
 
-    # Collect all photo files first
-    for dirpath, _, filenames in os.walk(folder):
-        for filename in filenames:
-            if is_photo(filename):
-                file_list.append(os.path.join(dirpath, filename))
 
-    # Process each file with a progress bar
-    for file_path in tqdm(file_list, desc=f"Hashing files in {folder}", unit="file"):
-        file_hash = calculate_hash(file_path)
-        if file_hash:
-            hashes.add(file_hash)
+def move_photo(file_path, originals_dir, names, file_hash=None):
+    """Move a photo into originals, returning True once its content is there.
 
-    return hashes
+    A photo whose name and content are already in originals is left in copies.
+    """
+    dest_path = names.destination(file_path, originals_dir, file_hash)
+    if dest_path is None:
+        return True
+    try:
+        shutil.move(file_path, dest_path)
+        log(f"Moved: {file_path} -> {dest_path}")
+        return True
+    except Exception as e:
+        log_error(f"Error moving {file_path}: {e}")
+        return False
 
 
 def move_unique_photos(copies_dir, originals_dir):
@@ -61,35 +90,42 @@ def move_unique_photos(copies_dir, originals_dir):
     print(f"Found {len(originals_hashes)} unique photos in originals.\n")
 
     print("Processing photos in copies...")
-    file_list = []
-
-    # Collect all photo files in copies
-    for dirpath, _, filenames in os.walk(copies_dir):
-        for filename in filenames:
-            if is_photo(filename):
-                file_list.append(os.path.join(dirpath, filename))
-
-    # Process each file with a progress bar
-    for file_path in tqdm(file_list, desc="Comparing and moving files", unit="file"):
-        file_hash = calculate_hash(file_path)
-
+    names = DestinationNames()
+    for file_path, file_hash, _ in hash_photos(copies_dir, "Comparing and moving files"):
         if file_hash and file_hash not in originals_hashes:
-            # Move the file to originals
-            dest_path = os.path.join(originals_dir, os.path.basename(file_path))
-            try:
-                shutil.move(file_path, dest_path)
-                print(f"Moved: {file_path} -> {dest_path}")
-                # Add the new hash to the set
+            # Move the file to originals and add the new hash to the set
+            if move_photo(file_path, originals_dir, names, file_hash):
                 originals_hashes.add(file_hash)
-            except Exception as e:
-                print(f"Error moving {file_path}: {e}")
         else:
-            print(f"Duplicate found, keeping in copies: {file_path}")
+            log(f"Duplicate found, keeping in copies: {file_path}")
+
+
+def move_unique_photos_external(copies_dir, originals_dir):
+    """Like move_unique_photos, but merging both folders through sorted runs on disk."""
+    with tempfile.TemporaryDirectory(prefix='copies_vs_original-', dir=MERGE_WORK_DIR) as work_dir:
+        print("Calculating hashes for originals...")
+        originals_runs = hash_to_runs(originals_dir, os.path.join(work_dir, 'originals'))
+        print("Calculating hashes for copies...")
+        copies_runs = hash_to_runs(copies_dir, os.path.join(work_dir, 'copies'))
+
+        print("Merging and moving files...")
+        names = DestinationNames()
+        for file_hash, originals, copies in merge_join(originals_runs, copies_runs):
+            # A photo missing from originals gets one of its copies moved there
+            moved = bool(originals)
+            for _, _, file_path in copies:
+                if moved:
+                    log(f"Duplicate found, keeping in copies: {file_path}")
+                else:
+                    moved = move_photo(file_path, originals_dir, names, file_hash)
 
 
 def main():
     print("Starting comparison between copies and originals...\n")
-    move_unique_photos(COPIES_DIR, ORIGINALS_DIR)
+    if EXTERNAL_MERGE:
+        move_unique_photos_external(COPIES_DIR, ORIGINALS_DIR)
+    else:
+        move_unique_photos(COPIES_DIR, ORIGINALS_DIR)
     print("\nOperation complete!")
 
 
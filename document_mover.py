@@ -1,5 +1,6 @@
 import os
 import shutil
+from photo_tools.metrics import log, log_error
 
 # Folder paths
 FINAL_DIR = '/Volumes/Photo backup/misc_from_internet'
@@ -33,17 +34,17 @@ def move_documents(final_dir, documents_dir):
                 dest_path = os.path.join(destination_path, filename)
                 try:
                     shutil.move(src_path, dest_path)
-                    print(f"Moved: {src_path} -> {dest_path}")
+                    log(f"Moved: {src_path} -> {dest_path}")
                 except Exception as e:
-                    print(f"Error moving {src_path}: {e}")
+                    log_error(f"Error moving {src_path}: {e}")
 
         # Delete the folder if it's empty after moving the documents
         if not os.listdir(dirpath):
             try:
                 os.rmdir(dirpath)
-                print(f"Deleted empty folder: {dirpath}")
+                log(f"Deleted empty folder: {dirpath}")
             except Exception as e:
-                print(f"Error deleting folder {dirpath}: {e}")
+                log_error(f"Error deleting folder {dirpath}: {e}")
 
 def main():
     print("Moving document files to the documents directory...")
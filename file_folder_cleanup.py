@@ -1,56 +1,63 @@
 import os
 import shutil
+from photo_tools.metrics import log, log_error
+from photo_tools.walker import make_prune, new_walk_stats, print_walk_stats, walk_entries
 
 # Path to the root directory where the cleanup should happen
 ROOT_DIR = '/Volumes/Photo backup/misc_from_internet'
 
 
+def is_unwanted_file(filename):
+    """Check if a file is Windows, iPhoto or Photos clutter that can be deleted."""
+    filename = filename.lower()
+    return filename == 'thumbs.db' or filename.startswith('facetile') or filename.endswith('.aae')
+
+
 def delete_unwanted_files(root_dir):
     """Delete Thumbs.db and files starting with 'AlbumArt' in all folders and subfolders."""
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if (filename.lower() == 'thumbs.db' or
-                    filename.lower().startswith('facetile') or
-                    filename.lower().endswith('.aae')):
-                file_path = os.path.join(dirpath, filename)
+    walk_stats = new_walk_stats()
+    for _, _, file_entries in walk_entries(root_dir, prune=make_prune(), stats=walk_stats):
+        for entry in file_entries:
+            if is_unwanted_file(entry.name):
+                file_path = entry.path
                 try:
                     os.remove(file_path)
-                    print(f"Deleted: {file_path}")
+                    log(f"Deleted: {file_path}")
                 except Exception as e:
-                    print(f"Error deleting {file_path}: {e}")
+                    log_error(f"Error deleting {file_path}: {e}")
+    print_walk_stats(walk_stats)
 
 
 def delete_empty_folders(root_dir):
     """Recursively delete empty folders, including those in the root directory, skipping system-protected folders."""
-    protected_folders = {'.Spotlight-V100', '.Trashes', '.fseventsd', '.TemporaryItems'}
-
-    # Walk the directory tree in bottom-up order
-    for dirpath, dirnames, _ in os.walk(root_dir, topdown=False):
-        # Skip protected folders
-        dirnames[:] = [d for d in dirnames if d not in protected_folders]
-
-        for dirname in dirnames:
-            folder_path = os.path.join(dirpath, dirname)
-            try:
-                if not os.listdir(folder_path):
-                    os.rmdir(folder_path)
-                    print(f"Deleted empty folder: {folder_path}")
-            except Exception as e:
-                print(f"Error deleting folder {folder_path}: {e}")
-
-    # Check and delete empty folders directly in the root directory
-    for entry in os.listdir(root_dir):
-        entry_path = os.path.join(root_dir, entry)
-        if entry in protected_folders:
+    walk_stats = new_walk_stats()
+    skip_protected = make_prune()
+    deleted = set()
+    has_protected = set()
+
+    def prune(entry):
+        # Protected folders are never listed or deleted, and their parent isn't empty
+        if skip_protected(entry):
+            has_protected.add(os.path.dirname(entry.path))
+            return True
+        return False
+
+    # Walk the directory tree in bottom-up order. A folder is empty when it has no files
+    # and every subfolder was deleted, so no extra listdir is needed.
+    for dirpath, dir_entries, file_entries in walk_entries(root_dir, prune=prune, topdown=False,
+                                                           stats=walk_stats):
+        if dirpath == root_dir or file_entries or dirpath in has_protected:
+            continue
+        if any(entry.path not in deleted for entry in dir_entries):
             continue
         try:
-            if os.path.isdir(entry_path) and not os.listdir(entry_path):
-                os.rmdir(entry_path)
-                print(f"Deleted empty folder in root: {entry_path}")
-        except PermissionError as e:
-            print(f"Permission error accessing {entry_path}: {e}")
+            os.rmdir(dirpath)
+            deleted.add(dirpath)
+            log(f"Deleted empty folder: {dirpath}")
         except Exception as e:
-            print(f"Error deleting root folder {entry_path}: {e}")
+            log_error(f"Error deleting folder {dirpath}: {e}")
+
+    print_walk_stats(walk_stats)
 
 
 def main():
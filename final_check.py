@@ -1,88 +1,83 @@
-import os
-import shutil
-import xxhash
-from collections import defaultdict
 from tqdm import tqdm
+from photo_tools.dest_names import DestinationNames
+from photo_tools.file_groups import FileGroups
+from photo_tools.hashing import estimate_file_count, hash_file_or_none
+from photo_tools.media import MEDIA_EXTENSIONS, has_extension
+from photo_tools.metrics import get_metrics
+from photo_tools.parallel import background_iter, device_of, imap_ordered
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path, print_plan_failures
+from photo_tools.rules import is_under
+from photo_tools.walker import iter_file_entries, make_prune, new_walk_stats, print_walk_stats
 
 # Folder paths
 ROOT_DIR = '/Volumes/Photo backup/photos'
 ORIGINALS_DIR = '/Volumes/Photo backup/photos/originals'
 COPIES_DIR = '/Volumes/Photo backup/photos/copies'
 
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
+
 # List of photo and video file extensions (case insensitive)
-PHOTO_EXTENSIONS = {
-    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.webp',
-    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.mpeg', '.3gp', '.mts', '.m4v', '.mpg'
-}
+PHOTO_EXTENSIONS = MEDIA_EXTENSIONS
 
 def is_photo(filename):
     """Check if a file is a photo based on its extension."""
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in PHOTO_EXTENSIONS
+    return has_extension(filename, PHOTO_EXTENSIONS)
 
 def calculate_hash(file_path):
-    """Calculate xxHash of a file."""
-    hash_xx = xxhash.xxh64()
-    try:
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b""):
-                hash_xx.update(chunk)
-        return hash_xx.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        return None
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path)
 
 def find_all_photos_with_hashes(root_dir):
     """Walk through the root directory and find all photos, storing them by hash."""
-    files_by_hash = defaultdict(list)
-    file_list = []
-
-    # Collect all eligible files first
-    print("Collecting photo files...")
-    for dirpath, _, filenames in tqdm(os.walk(root_dir), desc="Scanning directories", unit="dir"):
-        for filename in filenames:
-            if is_photo(filename):
-                file_list.append(os.path.join(dirpath, filename))
-
-    # Process each file with a progress bar
-    print("\nHashing photo files...")
-    for file_path in tqdm(file_list, desc="Hashing files", unit="file"):
-        file_hash = calculate_hash(file_path)
+    files_by_hash = FileGroups()
+    walk_stats = new_walk_stats()
+    entries = iter_file_entries(root_dir, is_photo, prune=make_prune(), stats=walk_stats)
+
+    # Scan and hash at the same time, the scan feeds the hashing threads through a bounded queue
+    print("Scanning and hashing photo files...")
+    device = device_of(root_dir)
+    results = imap_ordered(lambda entry: calculate_hash(entry.path),
+                           background_iter(entries), device=lambda _: device)
+    for entry, file_hash in tqdm(results, total=estimate_file_count([root_dir]),
+                                 desc="Hashing files", unit="file"):
         if file_hash:
-            files_by_hash[file_hash].append(file_path)
+            files_by_hash.add(file_hash, entry.path)
+    print_walk_stats(walk_stats)
 
     return files_by_hash
 
+def plan_duplicates_from_originals(files_by_hash, originals_dir, copies_dir, plan):
+    """Plan moving duplicates in originals to copies if they exist elsewhere on the drive."""
+    names = DestinationNames()
+    for file_hash, paths in files_by_hash.items():
+        originals = [path for path in paths if is_under(path, originals_dir)]
+        non_originals = [path for path in paths if not is_under(path, originals_dir)]
+
+        # If a file in originals has a duplicate elsewhere, move the original to copies
+        if originals and non_originals:
+            for original_path in originals:
+                dest = names.destination(original_path, copies_dir, file_hash)
+                if dest is not None:
+                    plan.move(original_path, dest)
+
 def move_duplicates_from_originals(files_by_hash, originals_dir, copies_dir):
-    """Move duplicates in originals to copies if they exist elsewhere on the drive."""
-    os.makedirs(copies_dir, exist_ok=True)  # Ensure copies directory exists
-
-    originals_count = sum(1 for paths in files_by_hash.values() if any(p.startswith(originals_dir) for p in paths))
-    print(f"\nChecking for duplicates in {originals_count} files in originals...")
-
-    with tqdm(total=originals_count, desc="Moving duplicates", unit="file") as pbar:
-        for file_hash, paths in files_by_hash.items():
-            originals = [path for path in paths if path.startswith(originals_dir)]
-            non_originals = [path for path in paths if not path.startswith(originals_dir)]
-
-            # If a file in originals has a duplicate elsewhere, move the original to copies
-            if originals and non_originals:
-                for original_path in originals:
-                    dest_path = os.path.join(copies_dir, os.path.basename(original_path))
-                    try:
-                        shutil.move(original_path, dest_path)
-                        print(f"Moved duplicate: {original_path} -> {dest_path}")
-                        pbar.update(1)
-                    except Exception as e:
-                        print(f"Error moving {original_path}: {e}")
-            else:
-                pbar.update(len(originals))
+    """Move duplicates in originals to copies, applying the plan unless this is a dry run."""
+    plan_path = default_plan_path('final_check')
+    print("\nChecking for duplicates in originals...")
+    with PlanWriter(plan_path, 'final_check') as plan:
+        plan_duplicates_from_originals(files_by_hash, originals_dir, copies_dir, plan)
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
+        return
+    print_plan_failures(apply_plan(plan_path))
 
 def main():
     print("Starting final duplicate check...\n")
 
     # Step 1: Find all photos and their hashes
-    files_by_hash = find_all_photos_with_hashes(ROOT_DIR)
+    with get_metrics().phase('scan and hash'):
+        files_by_hash = find_all_photos_with_hashes(ROOT_DIR)
 
     # Step 2: Move duplicates from originals to copies
     move_duplicates_from_originals(files_by_hash, ORIGINALS_DIR, COPIES_DIR)
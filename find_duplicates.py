@@ -1,21 +1,50 @@
 import os
-import shutil
-import xxhash
-from collections import defaultdict
+import tempfile
 from tqdm import tqdm
 import re
+from photo_tools.dest_names import DestinationNames
+from photo_tools.file_groups import FileGroups
+from photo_tools.hashing import (estimate_file_count, group_files_by_content, hash_file_or_none,
+                                 new_stage_stats, print_stage_stats, split_by_root)
+from photo_tools.media import MEDIA_EXTENSIONS, has_extension
+from photo_tools.metrics import log_error
+from photo_tools.parallel import background_iter, imap_ordered
+from photo_tools.perceptual import MAX_DISTANCE, merge_near_duplicates
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path
+from photo_tools.rules import is_under
+from photo_tools.snapshot import (apply_delta, files_by_hash_from_snapshot, hash_delta, load_snapshot,
+                                  rescan_snapshot, save_snapshot)
+from photo_tools.sorted_runs import merge_join, sort_into_runs
+from photo_tools.video import merge_video_duplicates
+from photo_tools.walker import iter_file_entries, make_prune, new_walk_stats, print_walk_stats
 
 # Folder paths
 ROOT_DIR = '/Volumes/Photo backup/final'        # Existing sorted photos
 TRANSFER_DIR = '/Volumes/Photo backup/transfer' # New photos to be sorted
 FINAL_DIR = '/Volumes/Photo backup/final'       # Destination for unique files
 
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
+
+# Reuse the snapshot of ROOT_DIR from the previous run and only rescan directories whose mtime changed
+INCREMENTAL_SCAN = False
+
+# Merge ROOT_DIR and TRANSFER_DIR through sorted runs of (hash, size, path) on disk instead of
+# in-memory dicts, so memory stays bounded for libraries of millions of files. Every file is
+# hashed in full in this mode. Runs go to MERGE_WORK_DIR, or the system temp directory if None.
+EXTERNAL_MERGE = False
+MERGE_WORK_DIR = None
+
+# Also treat resized or re-encoded copies of a photo as duplicates (needs Pillow)
+NEAR_DUPLICATES = False
+NEAR_DUPLICATE_DISTANCE = MAX_DISTANCE
+
+# Also treat re-muxed or end-trimmed copies of a video as duplicates, by fingerprinting its
+# container and first key frames (MP4, MOV, M4V and 3GP only)
+VIDEO_DUPLICATES = False
+
 # List of photo, video, and document file extensions (case insensitive)
-PHOTO_VIDEO_EXTENSIONS = {
-    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.webp',
-    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.mpeg', '.3gp', '.mts', '.m4v', '.mpg',
-    '.doc', '.docx', '.txt', '.zip'
-}
+PHOTO_VIDEO_EXTENSIONS = MEDIA_EXTENSIONS | {'.doc', '.docx', '.txt', '.zip'}
 
 # List to store problem files
 problem_files = []
@@ -26,40 +55,74 @@ def create_dirs():
 
 def is_photo_or_video(filename):
     """Check if a file is a photo, video, or document based on its extension."""
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in PHOTO_VIDEO_EXTENSIONS
-
-def calculate_hash(file_path):
-    """Calculate xxHash of a file."""
-    try:
-        hash_xx = xxhash.xxh64()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hash_xx.update(chunk)
-        return hash_xx.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        problem_files.append((file_path, str(e)))
-        return None
-
-def find_files_by_hash(root_dir):
-    """Walk through the root directory and find files, storing them by hash."""
-    files_by_hash = defaultdict(list)
-    file_list = []
-
-    # Gather all eligible files first
-    for dirpath, _, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if is_photo_or_video(filename):
-                file_path = os.path.join(dirpath, filename)
-                file_list.append(file_path)
-
-    # Process each file with a progress bar
-    for file_path in tqdm(file_list, desc=f"Hashing Files in {root_dir}", unit="file"):
-        file_hash = calculate_hash(file_path)
-        if file_hash:
-            files_by_hash[file_hash].append(file_path)
+    return has_extension(filename, PHOTO_VIDEO_EXTENSIONS)
+
+def calculate_hash(file_path, st=None):
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path, st, problem_files)
+
+def iter_files(root_dir, walk_stats=None):
+    """Walk through the root directory and yield the DirEntry of every eligible file."""
+    return iter_file_entries(root_dir, is_photo_or_video, prune=make_prune(), stats=walk_stats, with_stat=True)
+
+def find_files_by_hash(root_dirs):
+    """Find files in each root directory and group them by hash, returning one dict per root.
+
+    Files are hashed while the roots are still being scanned, and all roots are grouped
+    together so a file whose size or sample is unique across every root is never read
+    in full.
+    """
+    walk_stats = new_walk_stats()
+
+    def discover():
+        for root_index, root_dir in enumerate(root_dirs):
+            # Files below a root that was already walked were found there
+            walked = [other for other in root_dirs[:root_index]
+                      if is_under(root_dir, other) or is_under(other, root_dir)]
+            for entry in iter_files(root_dir, walk_stats):
+                if not any(is_under(entry.path, other) for other in walked):
+                    yield entry
+
+    # Directory discovery runs on its own thread and feeds hashing through a bounded queue
+    stats = new_stage_stats()
+    files_by_hash = group_files_by_content(background_iter(discover()), calculate_hash, stats,
+                                           estimated_total=estimate_file_count(root_dirs))
+    print_walk_stats(walk_stats)
+    print_stage_stats(stats)
+
+    if NEAR_DUPLICATES:
+        print("Comparing perceptual hashes of images...")
+        files_by_hash = merge_near_duplicates(files_by_hash, NEAR_DUPLICATE_DISTANCE)
+
+    if VIDEO_DUPLICATES:
+        print("Comparing video fingerprints...")
+        files_by_hash = merge_video_duplicates(files_by_hash)
+
+    return split_by_root(files_by_hash, root_dirs)
+
+def find_existing_files_incremental(root_dir):
+    """Update the files_by_hash of the root directory from its previous snapshot, hashing only what changed."""
+    walk_stats = new_walk_stats()
+    old_snapshot = load_snapshot(root_dir)
+    files_by_hash = files_by_hash_from_snapshot(old_snapshot)
+
+    snapshot, delta = rescan_snapshot(root_dir, old_snapshot, is_photo_or_video, make_prune(), walk_stats)
+    print_walk_stats(walk_stats)
+    print(f"{len(delta['added'])} added, {len(delta['modified'])} modified, "
+          f"{len(delta['removed'])} removed since the last scan")
+
+    hashes = hash_delta(snapshot, delta, calculate_hash)
+    apply_delta(files_by_hash, delta, hashes)
+    save_snapshot(snapshot)
+    return files_by_hash
 
+def find_files_by_full_hash(root_dir):
+    """Find files in the root directory and group them by full hash."""
+    files_by_hash = FileGroups()
+    results = imap_ordered(lambda entry: calculate_hash(entry.path), background_iter(iter_files(root_dir)))
+    for entry, file_hash in tqdm(results, desc=f"Hashing Files in {root_dir}", unit="file"):
+        if file_hash:
+            files_by_hash.add(file_hash, entry.path)
     return files_by_hash
 
 def get_preferred_folder(file_path):
@@ -68,49 +131,100 @@ def get_preferred_folder(file_path):
     closest_folder = os.path.basename(os.path.dirname(file_path))
     return closest_folder if not year_pattern.match(closest_folder) else None
 
-def move_file(src, folder_name):
-    """Move a file to the final directory, using the specified folder name."""
-    try:
-        dest_dir = os.path.join(FINAL_DIR, folder_name)
-        os.makedirs(dest_dir, exist_ok=True)
+def final_path(src, folder_name, names, file_hash=None):
+    """Return where a file goes in the final directory, using the specified folder name.
+
+    Returns None if a file with the same name and content is already there.
+    """
+    return names.destination(src, os.path.join(FINAL_DIR, folder_name), file_hash)
+
+def plan_unique_files(existing_files_dict, transfer_files_dict, plan):
+    """Plan moving unique files from transfer directory to the final directory."""
+    names = DestinationNames()
+    for file_hash, paths in transfer_files_dict.items():
+        if file_hash not in existing_files_dict:
+            # Move the file using the preferred folder name
+            for file_path in paths:
+                folder_name = get_preferred_folder(file_path) or "unsorted"
+                dest = final_path(file_path, folder_name, names, file_hash)
+                if dest is not None:
+                    plan.move(file_path, dest)
+
+def hash_to_runs(root_dir, work_dir):
+    """Hash every eligible file in the root directory into sorted runs of (hash, size, path)."""
+    def hash_entry(entry):
+        try:
+            st = entry.stat()
+        except OSError as e:
+            log_error(f"Error hashing {entry.path}: {e}")
+            return None, None
+        return calculate_hash(entry.path, st), st.st_size
+
+    results = imap_ordered(hash_entry, background_iter(iter_files(root_dir)))
+    records = ((file_hash, size, entry.path)
+               for entry, (file_hash, size) in tqdm(results, desc=f"Hashing Files in {root_dir}", unit="file"))
+    return sort_into_runs(records, work_dir)
+
+def plan_unique_files_external(existing_dir, transfer_dir, plan):
+    """Plan moving unique files from the transfer directory, merging both directories through sorted runs."""
+    with tempfile.TemporaryDirectory(prefix='find_duplicates-', dir=MERGE_WORK_DIR) as work_dir:
+        existing_runs = hash_to_runs(existing_dir, os.path.join(work_dir, 'existing'))
+        transfer_runs = hash_to_runs(transfer_dir, os.path.join(work_dir, 'transfer'))
+        names = DestinationNames()
+        for file_hash, existing, transfer in merge_join(existing_runs, transfer_runs):
+            if not existing:
+                for _, _, file_path in transfer:
+                    folder_name = get_preferred_folder(file_path) or "unsorted"
+                    dest = final_path(file_path, folder_name, names, file_hash)
+                    if dest is not None:
+                        plan.move(file_path, dest)
 
-        dest_path = os.path.join(dest_dir, os.path.basename(src))
+def move_unique_files(existing_files_dict, transfer_files_dict):
+    """Plan the unique files to move, then apply the plan unless this is a dry run."""
+    write_and_apply_plan(lambda plan: plan_unique_files(existing_files_dict, transfer_files_dict, plan))
 
-        shutil.move(src, dest_path)
-        print(f"Moved: {src} -> {dest_path}")
-    except Exception as e:
-        print(f"Error moving {src}: {e}")
-        problem_files.append((src, str(e)))
+def move_unique_files_external(existing_dir, transfer_dir):
+    """Like move_unique_files, but merging the two directories on disk rather than in memory."""
+    write_and_apply_plan(lambda plan: plan_unique_files_external(existing_dir, transfer_dir, plan))
 
-def move_unique_files(existing_files_dict, transfer_files_dict):
-    """Move unique files from transfer directory to the final directory."""
-    total_files = sum(len(paths) for paths in transfer_files_dict.values())
-    with tqdm(total=total_files, desc="Moving Unique Files", unit="file") as pbar:
-        for file_hash, paths in transfer_files_dict.items():
-            if file_hash not in existing_files_dict:
-                # Move the file using the preferred folder name
-                for file_path in paths:
-                    folder_name = get_preferred_folder(file_path) or "unsorted"
-                    move_file(file_path, folder_name)
-            pbar.update(len(paths))
+def write_and_apply_plan(plan_moves):
+    """Write the plan with plan_moves(plan), then apply it unless this is a dry run."""
+    plan_path = default_plan_path('find_duplicates')
+    with PlanWriter(plan_path, 'find_duplicates') as plan:
+        plan_moves(plan)
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
+        return
+
+    for op, error in apply_plan(plan_path):
+        problem_files.append((op['src'], error))
 
 def main():
     create_dirs()
-    print("Scanning existing final directory for photo, video, and document files...")
-    existing_files_dict = find_files_by_hash(ROOT_DIR)
+    if EXTERNAL_MERGE:
+        print("Hashing existing final and transfer directories into sorted runs and merging them...")
+        move_unique_files_external(ROOT_DIR, TRANSFER_DIR)
+    else:
+        if INCREMENTAL_SCAN:
+            # Incremental keys must be real hashes, so the transfer side is hashed in full
+            print("Rescanning changed directories of the existing final directory...")
+            existing_files_dict = find_existing_files_incremental(ROOT_DIR)
 
-    print("\nScanning transfer directory for photo, video, and document files...")
-    transfer_files_dict = find_files_by_hash(TRANSFER_DIR)
+            print("\nScanning transfer directory for photo, video, and document files...")
+            transfer_files_dict = find_files_by_full_hash(TRANSFER_DIR)
+        else:
+            print("Scanning existing final and transfer directories for photo, video, and document files...")
+            existing_files_dict, transfer_files_dict = find_files_by_hash([ROOT_DIR, TRANSFER_DIR])
 
-    print("\nIdentifying and moving unique files to the final directory...")
-    move_unique_files(existing_files_dict, transfer_files_dict)
+        print("\nIdentifying and moving unique files to the final directory...")
+        move_unique_files(existing_files_dict, transfer_files_dict)
 
     # Print problem files at the end
     if problem_files:
         print("\nThe following files could not be moved due to permission errors or other issues:")
         for file_path, error in problem_files:
             print(f"{file_path} - {error}")
-    else:
+    elif not DRY_RUN:
         print("\nAll unique files were moved successfully!")
 
     print("Done!")
@@ -1,21 +1,34 @@
+import argparse
 import os
-import shutil
-import xxhash
-from collections import defaultdict
-from tqdm import tqdm
 import re
+from photo_tools.checkpoint import finish_checkpoint, start_checkpoint
+from photo_tools.dest_names import DestinationNames
+from photo_tools.hashing import (estimate_file_count, group_files_by_content, hash_file_or_none,
+                                 new_stage_stats, print_stage_stats, split_by_root)
+from photo_tools.media import DOCUMENT_EXTENSIONS, MEDIA_EXTENSIONS, has_extension
+from photo_tools.parallel import background_iter
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path
+from photo_tools.reference_index import (ReferenceIndex, add_moved_file, default_index_path,
+                                         refresh_reference_index)
+from photo_tools.rules import is_under
+from photo_tools.walker import iter_file_entries, make_prune, new_walk_stats, print_walk_stats
 
 # Folder paths
 ROOT_DIR = '/Volumes/Photo backup'              # Existing drive
 NEW_DRIVE_DIR = '/Volumes/Madison Backup/Photo Project 2020'      # New hard drive with potential new photos
 FINAL_DIR = '/Volumes/Photo backup/final'       # Destination for unique files
 
+# Check the new drive against a digest index of the existing drive instead of hashing ROOT_DIR
+# along with it. The index is kept in the home folder and rewritten whenever a rescan of
+# ROOT_DIR, which only lists folders that changed, finds anything new, changed or removed.
+USE_REFERENCE_INDEX = False
+REFERENCE_INDEX_PATH = default_index_path(ROOT_DIR)
+
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
+
 # List of photo and video file extensions (case insensitive)
-PHOTO_VIDEO_EXTENSIONS = {
-    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.webp',
-    '.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.mpeg', '.3gp', '.mts', '.m4v', '.mpg',
-    '.doc', '.docx', '.xls', '.xlsx', '.pdf', '.ppt', '.pptx', '.txt', '.csv', '.zip', '.rar', '.7z'
-}
+PHOTO_VIDEO_EXTENSIONS = MEDIA_EXTENSIONS | DOCUMENT_EXTENSIONS
 
 # List to store problem files
 problem_files = []
@@ -26,52 +39,55 @@ def create_dirs():
 
 def is_photo_or_video(filename):
     """Check if a file is a photo or video based on its extension."""
-    _, ext = os.path.splitext(filename)
-    return ext.lower() in PHOTO_VIDEO_EXTENSIONS
-
-def calculate_hash(file_path):
-    """Calculate xxHash of a file."""
-    try:
-        hash_xx = xxhash.xxh64()
-        with open(file_path, 'rb') as f:
-            while chunk := f.read(8192):
-                hash_xx.update(chunk)
-        return hash_xx.hexdigest()
-    except Exception as e:
-        print(f"Error hashing {file_path}: {e}")
-        problem_files.append((file_path, str(e)))
-        return None
-
-def find_files_by_hash(root_dir):
-    """Walk through the root directory and find photo and video files, storing them by hash."""
-    files_by_hash = defaultdict(list)
-    file_list = []
-
-    # Count the number of directories first for the progress bar
-    dir_count = sum(1 for _ in os.walk(root_dir))
-
-    # Initialize the progress bar for scanning directories
-    with tqdm(total=dir_count, desc="Scanning Directories", unit="dir") as pbar:
-        for dirpath, _, filenames in os.walk(root_dir):
-            # Skip any directory that contains the word "thumbnail"
-            if "thumbnail" in dirpath.lower():
-                pbar.update(1)
-                continue
-
-            for filename in filenames:
-                if is_photo_or_video(filename):
-                    file_path = os.path.join(dirpath, filename)
-                    file_list.append(file_path)
-
-            pbar.update(1)  # Update the progress bar for each scanned directory
-
-    # Process each file with a progress bar
-    for file_path in tqdm(file_list, desc=f"Hashing Files in {root_dir}", unit="file"):
-        file_hash = calculate_hash(file_path)
-        if file_hash:
-            files_by_hash[file_hash].append(file_path)
-
-    return files_by_hash
+    return has_extension(filename, PHOTO_VIDEO_EXTENSIONS)
+
+def calculate_hash(file_path, st=None):
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path, st, problem_files)
+
+def files_prune():
+    """Skip any directory that contains the word "thumbnail" and macOS system folders."""
+    return make_prune(name_contains=("thumbnail",))
+
+def iter_files(root_dir, walk_stats=None):
+    """Walk through the root directory and yield the DirEntry of every photo and video file."""
+    return iter_file_entries(root_dir, is_photo_or_video, prune=files_prune(), stats=walk_stats, with_stat=True)
+
+def find_files_by_hash(root_dirs, known_sizes=None):
+    """Find photo and video files in each root directory and group them by hash, returning one dict per root.
+
+    Files are hashed while the roots are still being scanned, and all roots are grouped
+    together so a file whose size or sample is unique across every root is never read
+    in full. Files whose size is in known_sizes are always fully hashed so they can be
+    checked against a reference index.
+    """
+    walk_stats = new_walk_stats()
+
+    def discover():
+        for root_index, root_dir in enumerate(root_dirs):
+            # Files below a root that was already walked were found there
+            walked = [other for other in root_dirs[:root_index]
+                      if is_under(root_dir, other) or is_under(other, root_dir)]
+            for entry in iter_files(root_dir, walk_stats):
+                if not any(is_under(entry.path, other) for other in walked):
+                    yield entry
+
+    # Directory discovery runs on its own thread and feeds hashing through a bounded queue
+    stats = new_stage_stats()
+    files_by_hash = group_files_by_content(background_iter(discover()), calculate_hash, stats,
+                                           estimated_total=estimate_file_count(root_dirs),
+                                           known_sizes=known_sizes)
+    print_walk_stats(walk_stats)
+    print_stage_stats(stats)
+
+    return split_by_root(files_by_hash, root_dirs)
+
+def load_reference_index(root_dir, index_path):
+    """Open the reference index of the existing drive, first bringing it up to date with the drive."""
+    print(f"Checking {root_dir} for changes since its reference index was written...")
+    reference_index = refresh_reference_index(root_dir, index_path, is_photo_or_video, calculate_hash, files_prune())
+    print(f"Loaded reference index with {len(reference_index)} digests.")
+    return reference_index
 
 def check_drive_accessibility(drive_dir):
     """Check if the drive is accessible."""
@@ -105,47 +121,78 @@ def get_preferred_folder(file_paths):
         # Fallback to the first path if no valid folder is found
         return file_paths[0], os.path.basename(os.path.dirname(file_paths[0]))
 
-def move_file(src, folder_name):
-    """Move a file to the final directory, using the specified folder name."""
-    try:
-        dest_dir = os.path.join(FINAL_DIR, folder_name)
-        os.makedirs(dest_dir, exist_ok=True)
+def final_path(src, folder_name, names, file_hash=None):
+    """Return where a file goes in the final directory, using the specified folder name.
 
-        dest_path = os.path.join(dest_dir, os.path.basename(src))
+    Returns None if a file with the same name and content is already there.
+    """
+    return names.destination(src, os.path.join(FINAL_DIR, folder_name), file_hash)
 
-        shutil.move(src, dest_path)
-        print(f"Moved: {src} -> {dest_path}")
-    except Exception as e:
-        print(f"Error moving {src}: {e}")
-        problem_files.append((src, str(e)))
+def plan_unique_files(existing_files_dict, new_files_dict, plan):
+    """Plan moving unique files from the new drive to the final directory, maintaining folder preferences."""
+    names = DestinationNames()
+    for file_hash, paths in new_files_dict.items():
+        if file_hash not in existing_files_dict:
+            # Get the preferred folder name for the unique file
+            unique_file, preferred_folder = get_preferred_folder(paths)
+            dest = final_path(unique_file, preferred_folder, names, file_hash)
+            if dest is not None:
+                plan.move(unique_file, dest, hash=file_hash)
 
 def move_unique_files(existing_files_dict, new_files_dict):
-    """Move unique files from the new drive to the final directory, maintaining folder preferences."""
-    total_files = sum(len(paths) for paths in new_files_dict.values())
-    with tqdm(total=total_files, desc="Moving Unique Files", unit="file") as pbar:
-        for file_hash, paths in new_files_dict.items():
-            if file_hash not in existing_files_dict:
-                # Get the preferred folder name for the unique file
-                unique_file, preferred_folder = get_preferred_folder(paths)
-                move_file(unique_file, preferred_folder)
-            pbar.update(len(paths))
-
-
-def main():
-    create_dirs()
-
-    if not check_drive_accessibility(NEW_DRIVE_DIR):
+    """Plan the unique files to move, then apply the plan unless this is a dry run.
+
+    existing_files_dict may be a files_by_hash dict or a ReferenceIndex; an index is
+    updated in place with every file moved into FINAL_DIR.
+    """
+    is_index = isinstance(existing_files_dict, ReferenceIndex)
+    plan_path = default_plan_path('find_duplicates_multi_drive')
+    header = {'reference_index': REFERENCE_INDEX_PATH} if is_index else {}
+    with PlanWriter(plan_path, 'find_duplicates_multi_drive', **header) as plan:
+        plan_unique_files(existing_files_dict, new_files_dict, plan)
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
         return
 
-    print("Scanning existing drive for photo and video files...")
-    existing_files_dict = find_files_by_hash(ROOT_DIR)
+    on_moved = None
+    if is_index:
+        on_moved = lambda op: add_moved_file(existing_files_dict, op['hash'], op['dest'], calculate_hash)
+    for op, error in apply_plan(plan_path, on_moved):
+        problem_files.append((op['src'], error))
+    if is_index:
+        existing_files_dict.compact()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move photos and videos from a new drive that aren't on the existing drive yet.")
+    parser.add_argument('--resume', action='store_true',
+                        help="reuse the hashes checkpointed by an interrupted run for files that haven't changed")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    create_dirs()
 
-    # Check if the new drive is accessible before scanning
     if not check_drive_accessibility(NEW_DRIVE_DIR):
         return
 
-    print("\nScanning new drive for photo and video files...")
-    new_files_dict = find_files_by_hash(NEW_DRIVE_DIR)
+    # Hashes are checkpointed every few seconds, so a run that dies can pick up where it stopped
+    start_checkpoint('find_duplicates_multi_drive', resume=args.resume)
+    try:
+        if USE_REFERENCE_INDEX:
+            existing_files_dict = load_reference_index(ROOT_DIR, REFERENCE_INDEX_PATH)
+
+            print("\nScanning new drive for photo and video files...")
+            new_files_dict, = find_files_by_hash([NEW_DRIVE_DIR], known_sizes=existing_files_dict.sizes())
+        else:
+            print("Scanning existing drive and new drive for photo and video files...")
+            existing_files_dict, new_files_dict = find_files_by_hash([ROOT_DIR, NEW_DRIVE_DIR])
+    except BaseException:
+        finish_checkpoint(complete=False)
+        print("\nHashing was interrupted, run again with --resume to continue from the checkpoint.")
+        raise
+    finish_checkpoint()
 
     print("\nIdentifying and moving unique files to the final directory...")
     move_unique_files(existing_files_dict, new_files_dict)
@@ -155,9 +202,12 @@ def main():
         print("\nThe following files could not be moved due to permission errors or other issues:")
         for file_path, error in problem_files:
             print(f"{file_path} - {error}")
-    else:
+    elif not DRY_RUN:
         print("\nAll unique files were moved successfully!")
 
+    if USE_REFERENCE_INDEX:
+        existing_files_dict.close()
+
     print("Done!")
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+import argparse
+import contextlib
+import json
+import os
+import re
+import socket
+from tqdm import tqdm
+from photo_tools.digest_tables import merge_digest_tables, read_table_header, write_digest_table
+from photo_tools.hashing import estimate_file_count, hash_file
+from photo_tools.media import DOCUMENT_EXTENSIONS, MEDIA_EXTENSIONS, has_extension
+from photo_tools.metrics import log_error
+from photo_tools.parallel import background_iter, imap_ordered
+from photo_tools.plan import PlanWriter
+from photo_tools.rules import is_under
+from photo_tools.walker import iter_file_entries, make_prune, new_walk_stats, print_walk_stats
+
+# Roots scanned when none are given on the command line
+SCAN_ROOTS = ['/Volumes/Photo backup']
+
+# Folder inside each scanned root that redundant copies are moved into. It is never scanned.
+DUPLICATES_FOLDER = 'duplicates'
+
+# Where merge writes the duplicate groups and one plan per host
+MERGE_OUTPUT_DIR = os.path.expanduser('~/.photo_sharded_merge')
+
+# List of photo, video, and document file extensions (case insensitive)
+PHOTO_VIDEO_EXTENSIONS = MEDIA_EXTENSIONS | DOCUMENT_EXTENSIONS
+
+
+def is_photo_or_video(filename):
+    """Check if a file is a photo, video, or document based on its extension."""
+    return has_extension(filename, PHOTO_VIDEO_EXTENSIONS)
+
+
+def hash_entry(entry):
+    """Return the hash, size and mtime of a scanned file, or None for all three if it can't be read."""
+    try:
+        st = entry.stat()
+        return hash_file(entry.path, st), st.st_size, st.st_mtime_ns
+    except Exception as e:
+        log_error(f"Error hashing {entry.path}: {e}")
+        return None, None, None
+
+
+def entry_device(entry):
+    """Return the st_dev of a scanned file from its cached stat, or 0 if it can't be stat'ed."""
+    try:
+        return entry.stat().st_dev
+    except OSError:
+        return 0
+
+
+def scan(host, roots, table_path):
+    """Hash every file below this host's roots into a digest table for merge."""
+    roots = [os.path.abspath(root) for root in roots]
+    walk_stats = new_walk_stats()
+    # Only the duplicates folder at the top of each root, a folder of that name deeper down is scanned
+    prune = make_prune(paths=[os.path.join(root, DUPLICATES_FOLDER) for root in roots])
+
+    def entries():
+        for root_index, root in enumerate(roots):
+            # Files below a root that was already walked were found there
+            walked = [other for other in roots[:root_index] if is_under(root, other) or is_under(other, root)]
+            for entry in iter_file_entries(root, is_photo_or_video, prune=prune, stats=walk_stats, with_stat=True):
+                if not any(is_under(entry.path, other) for other in walked):
+                    yield entry
+
+    # Each root's drive gets its own concurrency cap and read queue
+    results = tqdm(imap_ordered(hash_entry, background_iter(entries()), device=entry_device),
+                   total=estimate_file_count(roots), desc=f"Hashing files on {host}", unit="file")
+    records = ((file_hash, size, entry.path, mtime_ns) for entry, (file_hash, size, mtime_ns) in results)
+    count = write_digest_table(table_path, records, host, roots)
+    print_walk_stats(walk_stats)
+    print(f"Wrote {count} digests of {host} to '{table_path}'")
+
+
+def safe_name(host):
+    """Return a host name with anything unsafe in a file name replaced."""
+    return re.sub(r'[^\w.-]', '_', host)
+
+
+def host_plan_path(output_dir, host):
+    """Return the plan merge writes for a host."""
+    return os.path.join(output_dir, f"{safe_name(host)}.plan.jsonl")
+
+
+def merge(table_paths, output_dir, prefer_hosts=()):
+    """Merge the digest tables of several hosts into global duplicate groups and one move plan per host.
+
+    The copy kept in each group is the one on the most preferred host (prefer_hosts,
+    then the order of the tables), and the oldest on that host. Every other copy is
+    planned to move into DUPLICATES_FOLDER of the root it was found in, keeping its
+    path below that root, on the host that has it. Nothing is deleted and no file
+    crosses hosts. Works entirely from the tables, without access to any host.
+    """
+    roots_by_host = {}
+    for table_path in table_paths:
+        header = read_table_header(table_path)
+        roots_by_host.setdefault(header['host'], []).extend(header['roots'])
+    host_rank = {}
+    for host in list(prefer_hosts) + list(roots_by_host):
+        if host in roots_by_host:
+            host_rank.setdefault(host, len(host_rank))
+
+    def root_of(host, path):
+        # The deepest root holding the path, in case a host's roots are nested
+        return max((root for root in roots_by_host[host] if is_under(path, root)), key=len)
+
+    os.makedirs(output_dir, exist_ok=True)
+    groups_path = os.path.join(output_dir, 'duplicate_groups.jsonl')
+    counts = {host: {'files': 0, 'bytes': 0} for host in roots_by_host}
+    group_count = 0
+    with contextlib.ExitStack() as stack:
+        plans = {host: stack.enter_context(PlanWriter(host_plan_path(output_dir, host), 'find_duplicates_sharded',
+                                                      host=host))
+                 for host in roots_by_host}
+        groups = stack.enter_context(open(groups_path, 'w', encoding='utf-8', errors='surrogateescape'))
+        for digest, size, copies in merge_digest_tables(table_paths):
+            # The same file listed twice, e.g. by a table scanned from nested roots, is one copy
+            unique = {}
+            for copy in copies:
+                unique.setdefault(copy[:2], copy)
+            copies = list(unique.values())
+            if len(copies) < 2:
+                continue
+            group_count += 1
+            keeper = min(copies, key=lambda copy: (host_rank[copy[0]], copy[2], copy[1]))
+            redundant = [copy for copy in copies if copy != keeper]
+            groups.write(json.dumps({
+                'digest': digest,
+                'size': size,
+                'keep': {'host': keeper[0], 'path': keeper[1]},
+                'copies': [{'host': host, 'path': path} for host, path, _ in redundant],
+            }, ensure_ascii=False) + '\n')
+            for host, path, _ in redundant:
+                root = root_of(host, path)
+                dest = os.path.join(root, DUPLICATES_FOLDER, os.path.relpath(path, root))
+                plans[host].move(path, dest, hash=digest)
+                counts[host]['files'] += 1
+                counts[host]['bytes'] += size
+
+    print(f"\n{group_count} groups of duplicates written to '{groups_path}'")
+    for host, host_counts in counts.items():
+        print(f"  {host}: {host_counts['files']} redundant copies ({host_counts['bytes'] / 1e9:.2f} GB), "
+              f"apply there with: python apply_plan.py '{host_plan_path(output_dir, host)}'")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Find duplicates across drives attached to different machines: scan each host into a "
+                    "digest table, then merge the tables anywhere into one move plan per host.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan_parser = subparsers.add_parser('scan', help="hash this host's roots into a digest table")
+    scan_parser.add_argument('roots', nargs='*', help=f"folders to scan (default: {', '.join(SCAN_ROOTS)})")
+    scan_parser.add_argument('--host', default=socket.gethostname(),
+                             help="name recorded for this host (default: the host name)")
+    scan_parser.add_argument('--output', help="table to write (default: <host>.digests.jsonl.gz)")
+
+    merge_parser = subparsers.add_parser('merge', help="merge digest tables into duplicate groups and plans")
+    merge_parser.add_argument('tables', nargs='+', help="digest tables written by scan")
+    merge_parser.add_argument('--prefer', action='append', default=[], metavar='HOST',
+                              help="host whose copies are kept first, may be repeated (default: table order)")
+    merge_parser.add_argument('--output-dir', default=MERGE_OUTPUT_DIR,
+                              help=f"where to write the groups and plans (default: {MERGE_OUTPUT_DIR})")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'scan':
+        table_path = args.output or f"{safe_name(args.host)}.digests.jsonl.gz"
+        scan(args.host, args.roots or SCAN_ROOTS, table_path)
+    else:
+        merge(args.tables, args.output_dir, args.prefer)
+
+
+if __name__ == "__main__":
+    main()
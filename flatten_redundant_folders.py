@@ -1,5 +1,6 @@
 import os
 import shutil
+from photo_tools.metrics import log, log_error
 
 # Base path where the documents are stored
 DOCUMENTS_DIR = '/Volumes/Photo backup/documents'
@@ -19,14 +20,14 @@ def flatten_redundant_subfolders(base_dir):
                         src = os.path.join(nested_folder, item)
                         dest = os.path.join(dirpath, item)
                         shutil.move(src, dest)
-                        print(f"Moved: {src} -> {dest}")
+                        log(f"Moved: {src} -> {dest}")
 
                     # Remove the now-empty nested folder
                     os.rmdir(nested_folder)
-                    print(f"Deleted empty folder: {nested_folder}")
+                    log(f"Deleted empty folder: {nested_folder}")
 
                 except Exception as e:
-                    print(f"Error processing {nested_folder}: {e}")
+                    log_error(f"Error processing {nested_folder}: {e}")
 
 def main():
     print(f"Flattening redundant subfolders in: {DOCUMENTS_DIR}")
@@ -1,7 +1,12 @@
 import os
-import shutil
 import re
 from datetime import datetime
+from photo_tools.dates import is_datable, read_capture_dates
+from photo_tools.dest_names import DestinationNames
+from photo_tools.metrics import log_error
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path, print_plan_failures
+from photo_tools.rules import is_under
+from photo_tools.walker import iter_file_entries, make_prune, new_walk_stats, print_walk_stats, walk_entries
 
 # Path to the root directory where the date-named folders are located
 ROOT_DIR = '/Volumes/Photo backup'
@@ -9,46 +14,109 @@ ROOT_DIR = '/Volumes/Photo backup'
 # Path to the final directory where files should be moved
 FINAL_DIR = '/Volumes/Photo backup/final'
 
+# Regex to match folders like '20160714-124524'
+DATE_FOLDER_PATTERN = re.compile(r'^(\d{4})(\d{2})\d{2}-\d{6}$')
+
+# Folders whose photos and videos are moved to /year/month by the date they were taken, read
+# from their EXIF, HEIC or MP4/MOV headers. Files without a readable date are left in place.
+METADATA_DATE_DIRS = ()
+
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
+
 def get_month_name(month_number):
     """Convert a month number to its full month name."""
     return datetime.strptime(month_number, "%m").strftime("%B")
 
-def move_files_by_date(root_dir, final_dir):
-    """Find folders with date names and move their files to /year/month structure in the final directory."""
-    # Regex to match folders like '20160714-124524'
-    date_folder_pattern = re.compile(r'^(\d{4})(\d{2})\d{2}-\d{6}$')
+def plan_files_by_date(root_dir, final_dir, plan, names=None):
+    """Find folders with date names and plan moving their files to /year/month structure in the final directory."""
+    names = names or DestinationNames()
+    walk_stats = new_walk_stats()
+    # The final directory sits inside the root directory, don't walk what we've already moved
+    prune = make_prune(paths=(final_dir,))
 
-    for dirpath, dirnames, _ in os.walk(root_dir):
-        for dirname in dirnames:
-            match = date_folder_pattern.match(dirname)
+    # Date folders with nothing but files, which can be deleted once all of them have moved
+    emptied_folders = []
+    for dirpath, dir_entries, _ in walk_entries(root_dir, prune=prune, stats=walk_stats):
+        for dir_entry in list(dir_entries):
+            match = DATE_FOLDER_PATTERN.match(dir_entry.name)
             if match:
                 year, month = match.groups()
                 month_name = get_month_name(month)
 
-                source_folder = os.path.join(dirpath, dirname)
+                source_folder = dir_entry.path
                 dest_folder = os.path.join(final_dir, year, month_name)
 
-                # Create the destination folder if it doesn't exist
-                os.makedirs(dest_folder, exist_ok=True)
-
                 # Move all files from the source folder to the destination folder
-                for filename in os.listdir(source_folder):
-                    source_file = os.path.join(source_folder, filename)
-                    if os.path.isfile(source_file):
-                        dest_file = os.path.join(dest_folder, filename)
-                        try:
-                            shutil.move(source_file, dest_file)
-                            print(f"Moved: {source_file} -> {dest_file}")
-                        except Exception as e:
-                            print(f"Error moving {source_file}: {e}")
-
-                # Delete the source folder if it's empty
-                if not os.listdir(source_folder):
-                    try:
-                        os.rmdir(source_folder)
-                        print(f"Deleted empty folder: {source_folder}")
-                    except Exception as e:
-                        print(f"Error deleting folder {source_folder}: {e}")
+                remaining = 0
+                try:
+                    walk_stats['scandir_calls'] += 1
+                    with os.scandir(source_folder) as it:
+                        entries = list(it)
+                except OSError as e:
+                    log_error(f"Error reading {source_folder}: {e}")
+                    continue
+                for entry in entries:
+                    dest = names.destination(entry.path, dest_folder) if entry.is_file() else None
+                    if dest is None:
+                        # A folder, or a file the month folder already has
+                        remaining += 1
+                        continue
+                    plan.move(entry.path, dest)
+
+                if not remaining:
+                    emptied_folders.append(source_folder)
+                    dir_entries.remove(dir_entry)
+
+    print_walk_stats(walk_stats)
+
+    # Delete the source folders once their files have moved
+    for source_folder in emptied_folders:
+        plan.rmdir(source_folder)
+
+def plan_files_by_capture_date(source_dirs, final_dir, plan, names=None):
+    """Plan moving the photos and videos in source_dirs to /year/month by the date their metadata gives."""
+    names = names or DestinationNames()
+    walk_stats = new_walk_stats()
+    # Files of date-named folders are moved by their folder's name instead
+    prune = make_prune(paths=(final_dir,), pattern=DATE_FOLDER_PATTERN)
+
+    # A folder inside another source folder is walked with it
+    source_dirs = [os.path.normpath(source_dir) for source_dir in source_dirs]
+    source_dirs = [source_dir for source_dir in set(source_dirs)
+                   if not any(other != source_dir and is_under(source_dir, other) for other in source_dirs)]
+
+    def paths():
+        for source_dir in sorted(source_dirs):
+            for entry in iter_file_entries(source_dir, is_datable, prune=prune, stats=walk_stats):
+                yield entry.path
+
+    undated = 0
+    for file_path, taken in read_capture_dates(paths()):
+        if taken is None:
+            undated += 1
+            continue
+        dest_folder = os.path.join(final_dir, f"{taken.year:04d}", get_month_name(f"{taken.month:02d}"))
+        dest = names.destination(file_path, dest_folder)
+        if dest is not None:
+            plan.move(file_path, dest)
+
+    print_walk_stats(walk_stats)
+    print(f"{undated} files have no readable date and stay where they are")
+
+def move_files_by_date(root_dir, final_dir):
+    """Move files from date-named folders and METADATA_DATE_DIRS, applying the plan unless this is a dry run."""
+    plan_path = default_plan_path('move_dates')
+    # Both kinds of moves share the month folders, so they share their names too
+    names = DestinationNames()
+    with PlanWriter(plan_path, 'move_dates') as plan:
+        plan_files_by_date(root_dir, final_dir, plan, names)
+        if METADATA_DATE_DIRS:
+            plan_files_by_capture_date(METADATA_DATE_DIRS, final_dir, plan, names)
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
+        return
+    print_plan_failures(apply_plan(plan_path))
 
 def main():
     print("Moving files from date-named folders to /year/month structure in final directory...")
@@ -0,0 +1,44 @@
+import os
+import sys
+from photo_tools.mover import JOURNAL_DIR, read_journal, resume_moves, rollback_moves
+
+
+def list_journals():
+    """Print every journal with its status and number of moves."""
+    try:
+        names = sorted(os.listdir(JOURNAL_DIR))
+    except FileNotFoundError:
+        names = []
+    if not names:
+        print(f"No move journals in '{JOURNAL_DIR}'.")
+        return
+    for name in names:
+        moves, done, refused, _, _, status = read_journal(os.path.join(JOURNAL_DIR, name))
+        print(f"{name}: {status}, {len(done)}/{len(moves)} moves recorded as done"
+              + (f", {len(refused)} refused because the destination existed" if refused else ""))
+
+
+def print_failures(results):
+    failures = [(src, error) for src, _, error, _ in results if error]
+    for src, error in failures:
+        print(f"{src} - {error}")
+    print(f"\n{len(results) - len(failures)} files moved, {len(failures)} failed.")
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('resume', 'rollback'):
+        print("Usage: python move_journal.py [resume|rollback] <journal>\n")
+        list_journals()
+        return
+
+    action, journal_path = sys.argv[1], sys.argv[2]
+    if not os.path.exists(journal_path):
+        journal_path = os.path.join(JOURNAL_DIR, journal_path)
+    if action == 'resume':
+        print_failures(resume_moves(journal_path))
+    else:
+        print_failures(rollback_moves(journal_path))
+
+
+if __name__ == "__main__":
+    main()
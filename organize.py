@@ -0,0 +1,135 @@
+import os
+from cleanup_misc_internet import PATTERN as NUMBERED_FOLDER_PATTERN
+from document_mover import is_document
+from file_folder_cleanup import is_unwanted_file
+from move_dates import DATE_FOLDER_PATTERN, get_month_name
+from photo_tools.metrics import get_metrics
+from photo_tools.plan import PlanWriter, apply_plan, default_plan_path, print_plan_failures
+from photo_tools.rules import DELETE, is_under, plan_rules
+from reorganize_years import EVENT_YEAR_PATTERN, VALID_YEAR_RANGE, format_folder_name
+from thumbnail_cleaner import THUMBNAIL_FOLDER_PATTERN
+
+# Drive walked once for every rule
+ROOT_DIR = '/Volumes/Photo backup'
+
+# Folders the rules read from and move into, see the scripts each rule comes from
+FINAL_DIR = '/Volumes/Photo backup/final'
+THUMBNAILS_DIR = '/Volumes/Photo backup/final/thumbnails'
+MISC_DIR = '/Volumes/Photo backup/misc_from_internet'
+DOCUMENTS_DIR = '/Volumes/Photo backup/documents'
+PHOTOS_DIR = '/Volumes/Photo backup/photos'
+
+# Only write the move plan, apply it later with apply_plan.py
+DRY_RUN = False
+
+
+def parent_name(path):
+    return os.path.basename(os.path.dirname(path))
+
+
+def numbered_folder_rule(path):
+    """cleanup_misc_internet.py: files in numbered folders go to the misc folder."""
+    if NUMBERED_FOLDER_PATTERN.match(parent_name(path)):
+        return os.path.join(MISC_DIR, os.path.basename(path))
+    return None
+
+
+def thumbnail_folder_rule(path):
+    """thumbnail_cleaner.py: files in thumbnail folders of the final folder go to the thumbnails folder."""
+    if (is_under(path, FINAL_DIR) and not is_under(path, THUMBNAILS_DIR)
+            and THUMBNAIL_FOLDER_PATTERN.match(parent_name(path))):
+        return os.path.join(THUMBNAILS_DIR, os.path.basename(path))
+    return None
+
+
+def date_folder_rule(path):
+    """move_dates.py: files in date-named folders outside the final folder go to /year/month."""
+    match = DATE_FOLDER_PATTERN.match(parent_name(path))
+    if match and not is_under(path, FINAL_DIR):
+        year, month = match.groups()
+        return os.path.join(FINAL_DIR, year, get_month_name(month), os.path.basename(path))
+    return None
+
+
+def document_rule(path):
+    """document_mover.py: documents in the misc folder go to the documents folder, keeping their folders."""
+    if is_under(path, MISC_DIR) and is_document(os.path.basename(path)):
+        return os.path.join(DOCUMENTS_DIR, os.path.relpath(path, MISC_DIR))
+    return None
+
+
+def unwanted_file_rule(path):
+    """file_folder_cleanup.py: clutter in the misc folder is deleted."""
+    if is_under(path, MISC_DIR) and is_unwanted_file(os.path.basename(path)):
+        return DELETE
+    return None
+
+
+def redundant_folder_rule(path):
+    """flatten_redundant_folders.py: folders nested in a folder of the same name are merged into it."""
+    if not is_under(path, DOCUMENTS_DIR) or path == DOCUMENTS_DIR:
+        return None
+    parts = [os.path.basename(DOCUMENTS_DIR)] + os.path.relpath(path, DOCUMENTS_DIR).split(os.sep)
+    flattened = parts[:1]
+    for part in parts[1:-1]:
+        if part != flattened[-1]:
+            flattened.append(part)
+    flattened.append(parts[-1])
+    if len(flattened) == len(parts):
+        return None
+    return os.path.join(DOCUMENTS_DIR, *flattened[1:])
+
+
+def year_folder_rule(path):
+    """reorganize_years.py: top-level photo folders named like 'December 2012' go to /year/event."""
+    if not is_under(path, PHOTOS_DIR) or path == PHOTOS_DIR:
+        return None
+    parts = os.path.relpath(path, PHOTOS_DIR).split(os.sep)
+    if len(parts) < 2:
+        return None
+    match = EVENT_YEAR_PATTERN.match(parts[0])
+    if not match or int(match.group(2)) not in VALID_YEAR_RANGE:
+        return None
+    event_name, year = match.groups()
+    return os.path.join(PHOTOS_DIR, year, format_folder_name(event_name), *parts)
+
+
+# Same order the scripts used to be run in, each rule sees where the earlier ones moved a file
+RULES = [
+    ('numbered folders', numbered_folder_rule),
+    ('thumbnail folders', thumbnail_folder_rule),
+    ('date folders', date_folder_rule),
+    ('documents', document_rule),
+    ('unwanted files', unwanted_file_rule),
+    ('redundant folders', redundant_folder_rule),
+    ('year folders', year_folder_rule),
+]
+
+# Rules that only tidy up leftovers of downloads and thumbnail exports, run by `python -m photo_tools clean`
+CLEANUP_RULES = [rule for rule in RULES if rule[0] in ('numbered folders', 'thumbnail folders', 'unwanted files')]
+
+
+def organize(root_dir, rules=RULES, name='organize'):
+    """Plan every rule over a single walk of root_dir, then apply the plan unless this is a dry run."""
+    plan_path = default_plan_path(name)
+    with get_metrics().phase('plan'), PlanWriter(plan_path, name) as plan:
+        counts = plan_rules(root_dir, rules, plan,
+                            keep_dirs=(FINAL_DIR, THUMBNAILS_DIR, MISC_DIR, DOCUMENTS_DIR, PHOTOS_DIR),
+                            cleanup_dirs=(MISC_DIR,))
+    for name, count in counts.items():
+        print(f"  {name}: {count}")
+
+    if DRY_RUN:
+        print(f"Dry run, nothing was moved. Apply the plan with: python apply_plan.py '{plan_path}'")
+        return
+    print_plan_failures(apply_plan(plan_path))
+
+
+def main():
+    print(f"Organizing '{ROOT_DIR}' in a single pass...")
+    organize(ROOT_DIR)
+    print("\nOperation complete!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Shared helpers used by the photo duplicate remover scripts."""
@@ -0,0 +1,3 @@
+from photo_tools.cli import main
+
+main()
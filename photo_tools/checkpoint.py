@@ -0,0 +1,121 @@
+import json
+import os
+import threading
+import time
+
+# Directory holding the hashing checkpoint of each script
+CHECKPOINT_DIR = os.path.expanduser('~/.photo_hash_checkpoints')
+
+# Seconds between checkpoint writes
+CHECKPOINT_SECONDS = 5
+
+_active_checkpoint = None
+
+
+class HashCheckpoint:
+    """Append-only log of the hashes computed by a run, so a run that dies can resume.
+
+    Every hash is buffered in memory and the buffer is appended to the log and fsynced
+    at most every CHECKPOINT_SECONDS, so a checkpoint costs one write per few seconds
+    whatever the hashing rate. With resume=True the existing log is loaded and
+    lookup() returns its hashes for files whose size and mtime haven't changed;
+    otherwise the log starts empty.
+    """
+
+    def __init__(self, checkpoint_path, resume=False):
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.buffer = []
+        self.last_write = time.monotonic()
+        self.resumed = 0
+        if resume:
+            self._load()
+            self._end_torn_line()
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        self.file = open(checkpoint_path, 'a' if resume else 'w', encoding='utf-8', errors='surrogateescape')
+
+    def _load(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8', errors='surrogateescape') as f:
+                for line in f:
+                    try:
+                        path, size, mtime_ns, kind, file_hash = json.loads(line)
+                    except ValueError:
+                        # Torn line of a run that died, the lines after it are still good
+                        continue
+                    self.hashes[(path, kind)] = (size, mtime_ns, file_hash)
+        except FileNotFoundError:
+            pass
+
+    def _end_torn_line(self):
+        """End a torn last line of the log, so the records appended next start on a line of their own."""
+        try:
+            with open(self.checkpoint_path, 'r+b') as f:
+                if f.seek(0, os.SEEK_END) == 0:
+                    return
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, path, st, kind='full_hash'):
+        """Return the checkpointed hash of the given kind, or None if missing or the file changed."""
+        with self.lock:
+            record = self.hashes.get((path, kind))
+        if record is None or record[:2] != (st.st_size, st.st_mtime_ns):
+            return None
+        with self.lock:
+            self.resumed += 1
+        return record[2]
+
+    def record(self, path, st, file_hash, kind='full_hash'):
+        """Add a hash to the checkpoint, writing the buffer out if the last write was a while ago."""
+        line = json.dumps([path, st.st_size, st.st_mtime_ns, kind, file_hash], ensure_ascii=False)
+        with self.lock:
+            self.buffer.append(line)
+            if time.monotonic() - self.last_write >= CHECKPOINT_SECONDS:
+                self._write()
+
+    def _write(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer.clear()
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.last_write = time.monotonic()
+
+    def close(self, complete=False):
+        """Write out the buffer; a complete run has nothing to resume, so its checkpoint is deleted."""
+        with self.lock:
+            self._write()
+            self.file.close()
+        if complete:
+            os.unlink(self.checkpoint_path)
+
+
+def start_checkpoint(name, resume=False):
+    """Start checkpointing every hash computed by the named script, and return the checkpoint."""
+    global _active_checkpoint
+    checkpoint = HashCheckpoint(os.path.join(CHECKPOINT_DIR, f"{name}.jsonl"), resume)
+    if resume:
+        print(f"Resuming from {len(checkpoint)} checkpointed hashes in '{checkpoint.checkpoint_path}'")
+    _active_checkpoint = checkpoint
+    return checkpoint
+
+
+def finish_checkpoint(complete=True):
+    """Stop checkpointing. Pass complete=False to keep the checkpoint for a later resume."""
+    global _active_checkpoint
+    if _active_checkpoint is not None:
+        _active_checkpoint.close(complete)
+        _active_checkpoint = None
+
+
+def get_checkpoint():
+    """Return the checkpoint of the running script, or None if it isn't checkpointing."""
+    return _active_checkpoint
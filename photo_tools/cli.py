@@ -0,0 +1,174 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+
+# The scripts live next to the photo_tools package and are imported from there
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Config file read when --config isn't given, if it exists
+DEFAULT_CONFIG_PATH = os.path.expanduser('~/.photo_tools.json')
+
+# Drives used when neither the command line nor the config file names one
+DEFAULT_DRIVE = '/Volumes/Photo backup'
+DEFAULT_NEW_DRIVE = '/Volumes/Madison Backup/Photo Project 2020'
+
+# Folders of a drive, relative to its root, for any folder not set on its own
+LAYOUT = {
+    'final_dir': 'final',
+    'transfer_dir': 'transfer',
+    'thumbnails_dir': 'final/thumbnails',
+    'misc_dir': 'misc_from_internet',
+    'documents_dir': 'documents',
+    'photos_dir': 'photos',
+    'originals_dir': 'photos/originals',
+    'copies_dir': 'photos/copies',
+}
+
+
+def _organize_constants(dirs):
+    return {'ROOT_DIR': dirs['drive'], 'FINAL_DIR': dirs['final_dir'], 'THUMBNAILS_DIR': dirs['thumbnails_dir'],
+            'MISC_DIR': dirs['misc_dir'], 'DOCUMENTS_DIR': dirs['documents_dir'], 'PHOTOS_DIR': dirs['photos_dir']}
+
+
+def _merge_drive_constants(dirs):
+    # Imported here, after the config's environment is set
+    from photo_tools.reference_index import default_index_path
+    return {'ROOT_DIR': dirs['drive'], 'NEW_DRIVE_DIR': dirs['new_drive'], 'FINAL_DIR': dirs['final_dir'],
+            'REFERENCE_INDEX_PATH': default_index_path(dirs['drive'])}
+
+
+def _run_main(module, args):
+    module.main()
+
+
+def _run_merge_drive(module, args):
+    module.main(['--resume'] if args.resume else [])
+
+
+def _run_clean(module, args):
+    print(f"Cleaning up '{module.ROOT_DIR}' in a single pass...")
+    module.organize(module.ROOT_DIR, module.CLEANUP_RULES, 'clean')
+
+
+# Subcommand -> (script module, help, constants to set from the folders, run(module, args))
+COMMANDS = {
+    'dedupe': (
+        'find_duplicates', "move transfer files that aren't in the final folder into it",
+        lambda dirs: {'ROOT_DIR': dirs['final_dir'], 'TRANSFER_DIR': dirs['transfer_dir'],
+                      'FINAL_DIR': dirs['final_dir']},
+        _run_main),
+    'merge-drive': (
+        'find_duplicates_multi_drive', "move files of the new drive that aren't on the drive into the final folder",
+        _merge_drive_constants,
+        _run_merge_drive),
+    'final-check': (
+        'final_check', "move originals that also exist elsewhere in the photos folder to copies",
+        lambda dirs: {'ROOT_DIR': dirs['photos_dir'], 'ORIGINALS_DIR': dirs['originals_dir'],
+                      'COPIES_DIR': dirs['copies_dir']},
+        _run_main),
+    'organize': (
+        'organize', "run every folder rule of organize.py over a single walk of the drive",
+        _organize_constants,
+        _run_main),
+    'clean': (
+        'organize', "only tidy numbered download folders, thumbnail folders and unwanted files",
+        _organize_constants,
+        _run_clean),
+}
+
+
+def load_config(path):
+    """Read a JSON config file, returning {} if path is None."""
+    if path is None:
+        return {}
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} must hold a JSON object")
+    return config
+
+
+def resolve_dirs(args, config):
+    """Return every folder the commands use: set on the command line, else in the config, else from the drive."""
+    def pick(key, default):
+        value = getattr(args, key)
+        if value is None:
+            value = config.get(key, default)
+        return os.path.abspath(os.path.expanduser(value))
+
+    dirs = {'drive': pick('drive', DEFAULT_DRIVE), 'new_drive': pick('new_drive', DEFAULT_NEW_DRIVE)}
+    for key, relative in LAYOUT.items():
+        dirs[key] = pick(key, os.path.join(dirs['drive'], relative))
+    return dirs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m photo_tools',
+        description="Run one or more of the photo scripts in a single process against any drive.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands, run in the order given and sharing the hash cache, hashing threads and metrics\n"
+               "of one process:\n"
+               + ''.join(f"  {command:<13} {help_text}\n" for command, (_, help_text, _, _) in COMMANDS.items())
+               + "\nThe config file is a JSON object with any of the folder options above (e.g. \"final_dir\"),\n"
+                 "\"dry_run\", \"plan_dir\", \"environment\" (PHOTO_* variables) and per-script constants\n"
+                 "keyed by script, e.g. {\"find_duplicates\": {\"NEAR_DUPLICATES\": true}}.")
+    parser.add_argument('commands', nargs='+', choices=list(COMMANDS), metavar='command',
+                        help=f"one or more of: {', '.join(COMMANDS)}")
+    parser.add_argument('--config', help=f"JSON config file (default: {DEFAULT_CONFIG_PATH} if it exists)")
+    parser.add_argument('--drive', help=f"drive the folders are laid out on (default: {DEFAULT_DRIVE})")
+    parser.add_argument('--new-drive', dest='new_drive', help="drive merge-drive copies new files from")
+    for key, relative in LAYOUT.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key, help=f"default: <drive>/{relative}")
+    parser.add_argument('--plan-dir', help="where plans are written, so parallel runs on other drives don't "
+                                           "replace each other's plans")
+    parser.add_argument('--dry-run', action='store_true', default=None, help="only write the plans")
+    parser.add_argument('--resume', action='store_true', help="merge-drive: reuse an interrupted run's checkpoint")
+    return parser, parser.parse_args(argv)
+
+
+def main(argv=None):
+    parser, args = parse_args(argv)
+    config_path = args.config
+    if config_path is None and os.path.exists(DEFAULT_CONFIG_PATH):
+        config_path = DEFAULT_CONFIG_PATH
+    try:
+        config = load_config(config_path)
+    except (OSError, ValueError) as e:
+        parser.error(f"can't read config {config_path}: {e}")
+
+    # Read by photo_tools when it is first imported, which happens below
+    for name, value in config.get('environment', {}).items():
+        os.environ[name] = str(value)
+    dirs = resolve_dirs(args, config)
+    dry_run = args.dry_run if args.dry_run is not None else bool(config.get('dry_run', False))
+
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    plan_dir = args.plan_dir or config.get('plan_dir')
+    if plan_dir:
+        from photo_tools import plan
+        plan.PLAN_DIR = os.path.abspath(os.path.expanduser(plan_dir))
+
+    # One pool of hashing threads for every command, started once the environment is set
+    from photo_tools.parallel import shared_hash_pool
+    with shared_hash_pool():
+        for command in args.commands:
+            module_name, _, constants_of, run = COMMANDS[command]
+            # Imported only when its command runs, so the others' dependencies are never loaded
+            module = importlib.import_module(module_name)
+            constants = constants_of(dirs)
+            if hasattr(module, 'DRY_RUN'):
+                constants['DRY_RUN'] = dry_run
+            overrides = config.get(module_name, {})
+            for name in overrides:
+                if not name.isupper() or not hasattr(module, name):
+                    parser.error(f"{module_name}.py has no setting {name}")
+            constants.update(overrides)
+            for name, value in constants.items():
+                setattr(module, name, value)
+
+            print(f"\n=== {command} ===")
+            run(module, args)
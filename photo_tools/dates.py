@@ -0,0 +1,253 @@
+import os
+import struct
+from datetime import datetime
+from photo_tools.hash_cache import get_hash_cache
+from photo_tools.metrics import get_metrics, log_error
+from photo_tools.parallel import imap_ordered, path_device
+from photo_tools.video import VIDEO_EXTENSIONS, iter_boxes, iter_file_boxes
+
+# File types whose capture date can be read from their headers, by container
+JPEG_EXTENSIONS = {'.jpg', '.jpeg'}
+TIFF_EXTENSIONS = {'.tif', '.tiff', '.dng', '.cr2', '.nef', '.arw'}
+HEIF_EXTENSIONS = {'.heic', '.heif'}
+DATE_EXTENSIONS = JPEG_EXTENSIONS | TIFF_EXTENSIONS | HEIF_EXTENSIONS | VIDEO_EXTENSIONS
+
+# EXIF tags holding a date, in order of preference: DateTimeOriginal, DateTimeDigitized, DateTime
+EXIF_IFD_TAG = 0x8769
+EXIF_DATE_TAGS = (0x9003, 0x9004)
+IFD0_DATE_TAG = 0x0132
+
+# Header boxes bigger than this are not read
+MAX_META_SIZE = 1024 * 1024
+
+# Seconds between the QuickTime epoch (1904) and the Unix epoch
+QUICKTIME_EPOCH_OFFSET = 2082844800
+
+# Format of the capture dates stored in the hash cache
+CACHE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def is_datable(path):
+    """Check if a path is a file type capture_date can read."""
+    return os.path.splitext(path)[1].lower() in DATE_EXTENSIONS
+
+
+class _CountingReader:
+    """Read ranges of a file, counting the bytes read."""
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_read = 0
+
+    def read(self, offset, size):
+        self.f.seek(offset)
+        data = self.f.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def _read_ifd(reader, tiff_base, offset, endian):
+    """Return {tag: (type, count, value field)} of the TIFF IFD at offset."""
+    count_bytes = reader.read(tiff_base + offset, 2)
+    if len(count_bytes) < 2:
+        return {}
+    count = struct.unpack(endian + 'H', count_bytes)[0]
+    data = reader.read(tiff_base + offset + 2, count * 12)
+    entries = {}
+    for start in range(0, len(data) - 11, 12):
+        tag, value_type, value_count = struct.unpack_from(endian + 'HHI', data, start)
+        entries[tag] = (value_type, value_count, data[start + 8:start + 12])
+    return entries
+
+
+def _parse_exif_date(text):
+    try:
+        return datetime.strptime(text.split(b'\0')[0].decode('ascii').strip(), '%Y:%m:%d %H:%M:%S')
+    except (UnicodeDecodeError, ValueError):
+        # Missing or zeroed dates such as '0000:00:00 00:00:00'
+        return None
+
+
+def tiff_date(reader, tiff_base):
+    """Read the capture date from the EXIF of a TIFF structure starting at tiff_base."""
+    header = reader.read(tiff_base, 8)
+    if header[:2] == b'II':
+        endian = '<'
+    elif header[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd0 = _read_ifd(reader, tiff_base, struct.unpack_from(endian + 'I', header, 4)[0], endian)
+
+    def date_of(entries, tag):
+        if tag not in entries:
+            return None
+        value_type, count, field = entries[tag]
+        if value_type != 2:
+            return None
+        if count <= 4:
+            return _parse_exif_date(field[:count])
+        return _parse_exif_date(reader.read(tiff_base + struct.unpack(endian + 'I', field)[0], count))
+
+    if EXIF_IFD_TAG in ifd0:
+        exif_offset = struct.unpack(endian + 'I', ifd0[EXIF_IFD_TAG][2])[0]
+        exif = _read_ifd(reader, tiff_base, exif_offset, endian)
+        for tag in EXIF_DATE_TAGS:
+            taken = date_of(exif, tag)
+            if taken is not None:
+                return taken
+    return date_of(ifd0, IFD0_DATE_TAG)
+
+
+def jpeg_date(reader):
+    """Find the Exif APP1 segment by walking the JPEG markers, and read its date."""
+    if reader.read(0, 2) != b'\xff\xd8':
+        return None
+    offset = 2
+    while True:
+        marker = reader.read(offset, 4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            # Start of the image data, no Exif before it
+            return None
+        length = struct.unpack_from('>H', marker, 2)[0]
+        if marker[1] == 0xE1 and reader.read(offset + 4, 6) == b'Exif\0\0':
+            return tiff_date(reader, offset + 10)
+        offset += 2 + length
+
+
+def heif_date(reader, f, file_size):
+    """Find the Exif item of a HEIF file through its meta box, and read its date."""
+    for box_type, body, box_end in iter_file_boxes(f, 0, file_size):
+        if box_type == b'meta':
+            if box_end - body > MAX_META_SIZE:
+                return None
+            meta = reader.read(body, box_end - body)
+            break
+    else:
+        return None
+
+    # meta is a full box: skip its version and flags
+    exif_item = None
+    locations = {}
+    for box_type, body, box_end in iter_boxes(meta, 4, len(meta)):
+        if box_type == b'iinf':
+            version = meta[body]
+            start = body + (6 if version == 0 else 8)
+            for entry_type, entry_body, _ in iter_boxes(meta, start, box_end):
+                if entry_type != b'infe' or meta[entry_body] < 2:
+                    continue
+                if meta[entry_body] == 2:
+                    item_id, _, item_type = struct.unpack_from('>HH4s', meta, entry_body + 4)
+                else:
+                    item_id, _, item_type = struct.unpack_from('>IH4s', meta, entry_body + 4)
+                if item_type == b'Exif':
+                    exif_item = item_id
+        elif box_type == b'iloc':
+            locations = _parse_iloc(meta, body)
+    if exif_item is None or exif_item not in locations:
+        return None
+    item_offset = locations[exif_item]
+    # The Exif item starts with the offset of the TIFF header past its 'Exif\0\0' prefix
+    prefix = struct.unpack('>I', reader.read(item_offset, 4))[0]
+    return tiff_date(reader, item_offset + 4 + prefix)
+
+
+def _parse_iloc(meta, body):
+    """Return {item id: file offset of its first extent} from an iloc box, for items stored in the file."""
+    version = meta[body]
+    offset_size = meta[body + 4] >> 4
+    length_size = meta[body + 4] & 0xF
+    base_offset_size = meta[body + 5] >> 4
+    index_size = meta[body + 5] & 0xF if version in (1, 2) else 0
+    position = body + 6
+
+    def read_uint(size):
+        nonlocal position
+        value = int.from_bytes(meta[position:position + size], 'big')
+        position += size
+        return value
+
+    locations = {}
+    item_count = read_uint(2 if version < 2 else 4)
+    for _ in range(item_count):
+        item_id = read_uint(2 if version < 2 else 4)
+        construction_method = read_uint(2) & 0xF if version in (1, 2) else 0
+        read_uint(2)
+        base_offset = read_uint(base_offset_size)
+        extents = []
+        for _ in range(read_uint(2)):
+            read_uint(index_size)
+            extents.append(read_uint(offset_size))
+            read_uint(length_size)
+        if construction_method == 0 and extents:
+            locations[item_id] = base_offset + extents[0]
+    return locations
+
+
+def quicktime_date(reader, f, file_size):
+    """Read the creation time of the mvhd box inside moov, reading only box headers on the way."""
+    for box_type, body, box_end in iter_file_boxes(f, 0, file_size):
+        if box_type != b'moov':
+            continue
+        for child_type, child_body, _ in iter_file_boxes(f, body, box_end):
+            if child_type != b'mvhd':
+                continue
+            header = reader.read(child_body, 12)
+            if header[0] == 1:
+                seconds = struct.unpack_from('>Q', header, 4)[0]
+            else:
+                seconds = struct.unpack_from('>I', header, 4)[0]
+            if not seconds:
+                return None
+            # Stored in UTC, converted to local time like the EXIF dates of photos
+            return datetime.fromtimestamp(seconds - QUICKTIME_EPOCH_OFFSET)
+        return None
+    return None
+
+
+def capture_date(file_path):
+    """Read when a photo or video was taken from its headers, or None if it doesn't say.
+
+    Only the few KB of headers on the way to the date are read: the JPEG markers and
+    EXIF IFDs, the HEIF meta box and its Exif item, or the moov box headers and mvhd
+    of a video. Images are never decoded.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    with open(file_path, 'rb') as f:
+        reader = _CountingReader(f)
+        if extension in JPEG_EXTENSIONS:
+            taken = jpeg_date(reader)
+        elif extension in TIFF_EXTENSIONS:
+            taken = tiff_date(reader, 0)
+        elif extension in HEIF_EXTENSIONS:
+            taken = heif_date(reader, f, os.fstat(f.fileno()).st_size)
+        elif extension in VIDEO_EXTENSIONS:
+            taken = quicktime_date(reader, f, os.fstat(f.fileno()).st_size)
+        else:
+            taken = None
+    get_metrics().add('date_bytes_read', reader.bytes_read)
+    return taken
+
+
+def capture_date_file(file_path):
+    """Read the capture date of a file, reusing the persistent hash cache. Returns None on errors."""
+    try:
+        cache = get_hash_cache()
+        if cache is None:
+            return capture_date(file_path)
+        st = os.stat(file_path)
+        cached = cache.lookup(file_path, st, 'capture_date')
+        if cached is not None:
+            return datetime.strptime(cached, CACHE_DATE_FORMAT) if cached else None
+        taken = capture_date(file_path)
+        # An empty string records that the file has no date
+        cache.store(file_path, st, taken.strftime(CACHE_DATE_FORMAT) if taken else '', 'capture_date')
+        return taken
+    except Exception as e:
+        log_error(f"Error reading the date of {file_path}: {e}")
+        return None
+
+
+def read_capture_dates(paths):
+    """Read the capture dates of a stream of paths on the hash pool, yielding (path, date or None) in order."""
+    return imap_ordered(capture_date_file, paths, device=path_device())
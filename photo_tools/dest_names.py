@@ -0,0 +1,115 @@
+import os
+import re
+import unicodedata
+from photo_tools.hashing import hash_file
+from photo_tools.metrics import get_metrics, log, log_error
+from photo_tools.reference_index import digest_to_int
+
+# Suffix added to a name already taken in its destination folder, e.g. 'IMG_0001 (2).jpg'
+SUFFIX_PATTERN = re.compile(r'^(.*) \((\d+)\)$')
+
+
+def _name_key(name):
+    """Key a file name the way macOS volumes compare them: case-insensitive, normalization-insensitive."""
+    return unicodedata.normalize('NFC', name).casefold()
+
+
+def _family(name):
+    """Return the key of a name with any ' (n)' suffix removed, and the suffix number or 0."""
+    stem, ext = os.path.splitext(name)
+    match = SUFFIX_PATTERN.match(stem)
+    if match:
+        return _name_key(match.group(1) + ext), int(match.group(2))
+    return _name_key(name), 0
+
+
+class _FolderNames:
+    """Names taken in one destination folder: those on disk plus those planned by this run."""
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.taken = set()
+        # Family key -> (path, source) of the files holding, or planned to hold, a name of that family
+        self.family = {}
+        # Family key -> next suffix number to try
+        self.next_suffix = {}
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    # A folder takes its name but has no content to compare
+                    self._add(entry.name, None if entry.is_dir() else entry.path)
+        except FileNotFoundError:
+            pass
+        get_metrics().add('dest_scandir_calls')
+
+    def _add(self, name, src):
+        self.taken.add(_name_key(name))
+        key, suffix = _family(name)
+        if src is not None:
+            self.family.setdefault(key, []).append((os.path.join(self.dir_path, name), src))
+        if suffix >= self.next_suffix.get(key, 1):
+            self.next_suffix[key] = suffix + 1
+
+    def claim(self, name, src):
+        """Take name, or the next free 'name (n)' if it is taken, returning the name given."""
+        if _name_key(name) in self.taken:
+            stem, ext = os.path.splitext(name)
+            key = _family(name)[0]
+            suffix = self.next_suffix.get(key, 1)
+            while _name_key(f"{stem} ({suffix}){ext}") in self.taken:
+                suffix += 1
+            self.next_suffix[key] = suffix + 1
+            name = f"{stem} ({suffix}){ext}"
+        self._add(name, src)
+        return name
+
+
+class DestinationNames:
+    """Collision-free destination paths for files flattened into shared folders.
+
+    Each destination folder is listed with a single scandir the first time a file is
+    sent there, and names are then claimed in memory, so a file costs no stat calls
+    however many others share its name. A name that is taken gets the next free
+    ' (n)' suffix. Only on a collision are contents compared: if the file has the same
+    hash as a file already holding (or planned for) a name of the same family, the
+    move is skipped as a duplicate.
+    """
+
+    def __init__(self):
+        self.folders = {}
+
+    def destination(self, src, dest_dir, file_hash=None):
+        """Return the path src should move to in dest_dir, or None if an identical file is already there.
+
+        file_hash is the full digest of src if the caller has it; otherwise src is
+        hashed (through the hash cache) only when its name collides.
+        """
+        dest_dir = os.path.normpath(dest_dir)
+        folder = self.folders.get(dest_dir)
+        if folder is None:
+            folder = self.folders[dest_dir] = _FolderNames(dest_dir)
+
+        name = os.path.basename(src)
+        if _name_key(name) in folder.taken:
+            duplicate_of = self._same_content(src, folder.family.get(_family(name)[0], ()), file_hash)
+            if duplicate_of is not None:
+                log(f"Same content as {duplicate_of}, leaving {src} in place")
+                get_metrics().add('dest_duplicates_skipped')
+                return None
+            get_metrics().add('dest_renamed')
+        return os.path.join(dest_dir, folder.claim(name, src))
+
+    def _same_content(self, src, candidates, file_hash):
+        """Return the first candidate with the same content as src, or None."""
+        try:
+            if digest_to_int(file_hash or '') is None:
+                file_hash = hash_file(src)
+            size = os.path.getsize(src)
+            for dest, candidate_src in candidates:
+                # A planned move hasn't happened yet, so its content is still at its source
+                candidate = dest if os.path.exists(dest) else candidate_src
+                if os.path.getsize(candidate) == size and hash_file(candidate) == file_hash:
+                    return candidate
+        except OSError as e:
+            log_error(f"Error comparing {src} with its destination: {e}")
+        return None
@@ -0,0 +1,69 @@
+import gzip
+import heapq
+import itertools
+import json
+import os
+import tempfile
+import time
+from photo_tools.sorted_runs import iter_sorted, sort_into_runs
+
+TABLE_VERSION = 1
+
+
+def write_digest_table(table_path, records, host, roots, work_dir=None):
+    """Write (digest, size, path, mtime_ns) records of one host as a digest table, returning the record count.
+
+    A table is a gzipped JSONL file: a header line with the host, its scanned roots
+    and when it was made, then one [digest, size, path, mtime_ns] line per file,
+    sorted by digest. Records are sorted through run files in work_dir (the system
+    temp directory if None), so a host's table never has to fit in memory. Records
+    without a digest are dropped.
+    """
+    tmp_path = table_path + '.tmp'
+    count = 0
+    with tempfile.TemporaryDirectory(prefix='digest_table-', dir=work_dir) as run_dir:
+        run_paths = sort_into_runs(records, run_dir)
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', errors='surrogateescape', compresslevel=3) as f:
+            header = {'version': TABLE_VERSION, 'host': host, 'roots': roots, 'created': time.time()}
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            for record in iter_sorted(run_paths):
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+    os.replace(tmp_path, table_path)
+    return count
+
+
+def read_table_header(table_path):
+    """Return the header of a digest table."""
+    with gzip.open(table_path, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+        header = json.loads(f.readline())
+    if header.get('version') != TABLE_VERSION:
+        raise ValueError(f"{table_path} is not a version {TABLE_VERSION} digest table")
+    return header
+
+
+def iter_table(table_path):
+    """Stream the (digest, size, path, mtime_ns) records of a digest table, in digest order."""
+    read_table_header(table_path)
+    with gzip.open(table_path, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+        f.readline()
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def _host_records(table_path, host):
+    for digest, size, path, mtime_ns in iter_table(table_path):
+        yield digest, size, host, path, mtime_ns
+
+
+def merge_digest_tables(table_paths):
+    """Stream any number of digest tables as one, yielding (digest, size, copies) for every file content.
+
+    copies is a list of (host, path, mtime_ns) for every file with that digest and size,
+    across all tables. Tables are read in a single sorted pass, so memory holds one
+    group at a time however big the tables are.
+    """
+    merged = heapq.merge(*(_host_records(table_path, read_table_header(table_path)['host'])
+                           for table_path in table_paths))
+    for (digest, size), group in itertools.groupby(merged, key=lambda record: record[:2]):
+        yield digest, size, [(host, path, mtime_ns) for _, _, host, path, mtime_ns in group]
@@ -0,0 +1,230 @@
+import bisect
+import os
+from array import array
+
+# Kinds of group key, see parse_key
+FULL_HASH = 0
+UNIQUE_SIZE = 1
+UNIQUE_SAMPLE = 2
+NEAR_DUPLICATE = 3
+VIDEO_FINGERPRINT = 4
+
+# Kinds whose key doesn't include the file size
+SIZELESS_KINDS = {FULL_HASH, NEAR_DUPLICATE, VIDEO_FINGERPRINT}
+
+
+def parse_key(file_hash):
+    """Split a files_by_hash key into (kind, digest, size).
+
+    Keys are xxh64 hexdigests, 'size:<size>' for files proven unique by size,
+    'sample:<size>:<hexdigest>' for files proven unique by their sample hash,
+    'near:<hexdigest>' for images grouped by perceptual hash, or 'video:<hexdigest>'
+    for videos grouped by fingerprint.
+    """
+    if file_hash.startswith('size:'):
+        size = int(file_hash[5:])
+        return UNIQUE_SIZE, size, size
+    if file_hash.startswith('sample:'):
+        _, size, digest = file_hash.split(':')
+        return UNIQUE_SAMPLE, int(digest, 16), int(size)
+    if file_hash.startswith('near:'):
+        return NEAR_DUPLICATE, int(file_hash[5:], 16), None
+    if file_hash.startswith('video:'):
+        return VIDEO_FINGERPRINT, int(file_hash[6:], 16), None
+    return FULL_HASH, int(file_hash, 16), None
+
+
+def format_key(kind, digest, size):
+    """Rebuild the files_by_hash key string from its parts."""
+    if kind == UNIQUE_SIZE:
+        return f"size:{size}"
+    if kind == UNIQUE_SAMPLE:
+        return f"sample:{size}:{digest:016x}"
+    if kind == NEAR_DUPLICATE:
+        return f"near:{digest:016x}"
+    if kind == VIDEO_FINGERPRINT:
+        return f"video:{digest:016x}"
+    return f"{digest:016x}"
+
+
+class _SortedKeys:
+    """Sequence view of the sort keys of rows in sorted order, for bisect on Python < 3.10."""
+
+    def __init__(self, order, row_key):
+        self.order = order
+        self.row_key = row_key
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        return self.row_key(self.order[position])
+
+
+class FileGroups:
+    """Compact, read-mostly replacement for a files_by_hash dict of lists.
+
+    Each file is a row in typed arrays: the uint64 digest, its size, the id of its
+    interned directory, and its basename in a shared UTF-8 buffer. Rows are sorted by
+    key once, on the first read, and groups are then contiguous runs of that order.
+    Supports the read side of the dict API: items(), keys(), values(), len(), `in`,
+    [] and get(). Keys are the same strings find_files_by_hash used to produce.
+    """
+
+    def __init__(self):
+        self.dir_ids = {}
+        self.dirs = []
+        self.kinds = array('B')
+        self.digests = array('Q')
+        self.sizes = array('Q')
+        self.dir_column = array('L')
+        self.name_offsets = array('Q', [0])
+        self.names = bytearray()
+        self.order = None
+        self.group_starts = None
+
+    def add(self, file_hash, path, size=0):
+        """Add a file under a files_by_hash key."""
+        kind, digest, key_size = parse_key(file_hash)
+        self.append(kind, digest, key_size if key_size is not None else size, path)
+
+    def append(self, kind, digest, size, path):
+        """Add a file as a row of the given key parts, returning its row number."""
+        dirpath, name = os.path.split(path)
+        dir_id = self.dir_ids.get(dirpath)
+        if dir_id is None:
+            dir_id = self.dir_ids[dirpath] = len(self.dirs)
+            self.dirs.append(dirpath)
+
+        self.kinds.append(kind)
+        self.digests.append(digest)
+        self.sizes.append(size)
+        self.dir_column.append(dir_id)
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.name_offsets.append(len(self.names))
+        self.order = None
+        return len(self.kinds) - 1
+
+    def set_key(self, row, kind, digest):
+        """Change the key of a row, e.g. once its file has been hashed."""
+        self.kinds[row] = kind
+        self.digests[row] = digest
+        self.order = None
+
+    def row_count(self):
+        """Return the number of files, as opposed to len() which counts groups."""
+        return len(self.kinds)
+
+    def subset(self, rows):
+        """Return new FileGroups holding only the given rows, in the order given.
+
+        The directory table is shared with this instance rather than copied.
+        """
+        subset = FileGroups()
+        subset.dir_ids = self.dir_ids
+        subset.dirs = self.dirs
+        for row in rows:
+            subset.kinds.append(self.kinds[row])
+            subset.digests.append(self.digests[row])
+            subset.sizes.append(self.sizes[row])
+            subset.dir_column.append(self.dir_column[row])
+            subset.names += self.names[self.name_offsets[row]:self.name_offsets[row + 1]]
+            subset.name_offsets.append(len(subset.names))
+        return subset
+
+    def path(self, row):
+        """Return the full path stored in a row."""
+        name = self.names[self.name_offsets[row]:self.name_offsets[row + 1]]
+        return os.path.join(self.dirs[self.dir_column[row]], name.decode('utf-8', 'surrogateescape'))
+
+    def rows(self):
+        """Yield (key, path, size) for every file, in the order they were added."""
+        for row in range(len(self.kinds)):
+            size = self.sizes[row]
+            yield format_key(self.kinds[row], self.digests[row], size), self.path(row), size
+
+    def _row_key(self, row):
+        return self.kinds[row], self.digests[row], self.sizes[row]
+
+    def _sort(self):
+        if self.order is not None:
+            return
+        # Sort one packed int per row rather than a tuple per row. The row number in the
+        # low bits keeps paths within a group in the order they were added in.
+        row_bits = max(len(self.kinds).bit_length(), 1)
+        size_bits = max(max(self.sizes, default=0).bit_length(), 1)
+        row_mask = (1 << row_bits) - 1
+        packed = [(((kind << 64 | digest) << size_bits | size) << row_bits) | row
+                  for row, (kind, digest, size) in enumerate(zip(self.kinds, self.digests, self.sizes))]
+        packed.sort()
+        self.order = array('Q', (key & row_mask for key in packed))
+        del packed
+        self.group_starts = array('Q')
+        previous = None
+        for position, row in enumerate(self.order):
+            key = self._row_key(row)
+            if self.kinds[row] in SIZELESS_KINDS:
+                key = key[:2]
+            if key != previous:
+                self.group_starts.append(position)
+                previous = key
+        self.group_starts.append(len(self.order))
+
+    def _group_bounds(self, file_hash):
+        """Return the (start, end) positions of a key's group in the sorted order, or None."""
+        try:
+            kind, digest, size = parse_key(file_hash)
+        except (ValueError, AttributeError):
+            return None
+        self._sort()
+        if kind in SIZELESS_KINDS:
+            target = (kind, digest)
+            row_key = lambda row: (self.kinds[row], self.digests[row])
+        else:
+            target = (kind, digest, size)
+            row_key = self._row_key
+        keys = _SortedKeys(self.order, row_key)
+        start = bisect.bisect_left(keys, target)
+        end = bisect.bisect_right(keys, target)
+        return (start, end) if start < end else None
+
+    def __contains__(self, file_hash):
+        return self._group_bounds(file_hash) is not None
+
+    def __getitem__(self, file_hash):
+        bounds = self._group_bounds(file_hash)
+        if bounds is None:
+            raise KeyError(file_hash)
+        return [self.path(row) for row in self.order[bounds[0]:bounds[1]]]
+
+    def get(self, file_hash, default=None):
+        try:
+            return self[file_hash]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        self._sort()
+        return len(self.group_starts) - 1
+
+    def __bool__(self):
+        return len(self.kinds) > 0
+
+    def items(self):
+        """Yield (key, paths) for every group, in key order."""
+        self._sort()
+        for start, end in zip(self.group_starts, self.group_starts[1:]):
+            rows = self.order[start:end]
+            first = rows[0]
+            yield (format_key(self.kinds[first], self.digests[first], self.sizes[first]),
+                   [self.path(row) for row in rows])
+
+    def keys(self):
+        for file_hash, _ in self.items():
+            yield file_hash
+
+    def values(self):
+        for _, paths in self.items():
+            yield paths
+
+    __iter__ = keys
@@ -0,0 +1,202 @@
+import atexit
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from photo_tools.metrics import get_metrics
+
+# Location of the on-disk hash index, set PHOTO_HASH_CACHE to '' to disable it
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.photo_hash_cache.sqlite3')
+
+# Number of writes buffered before committing to disk
+COMMIT_EVERY = 500
+
+# Pending writes are also committed once the last commit is this many seconds old
+COMMIT_SECONDS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    full_hash TEXT,
+    sample_hash TEXT,
+    perceptual_hash TEXT,
+    video_fingerprint TEXT,
+    capture_date TEXT,
+    last_seen REAL NOT NULL
+)
+"""
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+class HashCache:
+    """Persistent index of file hashes keyed by path, device, inode, size and mtime."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(hashes)")}
+        for column in ('perceptual_hash', 'video_fingerprint', 'capture_date'):
+            if column not in columns:
+                # Caches created before the column's feature
+                self.conn.execute(f"ALTER TABLE hashes ADD COLUMN {column} TEXT")
+        # Hashes stored since the last commit, by (path, kind), so no write transaction stays open between commits
+        self.pending = {}
+        self.last_commit = time.monotonic()
+        # Paths of cache hits since the last commit, their last_seen is refreshed with it
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def lookup(self, path, st, kind='full_hash'):
+        """Return the cached hash of the given kind, or None if missing, stale or the cache can't be read."""
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            pending = self.pending.get((path, kind))
+            if pending is not None and pending[0] == key:
+                self.hits += 1
+                return pending[1]
+            try:
+                row = self.conn.execute(
+                    f"SELECT device, inode, size, mtime_ns, {kind} FROM hashes WHERE path = ?",
+                    (path,)).fetchone()
+            except sqlite3.Error as e:
+                self._failed(e)
+                row = None
+            # A stale row, for a file changed since it was hashed, is replaced when its new hash is stored
+            if row is None or row[:4] != key or row[4] is None:
+                self.misses += 1
+                return None
+            self.seen.add(path)
+            self.hits += 1
+            return row[4]
+
+    def store(self, path, st, file_hash, kind='full_hash'):
+        """Record a hash of the given kind for a file with the given stat result, written with the next commit."""
+        with self.lock:
+            self.pending[(path, kind)] = ((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns), file_hash)
+            if len(self.pending) >= COMMIT_EVERY or time.monotonic() - self.last_commit >= COMMIT_SECONDS:
+                self._commit()
+
+    def flush(self):
+        """Commit pending writes now, e.g. before a long-running process goes idle."""
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        # Writes happen only here, in one short transaction, so other processes are never locked out for long
+        now = time.time()
+        try:
+            for (path, kind), (key, file_hash) in self.pending.items():
+                row = self.conn.execute(
+                    "SELECT device, inode, size, mtime_ns FROM hashes WHERE path = ?", (path,)).fetchone()
+                if row is not None and tuple(row) == key:
+                    self.conn.execute(
+                        f"UPDATE hashes SET {kind} = ?, last_seen = ? WHERE path = ?", (file_hash, now, path))
+                else:
+                    self.conn.execute(
+                        f"INSERT OR REPLACE INTO hashes (path, device, inode, size, mtime_ns, {kind}, last_seen) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (path, *key, file_hash, now))
+            self.conn.executemany("UPDATE hashes SET last_seen = ? WHERE path = ?", ((now, path) for path in self.seen))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            with contextlib.suppress(sqlite3.Error):
+                self.conn.rollback()
+            self._failed(e)
+        self.pending.clear()
+        self.seen.clear()
+        self.last_commit = time.monotonic()
+
+    def _failed(self, error):
+        # A busy or broken cache only costs hashing time: lookups miss and the hashes are calculated anyway
+        get_metrics().add('cache_errors')
+        if not self.errors:
+            print(f"Error using hash cache {self.db_path}, hashing without it: {error}")
+        self.errors += 1
+
+    def count_under(self, root_dir):
+        """Return the number of cached paths below root_dir."""
+        prefix = os.path.join(root_dir, '')
+        with self.lock:
+            try:
+                return self.conn.execute(
+                    "SELECT COUNT(*) FROM hashes WHERE path >= ? AND path < ?",
+                    (prefix, prefix[:-1] + chr(ord(os.sep) + 1))).fetchone()[0]
+            except sqlite3.Error as e:
+                self._failed(e)
+                return 0
+
+    def prune_missing(self):
+        """Delete rows for paths that no longer exist or changed on disk. Returns the number removed."""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, device, inode, size, mtime_ns FROM hashes").fetchall()
+        stale = []
+        for path, *key in rows:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stale.append((path,))
+                continue
+            except OSError:
+                # Unmounted drives are kept, they may come back
+                continue
+            if tuple(key) != (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns):
+                stale.append((path,))
+        with self.lock:
+            self.conn.executemany("DELETE FROM hashes WHERE path = ?", stale)
+            self._commit()
+        return len(stale)
+
+    def evict_unseen(self, max_age_days):
+        """Delete rows that haven't been hashed or refreshed in max_age_days. Returns the number removed."""
+        cutoff = time.time() - max_age_days * 86400
+        with self.lock:
+            self._commit()
+            cursor = self.conn.execute("DELETE FROM hashes WHERE last_seen < ?", (cutoff,))
+            self.conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        """Commit pending writes and close the database."""
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+
+def get_hash_cache():
+    """Return the shared hash cache, opening it on first use, or None if disabled."""
+    global _default_cache
+    if _default_cache is not None:
+        return _default_cache
+    # Hashing threads may all ask for the cache at once, only one of them may open it
+    with _default_cache_lock:
+        if _default_cache is None:
+            db_path = os.environ.get('PHOTO_HASH_CACHE', DEFAULT_CACHE_PATH)
+            if not db_path:
+                return None
+            try:
+                _default_cache = HashCache(db_path)
+            except sqlite3.Error as e:
+                print(f"Error opening hash cache {db_path}: {e}")
+                os.environ['PHOTO_HASH_CACHE'] = ''
+                return None
+            atexit.register(_default_cache.close)
+    return _default_cache
+
+
+def flush_hash_cache():
+    """Commit the pending writes of the shared hash cache, if it was opened."""
+    if _default_cache is not None:
+        _default_cache.flush()
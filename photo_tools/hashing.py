@@ -0,0 +1,466 @@
+import mmap
+import os
+import queue
+import threading
+import time
+import xxhash
+from array import array
+from collections import defaultdict, namedtuple
+from functools import partial
+from tqdm import tqdm
+from photo_tools.checkpoint import get_checkpoint
+from photo_tools.file_groups import UNIQUE_SAMPLE, UNIQUE_SIZE, FileGroups, parse_key
+from photo_tools.hash_cache import get_hash_cache
+from photo_tools.io_scheduler import ADAPTIVE_READS, get_read_sizer, locality_key
+from photo_tools.metrics import get_metrics, log_error
+from photo_tools.parallel import hash_pool
+from photo_tools.rules import is_under
+
+# Bytes read from the start and the end of a file for the sample hash
+SAMPLE_SIZE = 64 * 1024
+
+# Files up to this size are read in a single call
+SMALL_FILE_SIZE = 1024 * 1024
+
+# Files above this size are hashed through mmap instead of a read buffer
+MMAP_FILE_SIZE = 64 * 1024 * 1024
+
+# Size of the reusable per-thread read buffer for medium files
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Slice of a mapped file handed to xxhash at a time
+MMAP_SLICE_SIZE = 64 * 1024 * 1024
+
+# Progress of a file through group_files_by_content
+SAMPLING = 1
+HASHING = 2
+HASHED = 3
+
+# row_of_size value of a size more than one file has
+COLLIDED = -1
+
+# The parts of a stat result the hash cache and checkpoint key on
+_RowStat = namedtuple('_RowStat', 'st_dev st_ino st_size st_mtime_ns')
+
+_thread_buffers = threading.local()
+
+
+def new_stage_stats():
+    """Return a fresh counter of bytes skipped and read by each hashing stage."""
+    return {
+        'files': 0,
+        'total_bytes': 0,
+        'size_skipped_bytes': 0,
+        'sample_read_bytes': 0,
+        'sample_skipped_bytes': 0,
+        'full_read_bytes': 0,
+    }
+
+
+def format_bytes(num_bytes):
+    """Format a byte count as a human readable string."""
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if num_bytes < 1024 or unit == 'TB':
+            return f"{num_bytes:.1f} {unit}" if unit != 'B' else f"{num_bytes} B"
+        num_bytes /= 1024
+
+
+def print_stage_stats(stats):
+    """Print how many bytes each hashing stage avoided reading, and add the counts to the run's metrics."""
+    metrics = get_metrics()
+    for key, value in stats.items():
+        metrics.add(f"stage_{key}", value)
+    print(f"Hashing summary for {stats['files']} files ({format_bytes(stats['total_bytes'])}):")
+    print(f"  Size filter skipped:   {format_bytes(stats['size_skipped_bytes'])}")
+    print(f"  Sample filter skipped: {format_bytes(stats['sample_skipped_bytes'])} "
+          f"(read {format_bytes(stats['sample_read_bytes'])} of samples)")
+    print(f"  Fully hashed:          {format_bytes(stats['full_read_bytes'])}")
+    cache = get_hash_cache()
+    if cache is not None:
+        print(f"  Hash cache:            {cache.hits} hits, {cache.misses} misses")
+        metrics.add('cache_hits', cache.hits)
+        metrics.add('cache_misses', cache.misses)
+    checkpoint = get_checkpoint()
+    if checkpoint is not None and checkpoint.resumed:
+        print(f"  Resumed:               {checkpoint.resumed} hashes from the checkpoint")
+        metrics.add('checkpoint_resumed', checkpoint.resumed)
+
+
+def advise_sequential(fd, size):
+    """Tell the kernel the file will be read sequentially, where supported.
+
+    Returns the number of calls made, for the syscall count.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return 0
+    try:
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+    return 1
+
+
+def get_read_buffer(size=READ_BUFFER_SIZE):
+    """Return this thread's reusable read buffer, at least size bytes long."""
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = _thread_buffers.buffer = bytearray(max(size, READ_BUFFER_SIZE))
+    return buffer
+
+
+def hash_small(f, hash_xx, size):
+    """Hash a small file in one read into the reusable buffer. Returns the number of read calls."""
+    return hash_buffered(f, hash_xx, size + 1)
+
+
+def hash_buffered(f, hash_xx, read_size=READ_BUFFER_SIZE):
+    """Hash a medium file by reading into a reusable buffer, read_size bytes at a time.
+
+    Returns the number of read calls made, including the one that hit end of file.
+    """
+    view = memoryview(get_read_buffer(read_size))[:read_size]
+    reads = 1
+    while n := f.readinto(view):
+        hash_xx.update(view[:n])
+        reads += 1
+    return reads
+
+
+def hash_mapped(f, hash_xx, size):
+    """Hash a large file through a read-only memory map. Returns the number of calls made to map it."""
+    reads = 1
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            reads += 1
+        view = memoryview(mm)
+        try:
+            for offset in range(0, size, MMAP_SLICE_SIZE):
+                hash_xx.update(view[offset:offset + MMAP_SLICE_SIZE])
+        finally:
+            view.release()
+    # mmap, munmap and the madvise, the pages themselves are faulted in without read calls
+    return reads + 1
+
+
+def hash_range(fd, hash_xx, offset, length):
+    """Hash length bytes of a file starting at offset, or up to end of file. Returns the number of read calls."""
+    view = memoryview(get_read_buffer(length))[:length]
+    reads = 0
+    filled = 0
+    while filled < length:
+        n = os.preadv(fd, [view[filled:]], offset + filled)
+        reads += 1
+        if not n:
+            break
+        filled += n
+    hash_xx.update(view[:filled])
+    return reads
+
+
+def record_read(device, num_bytes, seconds, reads):
+    """Add a file read to the run's metrics, broken down by device."""
+    metrics = get_metrics()
+    metrics.add('bytes_read', num_bytes, device)
+    metrics.add('read_seconds', seconds, device)
+    # open, fstat and close around the reads
+    metrics.add('syscalls', reads + 3)
+
+
+def calculate_hash(file_path):
+    """Calculate xxHash of a file, picking the read strategy by file size."""
+    hash_xx = xxhash.xxh64()
+    start = time.perf_counter()
+    with open(file_path, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if size <= SMALL_FILE_SIZE:
+            reads = hash_small(f, hash_xx, size)
+        else:
+            reads = advise_sequential(f.fileno(), size)
+            if size < MMAP_FILE_SIZE and ADAPTIVE_READS:
+                sizer = get_read_sizer(st.st_dev, READ_BUFFER_SIZE)
+                read_start = time.perf_counter()
+                reads += hash_buffered(f, hash_xx, sizer.size)
+                sizer.record(size, time.perf_counter() - read_start)
+            elif size < MMAP_FILE_SIZE:
+                reads += hash_buffered(f, hash_xx)
+            else:
+                try:
+                    reads += hash_mapped(f, hash_xx, size)
+                except (OSError, ValueError):
+                    # Some network file systems can't be mapped, fall back to reading
+                    hash_xx.reset()
+                    f.seek(0)
+                    # the failed mmap and the seek
+                    reads += 2 + hash_buffered(f, hash_xx)
+    record_read(st.st_dev, size, time.perf_counter() - start, reads)
+    get_metrics().add('files_hashed')
+    return hash_xx.hexdigest()
+
+
+def calculate_sample_hash(file_path, size, sample_size=SAMPLE_SIZE):
+    """Calculate xxHash of the first and last sample_size bytes of a file."""
+    hash_xx = xxhash.xxh64()
+    start = time.perf_counter()
+    with open(file_path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        reads = hash_range(fd, hash_xx, 0, sample_size) + hash_range(fd, hash_xx, size - sample_size, sample_size)
+        device = os.fstat(fd).st_dev
+    record_read(device, 2 * sample_size, time.perf_counter() - start, reads)
+    get_metrics().add('files_sampled')
+    return hash_xx.hexdigest()
+
+
+def hash_file(file_path, st=None):
+    """Calculate xxHash of a file, reusing the persistent hash cache when the file is unchanged.
+
+    st may be passed in when the caller already has the stat result, e.g. from a DirEntry.
+    Hashes are also recorded in the running script's checkpoint, if it has one.
+    """
+    return _hash_with_reuse(file_path, st, 'full_hash', lambda: calculate_hash(file_path))
+
+
+def hash_file_or_none(file_path, st=None, problem_files=None):
+    """Like hash_file, but log errors and return None, adding (path, error) to problem_files if given."""
+    try:
+        return hash_file(file_path, st)
+    except Exception as e:
+        log_error(f"Error hashing {file_path}: {e}")
+        if problem_files is not None:
+            problem_files.append((file_path, str(e)))
+        return None
+
+
+def sample_file(file_path, size, sample_size=SAMPLE_SIZE, st=None):
+    """Calculate the sample hash of a file, reusing the persistent hash cache when the file is unchanged."""
+    if sample_size != SAMPLE_SIZE:
+        return calculate_sample_hash(file_path, size, sample_size)
+    return _hash_with_reuse(file_path, st, 'sample_hash',
+                            lambda: calculate_sample_hash(file_path, size, sample_size))
+
+
+def _hash_with_reuse(file_path, st, kind, calculate):
+    """Look a hash up in the checkpoint and the cache before calculating it, and record it in both."""
+    cache = get_hash_cache()
+    checkpoint = get_checkpoint()
+    if cache is None and checkpoint is None:
+        return calculate()
+
+    if st is None:
+        st = os.stat(file_path)
+    file_hash = checkpoint.lookup(file_path, st, kind) if checkpoint is not None else None
+    if file_hash is not None:
+        return file_hash
+    if cache is not None:
+        file_hash = cache.lookup(file_path, st, kind)
+    if file_hash is None:
+        file_hash = calculate()
+        if cache is not None:
+            cache.store(file_path, st, file_hash, kind)
+    if checkpoint is not None:
+        checkpoint.record(file_path, st, file_hash, kind)
+    return file_hash
+
+
+def estimate_file_count(root_dirs):
+    """Cheaply estimate how many files the roots hold from the hash cache, or None if unknown."""
+    cache = get_hash_cache()
+    if cache is None:
+        return None
+    return sum(cache.count_under(root_dir) for root_dir in root_dirs) or None
+
+
+def group_files_by_content(file_entries, calculate_hash, stats=None, sample_size=SAMPLE_SIZE,
+                           estimated_total=None, known_sizes=None):
+    """Group a stream of files by content, only fully hashing files whose size and sample collide.
+
+    file_entries yields os.DirEntry objects (or anything with .path and .stat()) and may
+    be a generator; the stat cached on each entry is reused for the size check and the
+    hash cache. Files are sampled and hashed as soon as a collision is found, while the
+    scan is still running. known_sizes holds the sizes of files outside this scan that
+    the result will be checked against, such as a reference index; files with those
+    sizes are always fully hashed. Returns a FileGroups mapping a key to the list of
+    paths with identical content. Files that collide with another
+    file are keyed by their full hash from calculate_hash; files proven unique by size
+    or sample get a 'size:' or 'sample:' key instead, so the grouping is exactly the
+    same as hashing every file in full. calculate_hash is called as
+    calculate_hash(path, st) and should return None on errors.
+    """
+    if stats is None:
+        stats = new_stage_stats()
+
+    # Every file is a row of the result from the moment it is found, the per-row state
+    # below lives in typed arrays indexed by row, not in dicts keyed by path
+    files = FileGroups()
+    devices = array('Q')
+    inodes = array('Q')
+    mtimes = array('q')
+    state = bytearray()
+    # Size -> the only row of that size so far, or COLLIDED
+    row_of_size = {}
+    # Rows that were sampled, and the rows of each (size, sample) pair
+    sample_of_row = {}
+    rows_by_sample = defaultdict(list)
+    unstatted = set()
+    # Rows whose full hash was dispatched but couldn't be read
+    unhashed = set()
+    completed = queue.Queue()
+    pending = 0
+
+    def row_stat(row):
+        if row in unstatted:
+            return None
+        return _RowStat(devices[row], inodes[row], files.sizes[row], mtimes[row])
+
+    def sample_or_none(item):
+        path, size, st = item
+        try:
+            return sample_file(path, size, sample_size, st)
+        except Exception as e:
+            log_error(f"Error sampling {path}: {e}")
+            return None
+
+    def full_hash(item):
+        path, st = item
+        try:
+            return calculate_hash(path, st)
+        except Exception as e:
+            log_error(f"Error hashing {path}: {e}")
+            return None
+
+    with get_metrics().phase('scan and hash'), hash_pool() as pool, \
+            tqdm(total=estimated_total, desc="Scanning files", unit="file") as scan_bar, \
+            tqdm(total=0, desc="Hashing files", unit="file") as hash_bar:
+
+        def dispatch(row, full):
+            nonlocal pending
+            size = files.sizes[row]
+            full = full or row in unstatted or size <= 2 * sample_size
+            if state[row] >= HASHING or (not full and state[row] == SAMPLING):
+                return
+            path = files.path(row)
+            st = row_stat(row)
+            # Worked out on a hashing thread, in physical order it opens the file
+            order_key = partial(locality_key, path, st, pool.read_order)
+            if full:
+                # The sample would cover the whole file, so hash it in full
+                future = pool.submit(full_hash, (path, st), devices[row], order_key, size)
+                state[row] = stage = HASHING
+            else:
+                # Samples are two small reads whatever the file size
+                future = pool.submit(sample_or_none, (path, size, st), devices[row], order_key, 2 * sample_size)
+                state[row] = stage = SAMPLING
+            pending += 1
+            hash_bar.total += 1
+            hash_bar.refresh()
+            future.add_done_callback(lambda f: completed.put((stage, row, f)))
+
+        def handle(stage, row, future):
+            result = future.result()
+            hash_bar.update(1)
+            if stage == HASHING:
+                if result:
+                    kind, digest, _ = parse_key(result)
+                    files.set_key(row, kind, digest)
+                    state[row] = HASHED
+                    stats['full_read_bytes'] += files.sizes[row]
+                else:
+                    unhashed.add(row)
+                return
+            if result is None:
+                # Already reported, the file is left out like one that fails to hash
+                return
+            size = files.sizes[row]
+            sample = int(result, 16)
+            sample_of_row[row] = sample
+            stats['sample_read_bytes'] += 2 * sample_size
+            group = rows_by_sample[(size, sample)]
+            group.append(row)
+            if len(group) == 2:
+                dispatch(group[0], full=True)
+            if len(group) >= 2:
+                dispatch(row, full=True)
+
+        def drain(block):
+            nonlocal pending
+            while pending:
+                try:
+                    item = completed.get(block=block)
+                except queue.Empty:
+                    return
+                pending -= 1
+                handle(*item)
+
+        # Stage 1: group by size as files are discovered, a unique size can't have a duplicate
+        for entry in file_entries:
+            scan_bar.update(1)
+            try:
+                st = entry.stat()
+            except OSError:
+                row = files.append(UNIQUE_SIZE, 0, 0, entry.path)
+                devices.append(0)
+                inodes.append(0)
+                mtimes.append(0)
+                state.append(0)
+                unstatted.add(row)
+                dispatch(row, full=True)
+                continue
+            size = st.st_size
+            row = files.append(UNIQUE_SIZE, size, size, entry.path)
+            devices.append(st.st_dev)
+            inodes.append(st.st_ino)
+            mtimes.append(st.st_mtime_ns)
+            state.append(0)
+            stats['files'] += 1
+            stats['total_bytes'] += size
+
+            if known_sizes is not None and size in known_sizes:
+                dispatch(row, full=True)
+
+            # Stage 2 and 3: sample, then fully hash, anything that collides
+            first = row_of_size.setdefault(size, row)
+            if first != row:
+                row_of_size[size] = COLLIDED
+                if first != COLLIDED:
+                    dispatch(first, full=False)
+                dispatch(row, full=False)
+            drain(block=False)
+
+        drain(block=True)
+
+    # Rows keep their 'size:' key if their size is unique; the rest become full hashes,
+    # unique samples, or are left out when they couldn't be read
+    dropped = []
+    for row in range(files.row_count()):
+        size = files.sizes[row]
+        if state[row] == HASHED:
+            continue
+        if row in unstatted or row in unhashed:
+            dropped.append(row)
+        elif row_of_size[size] == row:
+            stats['size_skipped_bytes'] += size
+        elif row in sample_of_row and len(rows_by_sample[(size, sample_of_row[row])]) == 1:
+            files.set_key(row, UNIQUE_SAMPLE, sample_of_row[row])
+            stats['sample_skipped_bytes'] += size - 2 * sample_size
+        else:
+            dropped.append(row)
+
+    if dropped:
+        dropped = set(dropped)
+        files = files.subset(row for row in range(files.row_count()) if row not in dropped)
+    return files
+
+
+def split_by_root(files_by_hash, root_dirs):
+    """Split combined FileGroups into one FileGroups per root directory.
+
+    A file belongs to every root it is below, so nested roots both get it.
+    """
+    roots_of_dir = [[index for index, root_dir in enumerate(root_dirs) if is_under(dirpath, root_dir)]
+                    for dirpath in files_by_hash.dirs]
+    rows_of_root = [array('Q') for _ in root_dirs]
+    for row, dir_id in enumerate(files_by_hash.dir_column):
+        for root_index in roots_of_dir[dir_id]:
+            rows_of_root[root_index].append(row)
+    return [files_by_hash.subset(rows) for rows in rows_of_root]
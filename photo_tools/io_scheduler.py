@@ -0,0 +1,178 @@
+import bisect
+import itertools
+import os
+import struct
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Order in which queued reads of a device are served: 'fifo' (discovery order), 'inode'
+# or 'physical' (the disk offset of the first extent via FIEMAP, Linux only, falling
+# back to the inode number). Ordering pays off on spinning disks, set
+# PHOTO_HASH_PER_DEVICE=1 as well there.
+READ_ORDER = os.environ.get('PHOTO_READ_ORDER', 'fifo')
+
+# Number of reads queued ahead of the hashing threads when reads are ordered; a larger
+# window lets the scheduler find nearer reads but holds more paths in memory
+SCHEDULE_WINDOW = 1024
+
+# Files at least this big count as large sequential reads
+LARGE_READ_SIZE = 16 * 1024 * 1024
+
+# Small files read between two large ones, so neither kind waits behind the other
+SMALL_BATCH = 32
+
+# Adapt the read size of each device to its observed throughput
+ADAPTIVE_READS = os.environ.get('PHOTO_ADAPTIVE_READS', '') not in ('', '0')
+MIN_READ_SIZE = 1024 * 1024
+MAX_READ_SIZE = 16 * 1024 * 1024
+
+# Bytes read at one read size before its throughput is compared with the previous one
+ADAPT_EVERY_BYTES = 256 * 1024 * 1024
+
+# Linux ioctl returning the extents of a file, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+
+
+# Whether FIEMAP works on each device, decided by the first file of the device that could be
+# opened, so the reads of one device are never keyed partly by disk offset and partly by inode
+_fiemap_devices = {}
+_fiemap_lock = threading.Lock()
+
+
+def physical_offset(path):
+    """Return the disk offset of the first extent of a file, 0 if it has none, or None where FIEMAP is unavailable.
+
+    Raises OSError if the file can't be opened.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return None
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if not mapped_extents:
+        return 0
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+
+def locality_key(path, st, read_order=None):
+    """Return the key reads are sorted by for the given order, or None to keep discovery order.
+
+    In 'physical' order this opens the file, so call it from a hashing thread rather
+    than the scanning one (HashPool.submit accepts it as a function for that). A device
+    whose first file has no FIEMAP support is keyed by inode throughout.
+    """
+    read_order = read_order or READ_ORDER
+    if read_order not in ('inode', 'physical') or st is None:
+        return None
+    if read_order == 'physical' and _fiemap_devices.get(st.st_dev) is not False:
+        try:
+            offset = physical_offset(path)
+        except OSError:
+            # Reading the file fails too, and reports the error
+            return 0
+        with _fiemap_lock:
+            supported = _fiemap_devices.setdefault(st.st_dev, offset is not None)
+        if supported:
+            return offset or 0
+    return st.st_ino
+
+
+class DeviceQueue:
+    """Pending reads of one device, served in elevator order.
+
+    Reads are kept sorted by locality key and the next one served is the first at or
+    after the last key served, wrapping around at the end (C-SCAN), so the disk head
+    sweeps across the drive instead of seeking back and forth. Large files and small
+    files wait in separate lanes: a batch of SMALL_BATCH small files is read between
+    two large ones, so a run of videos doesn't starve thumbnails and vice versa.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.small = []
+        self.large = []
+        self.position = -1
+        self.small_served = 0
+        self.sequence = itertools.count()
+
+    def push(self, key, size, task):
+        lane = self.large if (size or 0) >= LARGE_READ_SIZE else self.small
+        with self.lock:
+            bisect.insort(lane, (key, next(self.sequence), task))
+
+    def pop(self):
+        """Return the next task to run. There must be one queued."""
+        with self.lock:
+            if self.large and (not self.small or self.small_served >= SMALL_BATCH):
+                lane = self.large
+                self.small_served = 0
+            else:
+                lane = self.small
+                self.small_served += 1
+            index = bisect.bisect_left(lane, (self.position,))
+            if index == len(lane):
+                index = 0
+            key, _, task = lane.pop(index)
+            self.position = key
+            return task
+
+
+class ReadSizer:
+    """Pick the read size of one device by hill climbing on its observed throughput.
+
+    After every ADAPT_EVERY_BYTES the throughput is compared with the one at the
+    previous read size; the size keeps doubling (or halving) while that helps and
+    turns around when it doesn't.
+    """
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.size = size
+        self.factor = 2
+        self.last_rate = None
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def record(self, num_bytes, seconds):
+        with self.lock:
+            self.bytes += num_bytes
+            self.seconds += seconds
+            if self.bytes < ADAPT_EVERY_BYTES or not self.seconds:
+                return
+            rate = self.bytes / self.seconds
+            self.bytes = 0
+            self.seconds = 0.0
+            if self.last_rate is not None and rate < self.last_rate:
+                self.factor = 1 / self.factor
+            self.last_rate = rate
+            size = int(self.size * self.factor)
+            if not MIN_READ_SIZE <= size <= MAX_READ_SIZE:
+                self.factor = 1 / self.factor
+                size = int(self.size * self.factor)
+            self.size = size
+
+
+_read_sizers = {}
+_read_sizers_lock = threading.Lock()
+
+
+def get_read_sizer(device, size):
+    """Return the read sizer of a device, starting at size."""
+    with _read_sizers_lock:
+        sizer = _read_sizers.get(device)
+        if sizer is None:
+            sizer = _read_sizers[device] = ReadSizer(size)
+        return sizer
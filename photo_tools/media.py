@@ -0,0 +1,13 @@
+import os
+
+# File types the scripts pick up, by lower-case extension. Each script matches its own
+# combination of these sets, so a file type is only ever listed once.
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.heic', '.webp'}
+MOVIE_EXTENSIONS = {'.mp4', '.mov', '.avi', '.mkv', '.flv', '.wmv', '.mpeg', '.3gp', '.mts', '.m4v', '.mpg'}
+MEDIA_EXTENSIONS = IMAGE_EXTENSIONS | MOVIE_EXTENSIONS
+DOCUMENT_EXTENSIONS = {'.doc', '.docx', '.xls', '.xlsx', '.pdf', '.ppt', '.pptx', '.txt', '.csv', '.zip', '.rar', '.7z'}
+
+
+def has_extension(filename, extensions):
+    """Check if a file name ends in one of extensions, ignoring case."""
+    return os.path.splitext(filename)[1].lower() in extensions
@@ -0,0 +1,195 @@
+import atexit
+import contextlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# Write metrics to this path at the end of a run, as Prometheus text if it ends in .prom, else JSON
+METRICS_PATH = os.environ.get('PHOTO_METRICS', '')
+
+# Also rewrite the metrics file every this many seconds while the run is going, 0 to disable
+METRICS_INTERVAL = float(os.environ.get('PHOTO_METRICS_INTERVAL', 0))
+
+# Replace per-file output with at most one line per LOG_INTERVAL seconds
+QUIET = os.environ.get('PHOTO_QUIET', '') not in ('', '0')
+LOG_INTERVAL = 2.0
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+class Metrics:
+    """Thread-safe counters and phase timings for one run.
+
+    Counters are keyed by name and an optional device, such as an st_dev or a
+    'source->destination' pair of them, so bytes read per drive and totals share one
+    structure. Phases record their wall time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = defaultdict(float)
+        self.phases = {}
+
+    def add(self, name, value=1, device=None):
+        """Add value to a counter, optionally broken down by device."""
+        with self.lock:
+            self.counters[(name, device)] += value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the run."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def snapshot(self):
+        """Return the metrics as a JSON-serializable dict, with per-device read and copy throughput."""
+        with self.lock:
+            counters = dict(self.counters)
+            phases = dict(self.phases)
+        totals = defaultdict(float)
+        by_device = defaultdict(dict)
+        for (name, device), value in counters.items():
+            totals[name] += value
+            if device is not None:
+                by_device[name][str(device)] = value
+        throughput = {}
+        for kind, bytes_name, seconds_name in (('read', 'bytes_read', 'read_seconds'),
+                                               ('copy', 'bytes_copied', 'copy_seconds')):
+            throughput[kind] = {}
+            for device, num_bytes in by_device.get(bytes_name, {}).items():
+                seconds = by_device.get(seconds_name, {}).get(device)
+                if seconds:
+                    throughput[kind][device] = num_bytes / seconds
+        elapsed = time.time() - self.started
+        return {
+            'started': self.started,
+            'elapsed_seconds': elapsed,
+            'phases': phases,
+            'counters': dict(totals),
+            'by_device': dict(by_device),
+            'bytes_per_second_by_device': throughput,
+            'files_hashed_per_second': totals.get('files_hashed', 0) / elapsed if elapsed else 0,
+        }
+
+    def to_prometheus(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE photo_elapsed_seconds gauge',
+            f"photo_elapsed_seconds {snapshot['elapsed_seconds']:.6f}",
+            '# TYPE photo_phase_seconds gauge',
+        ]
+        for phase, seconds in snapshot['phases'].items():
+            lines.append(f'photo_phase_seconds{{phase="{_escape(phase)}"}} {seconds:.6f}')
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = 'photo_' + re.sub(r'[^a-zA-Z0-9_]', '_', name) + '_total'
+            lines.append(f'# TYPE {metric} counter')
+            devices = snapshot['by_device'].get(name)
+            if not devices:
+                lines.append(f'{metric} {_format_value(value)}')
+                continue
+            # Labelled counters are only exported per device, so summing them gives the total
+            for device, device_value in sorted(devices.items()):
+                lines.append(f'{metric}{{device="{_escape(device)}"}} {_format_value(device_value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Atomically write the metrics to path, as Prometheus text for .prom files and JSON otherwise."""
+        if path.endswith('.prom'):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _export_periodically(metrics, path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            metrics.write(path)
+        except OSError as e:
+            print(f"Error writing metrics to {path}: {e}")
+
+
+def get_metrics():
+    """Return the metrics of this run, starting the periodic export on first use if configured."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+            if METRICS_PATH:
+                atexit.register(export_metrics)
+                if METRICS_INTERVAL > 0:
+                    threading.Thread(target=_export_periodically, args=(_metrics, METRICS_PATH, METRICS_INTERVAL),
+                                     daemon=True).start()
+    return _metrics
+
+
+def export_metrics(path=None):
+    """Write this run's metrics to path, or to PHOTO_METRICS if set."""
+    path = path or METRICS_PATH
+    if path and _metrics is not None:
+        try:
+            _metrics.write(path)
+        except OSError as e:
+            print(f"Error writing metrics to {path}: {e}")
+
+
+class _RateLimitedLog:
+    """Print at most one message per interval, counting the ones skipped in between."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_print = 0
+        self.skipped = 0
+
+    def __call__(self, message):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_print < self.interval:
+                self.skipped += 1
+                return
+            if self.skipped:
+                message = f"{message} (and {self.skipped} more messages)"
+            self.skipped = 0
+            self.last_print = now
+        print(message)
+
+
+_quiet_log = _RateLimitedLog(LOG_INTERVAL)
+
+
+def log(message):
+    """Print a per-file message, or only now and then in quiet mode (PHOTO_QUIET=1)."""
+    if QUIET:
+        _quiet_log(message)
+    else:
+        print(message)
+
+
+def log_error(message):
+    """Print a per-file error to stderr, even in quiet mode, and count it in the run's metrics."""
+    get_metrics().add('errors')
+    print(message, file=sys.stderr)
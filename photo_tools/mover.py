@@ -0,0 +1,557 @@
+import ctypes
+import errno
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import xxhash
+from tqdm import tqdm
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from photo_tools.hash_cache import get_hash_cache
+from photo_tools.hashing import READ_BUFFER_SIZE, advise_sequential, calculate_hash, get_read_buffer, record_read
+from photo_tools.metrics import get_metrics
+from photo_tools.parallel import HashPool, imap_ordered
+from photo_tools.reference_index import digest_to_int
+
+# Directory holding one journal file per batch of moves
+JOURNAL_DIR = os.path.expanduser('~/.photo_move_journals')
+
+# Number of completed moves between journal flushes
+JOURNAL_FLUSH_EVERY = 200
+
+JOURNAL_VERSION = 1
+
+# Files at least this big are copied by the kernel with copy_file_range or sendfile where available
+KERNEL_COPY_SIZE = 8 * 1024 * 1024
+
+# Bytes copied by the kernel per call, each chunk is hashed while it is still in the page cache
+KERNEL_COPY_CHUNK = 8 * 1024 * 1024
+
+# Flags that make renameat2 (Linux) and renamex_np (macOS) fail rather than replace the destination
+RENAME_NOREPLACE = 1
+RENAME_EXCL = 0x4
+AT_FDCWD = -100
+
+# Also read every cross-device copy back from the destination drive and hash it again.
+# Off by default, it doubles the I/O of a copy; set PHOTO_VERIFY_COPIES=1 to enable
+VERIFY_COPIES = os.environ.get('PHOTO_VERIFY_COPIES', '') not in ('', '0')
+
+# macOS fcntl keeping a file's pages out of the cache, so a copy can be read back from the drive
+F_NOCACHE = 48
+
+_noreplace_rename = None
+
+
+def _load_noreplace_rename():
+    """Return a libc call renaming (src, dest) without replacing dest, or None where there isn't one."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    if sys.platform.startswith('linux') and hasattr(libc, 'renameat2'):
+        return lambda src, dest: libc.renameat2(AT_FDCWD, src, AT_FDCWD, dest, RENAME_NOREPLACE)
+    if sys.platform == 'darwin' and hasattr(libc, 'renamex_np'):
+        return lambda src, dest: libc.renamex_np(src, dest, RENAME_EXCL)
+    return None
+
+
+def rename_noreplace(src, dest):
+    """Rename a file within a file system, raising FileExistsError instead of replacing dest.
+
+    Uses renameat2 with RENAME_NOREPLACE on Linux and renamex_np with RENAME_EXCL on
+    macOS, which check and rename atomically. Where neither works, e.g. on file systems
+    that don't support the flag, dest is checked just before a plain rename.
+    """
+    global _noreplace_rename
+    if _noreplace_rename is None:
+        _noreplace_rename = _load_noreplace_rename() or False
+    if _noreplace_rename:
+        if _noreplace_rename(os.fsencode(src), os.fsencode(dest)) == 0:
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.ENOSYS, errno.EINVAL, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise OSError(error, os.strerror(error), src, None, dest)
+    if os.path.lexists(dest):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dest)
+    os.rename(src, dest)
+
+
+def new_journal_path(name):
+    """Return a fresh journal path for a batch of moves made by the named script."""
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(JOURNAL_DIR, f"{name}-{stamp}-{os.getpid()}.jsonl")
+
+
+def _end_torn_line(journal_path):
+    """End a torn last line of an interrupted run's journal, so the lines appended next start on a line of their own."""
+    try:
+        with open(journal_path, 'r+b') as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+    except FileNotFoundError:
+        pass
+
+
+class MoveJournal:
+    """Append-only JSONL record of a batch of moves.
+
+    The first line is a header, followed by one line per planned move, then 'mkdir'
+    lines for directories the batch created, 'partial' lines for the partial files of
+    copies, written before each copy starts, 'done' lines as moves complete and
+    'refused' lines for moves whose destination already existed. Done lines are
+    buffered, so after a crash some completed moves may be missing them; resume and
+    rollback tell those apart by checking which side of the move exists. Copies write
+    their partial lines from the hashing threads, so writes are locked.
+    """
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        _end_torn_line(journal_path)
+        self.file = open(journal_path, 'a', encoding='utf-8', errors='surrogateescape')
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def write(self, record, flush=False):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.pending += 1
+            if flush or self.pending >= JOURNAL_FLUSH_EVERY:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_journal(journal_path):
+    """Read a journal into (moves, done indexes, refused indexes, created dirs, partials, status).
+
+    partials is a list of (move index, path) for every partial file a copy created.
+    """
+    moves = []
+    done = set()
+    refused = set()
+    created = []
+    partials = []
+    status = 'incomplete'
+    with open(journal_path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn line of an interrupted run, the lines a resume appended after it are still good
+                continue
+            if 'src' in record:
+                moves.append((record['src'], record['dest'], record.get('hash')))
+            elif 'done' in record:
+                done.add(record['done'])
+            elif 'refused' in record:
+                refused.add(record['refused'])
+            elif 'mkdir' in record:
+                created.append(record['mkdir'])
+            elif 'partial' in record:
+                partials.append((record['move'], record['partial']))
+            elif 'status' in record:
+                status = record['status']
+    return moves, done, refused, created, partials, status
+
+
+def _device(path, devices):
+    """Return the device id of a directory, caching it per directory."""
+    device = devices.get(path)
+    if device is None:
+        try:
+            device = os.stat(path).st_dev
+        except OSError:
+            device = -1
+        devices[path] = device
+    return device
+
+
+def _ensure_dir(dest_dir, ensured, journal):
+    """Create a destination directory once per batch, journaling the directories it adds."""
+    if dest_dir in ensured:
+        return
+    missing = []
+    path = dest_dir
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    os.makedirs(dest_dir, exist_ok=True)
+    for path in reversed(missing):
+        ensured.add(path)
+        if journal is not None:
+            journal.write({'mkdir': path})
+    ensured.add(dest_dir)
+
+
+def _kernel_copy(src_fd, dest_fd, offset, count):
+    """Copy a range between files inside the kernel. Returns the bytes copied, or None if unsupported."""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src_fd, dest_fd, count, offset, offset)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    if hasattr(os, 'sendfile') and os.lseek(dest_fd, 0, os.SEEK_CUR) == offset:
+        try:
+            return os.sendfile(dest_fd, src_fd, offset, count)
+        except OSError as e:
+            # macOS can only sendfile to a socket
+            if e.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTSOCK):
+                raise
+    return None
+
+
+def copy_and_hash(src, fdest, verify=False):
+    """Copy a file's bytes into fdest, returning the xxh64 hexdigests of what was read and of what was written.
+
+    fdest is an empty file opened unbuffered for reading and writing.
+
+    Small files, and platforms without copy_file_range or sendfile (macOS), go through
+    this thread's read buffer and are hashed from it. Large files are copied by the
+    kernel in chunks; each chunk is hashed right after it is copied, while the kernel
+    still has it in the page cache, so the drive is not read twice. The copy is then
+    fsynced. Only with verify is it also dropped from the page cache where the platform
+    allows it and read back from the destination drive to hash the bytes that actually
+    landed there; otherwise the written digest is None.
+    """
+    hash_xx = xxhash.xxh64()
+    start = time.perf_counter()
+    with open(src, 'rb', buffering=0) as fsrc:
+        src_fd = fsrc.fileno()
+        dest_fd = fdest.fileno()
+        src_st = os.fstat(src_fd)
+        size = src_st.st_size
+        advise_sequential(src_fd, size)
+        if verify and sys.platform == 'darwin' and fcntl is not None:
+            # macOS has no fadvise to drop the copy from the cache afterwards
+            fcntl.fcntl(dest_fd, F_NOCACHE, 1)
+        buffer = get_read_buffer()
+        view = memoryview(buffer)
+        offset = 0
+        kernel = size >= KERNEL_COPY_SIZE
+        while True:
+            if kernel:
+                copied = _kernel_copy(src_fd, dest_fd, offset, KERNEL_COPY_CHUNK)
+                if copied is None:
+                    kernel = False
+                    os.lseek(src_fd, offset, os.SEEK_SET)
+                    os.lseek(dest_fd, offset, os.SEEK_SET)
+                    continue
+                if not copied:
+                    break
+                end = offset + copied
+                while offset < end:
+                    n = os.preadv(src_fd, [view[:min(READ_BUFFER_SIZE, end - offset)]], offset)
+                    if not n:
+                        raise OSError(errno.EIO, f"{src} shrank while it was copied")
+                    hash_xx.update(view[:n])
+                    offset += n
+                os.lseek(dest_fd, end, os.SEEK_SET)
+            else:
+                n = fsrc.readinto(buffer)
+                if not n:
+                    break
+                hash_xx.update(view[:n])
+                written = 0
+                while written < n:
+                    written += fdest.write(view[written:n])
+                offset += n
+        os.fsync(dest_fd)
+        dest_device = os.fstat(dest_fd).st_dev
+        devices = f"{src_st.st_dev}->{dest_device}"
+        copy_seconds = time.perf_counter() - start
+        written_hash = _hash_written(dest_fd, dest_device, view) if verify else None
+    metrics = get_metrics()
+    metrics.add('bytes_copied', offset, devices)
+    metrics.add('copy_seconds', copy_seconds, devices)
+    return hash_xx.hexdigest(), written_hash
+
+
+def _hash_written(fd, device, view):
+    """Hash a fsynced file from its drive, dropping its cached pages first where the platform allows it."""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+    hash_xx = xxhash.xxh64()
+    start = time.perf_counter()
+    offset = 0
+    reads = 1
+    while n := os.preadv(fd, [view], offset):
+        hash_xx.update(view[:n])
+        offset += n
+        reads += 1
+    record_read(device, offset, time.perf_counter() - start, reads)
+    get_metrics().add('bytes_verified', offset, device)
+    return hash_xx.hexdigest()
+
+
+def _copy_move(src, dest, expected_hash=None, journal=None, index=None):
+    """Move a file across devices, returning the xxh64 hexdigest of the copied bytes.
+
+    The file is copied to a partial file while it is hashed, in the same pass. Only if
+    that hash matches expected_hash when it is a full digest, and with VERIFY_COPIES
+    the copy read back from the destination hashes the same, is the copy renamed into
+    place, never over an existing file, and the source unlinked. The partial file is created exclusively
+    under a unique hidden name next to dest, so no existing file is ever written to or
+    removed, and with a journal it is journaled for move index before the copy starts.
+    The digest is stored in the hash cache for the new path.
+    """
+    fd, partial_path = tempfile.mkstemp(suffix='.partial', prefix=f".{os.path.basename(dest)}.",
+                                        dir=os.path.dirname(dest))
+    try:
+        with open(fd, 'r+b', buffering=0) as fdest:
+            if journal is not None:
+                journal.write({'partial': partial_path, 'move': index}, flush=True)
+            file_hash, written_hash = copy_and_hash(src, fdest, VERIFY_COPIES)
+        shutil.copystat(src, partial_path)
+        if digest_to_int(expected_hash or '') is not None and file_hash != expected_hash:
+            raise OSError(errno.EIO, f"source hashed to {file_hash} instead of {expected_hash}, source kept")
+        if VERIFY_COPIES and written_hash != file_hash:
+            raise OSError(errno.EIO, f"copy read back as {written_hash} instead of {file_hash}, source kept")
+        rename_noreplace(partial_path, dest)
+    except BaseException:
+        try:
+            os.unlink(partial_path)
+        except OSError:
+            pass
+        raise
+    os.unlink(src)
+
+    cache = get_hash_cache()
+    if cache is not None:
+        try:
+            cache.store(dest, os.stat(dest), file_hash)
+        except OSError:
+            pass
+    return file_hash
+
+
+def move_files(moves, journal_path=None, desc="Moving files"):
+    """Move a batch of files, returning a list of (src, dest, error, file_hash).
+
+    moves are (src, dest) or (src, dest, expected_hash) tuples. Each destination
+    directory is created once. A move never replaces an existing destination: it is
+    refused with an error, journaled, and the source stays. Moves within a device are
+    renames done in order;
+    moves across devices are copied on a thread pool, capped per (source device,
+    destination device) pair, and hashed during the copy. A copy whose hash doesn't
+    match expected_hash leaves the source in place and reports an error. error is None
+    for files that moved, and file_hash is the digest computed by a copy (None for
+    renames). With a journal_path, the batch is journaled so an interrupted run can be
+    resumed or rolled back with move_journal.py.
+    """
+    moves = [(move[0], move[1], move[2] if len(move) > 2 else None) for move in moves]
+    journal = None
+    if journal_path is not None:
+        journal = MoveJournal(journal_path)
+        journal.write({'version': JOURNAL_VERSION, 'started': time.time()})
+        for src, dest, expected_hash in moves:
+            record = {'src': src, 'dest': dest}
+            if expected_hash:
+                record['hash'] = expected_hash
+            journal.write(record)
+        journal.flush()
+    try:
+        results = _run_moves(list(enumerate(moves)), journal, desc)
+        if journal is not None:
+            journal.write({'status': 'complete'})
+        return results
+    finally:
+        if journal is not None:
+            journal.close()
+
+
+def _run_moves(indexed_moves, journal, desc):
+    results = [None] * len(indexed_moves)
+    position_of = {}
+    ensured = set()
+    devices = {}
+    renames = []
+    copies = []
+
+    for position, (index, (src, dest, expected_hash)) in enumerate(indexed_moves):
+        position_of[index] = position
+        dest_dir = os.path.dirname(dest)
+        try:
+            _ensure_dir(dest_dir, ensured, journal)
+        except OSError as e:
+            results[position] = (src, dest, str(e), None)
+            get_metrics().add('move_errors')
+            continue
+        src_device = _device(os.path.dirname(src), devices)
+        dest_device = _device(dest_dir, devices)
+        if src_device == dest_device and src_device != -1:
+            renames.append((index, src, dest, expected_hash))
+        else:
+            copies.append((index, src, dest, expected_hash, (src_device, dest_device)))
+
+    metrics = get_metrics()
+
+    def finish(index, src, dest, error, file_hash=None):
+        results[position_of[index]] = (src, dest, None if error is None else str(error), file_hash)
+        metrics.add('files_moved' if error is None else 'move_errors')
+        if journal is not None:
+            if error is None:
+                journal.write({'done': index})
+            elif isinstance(error, FileExistsError):
+                journal.write({'refused': index, 'error': str(error)})
+        pbar.update(1)
+
+    with tqdm(total=len(indexed_moves), desc=desc, unit="file") as pbar:
+        pbar.update(len(indexed_moves) - len(renames) - len(copies))
+        for index, src, dest, expected_hash in renames:
+            try:
+                rename_noreplace(src, dest)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    # Same st_dev but a different mount, e.g. a bind mount
+                    copies.append((index, src, dest, expected_hash, (-1, -1)))
+                else:
+                    finish(index, src, dest, e)
+                continue
+            finish(index, src, dest, None)
+
+        def copy(item):
+            index, src, dest, expected_hash, _ = item
+            try:
+                return None, _copy_move(src, dest, expected_hash, journal, index)
+            except Exception as e:
+                return e, None
+
+        with HashPool() as pool:
+            for (index, src, dest, _, _), (error, file_hash) in imap_ordered(copy, copies, device=lambda item: item[4],
+                                                                              pool=pool):
+                finish(index, src, dest, error, file_hash)
+
+    return results
+
+
+def _remove_partials(partials):
+    """Unlink the journaled partial files that are still there."""
+    for _, path in partials:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def _copied_before_crash(index, src, dest, copied):
+    """Return whether a copy move left both its files behind with the same contents.
+
+    That happens when a run stops after renaming the copy into place but before
+    unlinking the source. Only moves that journaled a partial file are checked.
+    """
+    if index not in copied or not (os.path.lexists(src) and os.path.lexists(dest)):
+        return False
+    try:
+        return calculate_hash(src) == calculate_hash(dest)
+    except OSError:
+        return False
+
+
+def resume_moves(journal_path):
+    """Finish the moves of an interrupted journal. Returns the list of (src, dest, error, file_hash) it attempted.
+
+    Leftover partial files are removed. A copy that was renamed into place before its
+    source was unlinked is finished by unlinking the source if both hash the same.
+    """
+    moves, done, refused, _, partials, status = read_journal(journal_path)
+    if status != 'incomplete':
+        print(f"Journal {journal_path} is already {status}.")
+        return []
+    _remove_partials(partials)
+    copied = {index for index, _ in partials}
+    pending = []
+    results = []
+    journal = MoveJournal(journal_path)
+    for index, (src, dest, expected_hash) in enumerate(moves):
+        if index in done or index in refused:
+            continue
+        if _copied_before_crash(index, src, dest, copied):
+            try:
+                os.unlink(src)
+            except OSError as e:
+                results.append((src, dest, str(e), None))
+                continue
+            journal.write({'done': index})
+            results.append((src, dest, None, None))
+        elif os.path.lexists(src):
+            pending.append((index, (src, dest, expected_hash)))
+        elif os.path.lexists(dest):
+            # Moved before the crash, but its done line was never flushed
+            journal.write({'done': index})
+    try:
+        results += _run_moves(pending, journal, "Resuming moves")
+        journal.write({'status': 'complete'})
+        return results
+    finally:
+        journal.close()
+
+
+def rollback_moves(journal_path):
+    """Move every file of a journal back to where it came from and remove the directories it created.
+
+    Only the partial files recorded in the journal are removed. A copy that was renamed
+    into place before its source was unlinked is undone by unlinking the copy if both
+    hash the same.
+    """
+    moves, done, refused, created, partials, status = read_journal(journal_path)
+    if status == 'rolled back':
+        print(f"Journal {journal_path} is already rolled back.")
+        return []
+    _remove_partials(partials)
+    copied = {index for index, _ in partials}
+    back = []
+    results = []
+    for index, (src, dest, _) in reversed(list(enumerate(moves))):
+        if index in refused:
+            # The destination was there before the run, it isn't ours to move
+            continue
+        if index in done or (not os.path.lexists(src) and os.path.lexists(dest)):
+            back.append((dest, src))
+        elif _copied_before_crash(index, src, dest, copied):
+            # The source is still in place, only the copy has to go
+            try:
+                os.unlink(dest)
+            except OSError as e:
+                results.append((dest, src, str(e), None))
+                continue
+            results.append((dest, src, None, None))
+
+    results += move_files(back, desc="Rolling back moves")
+    for path in reversed(created):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+    journal = MoveJournal(journal_path)
+    journal.write({'status': 'rolled back'}, flush=True)
+    journal.close()
+    return results
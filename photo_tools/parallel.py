@@ -0,0 +1,237 @@
+import contextlib
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from photo_tools.io_scheduler import DeviceQueue, READ_ORDER, SCHEDULE_WINDOW
+from photo_tools.metrics import get_metrics
+
+# Total number of hashing threads, set PHOTO_HASH_WORKERS=1 for the serial path
+HASH_WORKERS = int(os.environ.get('PHOTO_HASH_WORKERS', min(8, (os.cpu_count() or 1) * 2)))
+
+# Maximum concurrent reads per device, keep this low for spinning USB disks
+PER_DEVICE_LIMIT = int(os.environ.get('PHOTO_HASH_PER_DEVICE', 2))
+
+# Maximum number of discovered paths waiting to be hashed
+SCAN_QUEUE_SIZE = 10000
+
+_DONE = object()
+
+# The HashPool every hashing stage runs on while shared_hash_pool() is active
+_shared_pool = None
+
+
+class HashPool:
+    """Thread pool with a bounded number of queued tasks and a concurrency cap per device.
+
+    submit blocks once too many tasks are outstanding, which keeps a fast directory
+    scan from queueing millions of paths ahead of the hashing threads. With a
+    read_order other than 'fifo', tasks submitted with an order_key wait in a
+    DeviceQueue per device and are read in disk order rather than submission order.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, per_device_limit=PER_DEVICE_LIMIT, read_order=None):
+        self.workers = max(1, workers)
+        self.per_device_limit = max(1, per_device_limit)
+        self.read_order = read_order or READ_ORDER
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        ordered = self.read_order != 'fifo'
+        self.slots = threading.BoundedSemaphore(SCHEDULE_WINDOW if ordered else self.workers * 4)
+        self.device_semaphores = defaultdict(lambda: threading.Semaphore(self.per_device_limit))
+        self.device_queues = defaultdict(DeviceQueue) if ordered else None
+        self.lock = threading.Lock()
+
+    def _device_semaphore(self, device):
+        with self.lock:
+            return self.device_semaphores[device]
+
+    def _device_queue(self, device):
+        with self.lock:
+            return self.device_queues[device]
+
+    def submit(self, func, item, device=0, order_key=None, size=None):
+        """Schedule func(item), blocking while the pool is full. Returns a Future.
+
+        order_key (see io_scheduler.locality_key) and size place an ordered task in its
+        device's queue; without an order_key tasks run in submission order. order_key may
+        be a function of no arguments, which is called on a pool thread so keys that read
+        the disk don't hold up the caller. Time spent
+        blocked on a full pool or on a busy device is recorded as a stall in the run's
+        metrics.
+        """
+        metrics = get_metrics()
+        if not self.slots.acquire(blocking=False):
+            start = time.perf_counter()
+            self.slots.acquire()
+            metrics.add('hash_pool_full_stalls')
+            metrics.add('hash_pool_full_stall_seconds', time.perf_counter() - start)
+        semaphore = self._device_semaphore(device)
+        ordered = self.device_queues is not None and order_key is not None
+        if ordered:
+            # Every queued task gets one run() call, which runs whichever task is next in disk order
+            future = Future()
+            device_queue = self._device_queue(device)
+
+        def run():
+            if not semaphore.acquire(blocking=False):
+                start = time.perf_counter()
+                semaphore.acquire()
+                metrics.add('device_busy_stalls', 1, device)
+                metrics.add('device_busy_stall_seconds', time.perf_counter() - start, device)
+            try:
+                if not ordered:
+                    return func(item)
+                next_func, next_item, next_future = device_queue.pop()
+                if next_future.set_running_or_notify_cancel():
+                    try:
+                        next_future.set_result(next_func(next_item))
+                    except BaseException as e:
+                        next_future.set_exception(e)
+            finally:
+                semaphore.release()
+
+        def queue():
+            key = order_key() if callable(order_key) else order_key
+            device_queue.push(0 if key is None else key, size, (func, item, future))
+            self.executor.submit(run)
+
+        def queue_failed(queuer):
+            if queuer.exception() is not None and not future.done():
+                future.set_exception(queuer.exception())
+
+        try:
+            runner = self.executor.submit(queue if ordered else run)
+        except BaseException:
+            self.slots.release()
+            raise
+        if ordered:
+            runner.add_done_callback(queue_failed)
+        else:
+            future = runner
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+@contextlib.contextmanager
+def shared_hash_pool():
+    """Run every hashing stage started inside the block on one HashPool, e.g. for several commands in one process."""
+    global _shared_pool
+    with HashPool() as pool:
+        _shared_pool = pool
+        try:
+            yield pool
+        finally:
+            _shared_pool = None
+
+
+@contextlib.contextmanager
+def hash_pool():
+    """Yield the shared HashPool if one is active, or else a new one that is shut down after the block."""
+    if _shared_pool is not None:
+        yield _shared_pool
+        return
+    with HashPool() as pool:
+        yield pool
+
+
+def path_device(path_of=None):
+    """Return a device function for imap_ordered giving the st_dev of the folder holding each item's path.
+
+    path_of maps an item to its path and defaults to the item itself. Each folder is
+    looked up once with device_of.
+    """
+    devices = {}
+
+    def device(item):
+        folder = os.path.dirname(path_of(item) if path_of else item)
+        st_dev = devices.get(folder)
+        if st_dev is None:
+            st_dev = devices[folder] = device_of(folder)
+        return st_dev
+
+    return device
+
+
+def imap_ordered(func, items, device=None, pool=None):
+    """Apply func to a stream of items on a HashPool, yielding (item, result) in input order.
+
+    device is an optional function returning the st_dev of an item. At most a few
+    results per worker are held in memory at once.
+    """
+    own_pool = pool is None and _shared_pool is None
+    if own_pool:
+        pool = HashPool()
+    elif pool is None:
+        pool = _shared_pool
+    window = deque()
+    try:
+        for item in items:
+            window.append((item, pool.submit(func, item, device(item) if device else 0)))
+            while window and (window[0][1].done() or len(window) > pool.workers * 4):
+                head, future = window.popleft()
+                yield head, future.result()
+        while window:
+            head, future = window.popleft()
+            yield head, future.result()
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+
+def _stalling_call(nonblocking, blocking, metrics, name):
+    """Try a queue operation without blocking, and record the wait in the metrics if it has to block."""
+    try:
+        return nonblocking()
+    except (queue.Full, queue.Empty):
+        start = time.perf_counter()
+        result = blocking()
+        metrics.add(f"{name}_stalls")
+        metrics.add(f"{name}_stall_seconds", time.perf_counter() - start)
+        return result
+
+
+def background_iter(iterable, maxsize=SCAN_QUEUE_SIZE):
+    """Run an iterable on a background thread, yielding its items through a bounded queue.
+
+    Waits on a full queue (the consumer is the bottleneck) and on an empty queue (the
+    producer is) are recorded as stalls in the run's metrics.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    errors = []
+    metrics = get_metrics()
+
+    def produce():
+        try:
+            for item in iterable:
+                _stalling_call(lambda: items.put_nowait(item), lambda: items.put(item), metrics, 'scan_queue_full')
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            items.put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while (item := _stalling_call(items.get_nowait, items.get, metrics, 'scan_queue_empty')) is not _DONE:
+        yield item
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def device_of(path):
+    """Return the device id of a path, or 0 if it can't be read."""
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return 0
@@ -0,0 +1,169 @@
+import os
+from photo_tools.file_groups import FileGroups
+from photo_tools.hash_cache import get_hash_cache
+from photo_tools.media import IMAGE_EXTENSIONS, has_extension
+from photo_tools.metrics import log_error
+from photo_tools.parallel import imap_ordered, path_device
+
+# Maximum number of differing bits out of 64 for two images to count as the same photo
+MAX_DISTANCE = 5
+
+# dHash compares each pixel of a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail with its right neighbour
+HASH_SIZE = 8
+
+_image_module = None
+
+
+def load_pillow():
+    """Import Pillow on first use, registering HEIC support when pillow-heif is installed."""
+    global _image_module
+    if _image_module is None:
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            raise RuntimeError("Near-duplicate mode needs Pillow: pip install Pillow") from None
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            pass
+        _image_module = (Image, ImageOps)
+    return _image_module
+
+
+def is_image(path):
+    """Check if a path is an image the perceptual hash can handle (HEIC needs the optional pillow-heif package)."""
+    return has_extension(path, IMAGE_EXTENSIONS)
+
+
+def calculate_dhash(file_path):
+    """Calculate the 64-bit difference hash of an image."""
+    Image, ImageOps = load_pillow()
+    with Image.open(file_path) as img:
+        # Let the JPEG decoder scale down by up to 8x while decoding instead of decoding full size
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+        img = ImageOps.exif_transpose(img).convert('L')
+        pixels = list(img.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR).getdata())
+
+    bits = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return bits
+
+
+def dhash_file(file_path):
+    """Calculate the dHash of an image, reusing the persistent hash cache. Returns None on errors."""
+    try:
+        cache = get_hash_cache()
+        if cache is None:
+            return calculate_dhash(file_path)
+        st = os.stat(file_path)
+        cached = cache.lookup(file_path, st, 'perceptual_hash')
+        if cached is not None:
+            return int(cached, 16)
+        dhash = calculate_dhash(file_path)
+        cache.store(file_path, st, f"{dhash:016x}", 'perceptual_hash')
+        return dhash
+    except Exception as e:
+        log_error(f"Error reading image {file_path}: {e}")
+        return None
+
+
+def hamming(a, b):
+    """Count the differing bits of two hashes."""
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-distance range queries.
+
+    Each query only visits subtrees whose edge distance is within max_distance of the
+    query's distance to the node, so it touches a small part of the tree instead of
+    comparing against every hash.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        node = [value, [item], {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, max_distance):
+        """Return the items of every hash within max_distance of value."""
+        if self.root is None:
+            return []
+        found = []
+        stack = [self.root]
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming(value, node_value)
+            if distance <= max_distance:
+                found.extend(items)
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+def merge_near_duplicates(files_by_hash, max_distance=MAX_DISTANCE):
+    """Merge groups of files_by_hash whose images look the same into 'near:' groups.
+
+    One image per exact group is hashed, so exact duplicates are only decoded once.
+    The first image of each cluster is its leader, and only leaders go in the BK-tree.
+    An image joins the nearest leader within max_distance or starts a new cluster, so
+    every image in a cluster is within max_distance of its leader; a chain of small
+    steps never joins two images that are far apart. Merged groups get a
+    'near:<leader dhash>' key and everything else keeps its exact key.
+    """
+    groups = list(files_by_hash.items())
+    representatives = []
+    for index, (_, paths) in enumerate(groups):
+        image_path = next((path for path in paths if is_image(path)), None)
+        if image_path is not None:
+            representatives.append((index, image_path))
+
+    load_pillow()
+    leaders = BKTree()
+    dhash_of_group = {}
+    leader_of_group = {}
+    results = imap_ordered(lambda item: dhash_file(item[1]), representatives, device=path_device(lambda item: item[1]))
+    for (index, _), dhash in results:
+        if dhash is None:
+            continue
+        dhash_of_group[index] = dhash
+        nearby = leaders.search(dhash, max_distance)
+        if nearby:
+            leader_of_group[index] = min(nearby, key=lambda leader: (hamming(dhash, dhash_of_group[leader]), leader))
+        else:
+            leader_of_group[index] = index
+            leaders.add(dhash, index)
+
+    cluster_sizes = {}
+    for leader in leader_of_group.values():
+        cluster_sizes[leader] = cluster_sizes.get(leader, 0) + 1
+
+    near_keys = {}
+    for index, leader in leader_of_group.items():
+        if cluster_sizes[leader] > 1:
+            near_keys[groups[index][0]] = f"near:{dhash_of_group[leader]:016x}"
+
+    merged = FileGroups()
+    for file_hash, path, size in files_by_hash.rows():
+        merged.add(near_keys.get(file_hash, file_hash), path, size)
+    return merged
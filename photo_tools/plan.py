@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from photo_tools.metrics import get_metrics, log, log_error
+from photo_tools.mover import move_files, new_journal_path
+
+# Directory holding the latest plan written by each script
+PLAN_DIR = os.path.expanduser('~/.photo_move_plans')
+
+PLAN_VERSION = 1
+
+
+def default_plan_path(name):
+    """Return the plan file used by the named script."""
+    return os.path.join(PLAN_DIR, f"{name}.plan.jsonl")
+
+
+class PlanWriter:
+    """Write a move plan as JSONL: a header line, then one line per operation.
+
+    Operations are {'op': 'move', 'src', 'dest'}, {'op': 'delete', 'path'} and
+    {'op': 'rmdir', 'path'}, applied in the order they were written. Extra keyword
+    arguments are stored on the operation, e.g. the hash of a moved file. Extra header
+    fields tell apply_plan.py what else to update after applying.
+    """
+
+    def __init__(self, plan_path, name, **header):
+        self.plan_path = plan_path
+        self.tmp_path = plan_path + '.tmp'
+        self.counts = {'move': 0, 'delete': 0, 'rmdir': 0}
+        os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+        self.file = open(self.tmp_path, 'w', encoding='utf-8', errors='surrogateescape')
+        self._write({'version': PLAN_VERSION, 'name': name, 'created': time.time(), **header})
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def move(self, src, dest, **extra):
+        self.counts['move'] += 1
+        self._write({'op': 'move', 'src': src, 'dest': dest, **extra})
+
+    def delete(self, path):
+        self.counts['delete'] += 1
+        self._write({'op': 'delete', 'path': path})
+
+    def rmdir(self, path):
+        self.counts['rmdir'] += 1
+        self._write({'op': 'rmdir', 'path': path})
+
+    def close(self):
+        """Finish the plan, replacing the previous plan at the same path."""
+        self.file.close()
+        os.replace(self.tmp_path, self.plan_path)
+        metrics = get_metrics()
+        for op, count in self.counts.items():
+            metrics.add(f"planned_{op}", count)
+        print(f"Planned {self.counts['move']} moves, {self.counts['delete']} deletions and "
+              f"{self.counts['rmdir']} folder removals in '{self.plan_path}'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.unlink(self.tmp_path)
+
+
+def read_plan_header(plan_path):
+    """Return the header of a plan file."""
+    with open(plan_path, encoding='utf-8', errors='surrogateescape') as f:
+        header = json.loads(f.readline())
+    if header.get('version') != PLAN_VERSION:
+        raise ValueError(f"{plan_path} is not a version {PLAN_VERSION} move plan")
+    return header
+
+
+def iter_plan(plan_path):
+    """Stream the operations of a plan file."""
+    read_plan_header(plan_path)
+    with open(plan_path, encoding='utf-8', errors='surrogateescape') as f:
+        f.readline()
+        for line in f:
+            yield json.loads(line)
+
+
+def apply_plan(plan_path, on_moved=None):
+    """Apply a plan file, returning a list of (op, error) for every operation that failed.
+
+    Consecutive moves are handed to move_files as one journaled batch; a batch is
+    flushed before any deletion or folder removal so those see the moved files gone.
+    A folder is not removed if a move out of it failed. Moves carrying a 'hash' are
+    verified against it when copied across devices. on_moved(op) is called for every
+    move that succeeded, with op['hash'] set to the digest computed by the copy if any.
+    """
+    name = read_plan_header(plan_path)['name']
+    failures = []
+    failed_dirs = set()
+    batch = []
+    batch_count = 0
+
+    def flush():
+        nonlocal batch_count
+        if not batch:
+            return
+        journal_name = name if not batch_count else f"{name}-{batch_count}"
+        results = move_files([(op['src'], op['dest'], op.get('hash')) for op in batch],
+                             new_journal_path(journal_name))
+        for op, (src, _, error, file_hash) in zip(batch, results):
+            if error:
+                log_error(f"Error moving {src}: {error}")
+                failures.append((op, error))
+                failed_dirs.add(os.path.dirname(src))
+                continue
+            if file_hash:
+                # Hashed while it was copied across devices, so it needn't be read again
+                op['hash'] = file_hash
+            if on_moved is not None:
+                on_moved(op)
+        batch.clear()
+        batch_count += 1
+
+    with get_metrics().phase('apply plan'):
+        for op in iter_plan(plan_path):
+            if op['op'] == 'move':
+                batch.append(op)
+                continue
+            flush()
+            path = op['path']
+            try:
+                if op['op'] == 'delete':
+                    os.unlink(path)
+                    log(f"Deleted: {path}")
+                elif path in failed_dirs:
+                    continue
+                else:
+                    os.rmdir(path)
+                    log(f"Deleted empty folder: {path}")
+            except OSError as e:
+                log_error(f"Error deleting {path}: {e}")
+                failures.append((op, str(e)))
+                failed_dirs.add(os.path.dirname(path))
+        flush()
+    return failures
+
+
+def print_plan_failures(failures):
+    """Print the (op, error) failures returned by apply_plan."""
+    if failures:
+        print("\nThe following operations failed:")
+        for op, error in failures:
+            print(f"{op.get('src', op.get('path'))} - {error}")
@@ -0,0 +1,245 @@
+import bisect
+import mmap
+import os
+import struct
+import sys
+from array import array
+from photo_tools.snapshot import hash_delta, load_snapshot, rescan_snapshot, save_snapshot
+from photo_tools.walker import new_walk_stats, print_walk_stats
+
+# File layout: a 24 byte header (magic, sorted record count, distinct size count), then
+# the sorted records of two little-endian uint64s (xxh64 digest, file size), sorted by
+# digest, then every distinct size of those records as sorted uint64s. Records appended
+# after that are unsorted and are merged into the sorted part by compact().
+MAGIC = b'PDRIDX02'
+HEADER = struct.Struct('<8sQQ')
+RECORD = struct.Struct('<QQ')
+SIZE = struct.Struct('<Q')
+
+# Reference indexes are kept here, one per indexed library, rather than on the library's drive
+INDEX_DIR = os.path.expanduser('~/.photo_reference_indexes')
+
+# Merge appended records into the sorted part once they make up this share of the index
+COMPACT_RATIO = 0.1
+
+
+def digest_to_int(file_hash):
+    """Convert an xxh64 hexdigest to its integer digest, or None for non-digest keys."""
+    if len(file_hash) != 16:
+        return None
+    try:
+        return int(file_hash, 16)
+    except ValueError:
+        return None
+
+
+class _SortedDigests:
+    """Sequence view of the digest column of the mapped records, for bisect."""
+
+    def __init__(self, words, count):
+        self.words = words
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.words[2 * index]
+
+
+class _IndexSizes:
+    """Set-like view of the file sizes in a reference index, for membership checks."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __contains__(self, size):
+        if size in self.index.appended_sizes:
+            return True
+        sizes = self.index.size_words
+        if sizes is None:
+            return False
+        position = bisect.bisect_left(sizes, size)
+        return position < len(sizes) and sizes[position] == size
+
+
+class ReferenceIndex:
+    """Memory-mapped sorted table of (xxh64 digest, size) for every file in a library.
+
+    Membership checks binary-search the mapped file without loading it, so opening an
+    index of millions of files takes milliseconds. New digests are appended in place
+    and kept in memory until the next compact().
+    """
+
+    def __init__(self, index_path):
+        if sys.byteorder != 'little':
+            raise ValueError("reference indexes can only be mapped on little-endian machines")
+        self.index_path = index_path
+        self.file = open(index_path, 'r+b')
+        magic, self.sorted_count, size_count = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            self.file.close()
+            raise ValueError(f"{index_path} is not a current reference index")
+
+        self.mm = None
+        self.words = None
+        self.size_words = None
+        sizes_start = HEADER.size + self.sorted_count * RECORD.size
+        appended_start = sizes_start + size_count * SIZE.size
+        if self.sorted_count:
+            self.mm = mmap.mmap(self.file.fileno(), appended_start, access=mmap.ACCESS_READ)
+            self.words = memoryview(self.mm)[HEADER.size:sizes_start].cast('Q')
+            self.size_words = memoryview(self.mm)[sizes_start:appended_start].cast('Q')
+        self.digests = _SortedDigests(self.words, self.sorted_count)
+
+        # Records appended since the last compaction
+        self.appended = {}
+        self.appended_sizes = set()
+        self.file.seek(appended_start)
+        while record := self.file.read(RECORD.size):
+            if len(record) < RECORD.size:
+                break
+            digest, size = RECORD.unpack(record)
+            self.appended[digest] = size
+            self.appended_sizes.add(size)
+        self.file.seek(appended_start + len(self.appended) * RECORD.size)
+        self.file.truncate()
+
+    def __len__(self):
+        return self.sorted_count + len(self.appended)
+
+    def _find(self, digest):
+        index = bisect.bisect_left(self.digests, digest)
+        return index if index < self.sorted_count and self.digests[index] == digest else -1
+
+    def __contains__(self, file_hash):
+        """Check a hexdigest (or integer digest) against the index."""
+        digest = file_hash if isinstance(file_hash, int) else digest_to_int(file_hash)
+        if digest is None:
+            return False
+        return digest in self.appended or self._find(digest) >= 0
+
+    def sizes(self):
+        """Return a set-like view of the file sizes in the index, read from its stored size table."""
+        return _IndexSizes(self)
+
+    def add(self, file_hash, size):
+        """Append a digest to the index file unless it's already there."""
+        digest = file_hash if isinstance(file_hash, int) else digest_to_int(file_hash)
+        if digest is None or digest in self:
+            return
+        self.file.write(RECORD.pack(digest, size))
+        self.file.flush()
+        self.appended[digest] = size
+        self.appended_sizes.add(size)
+
+    def compact(self):
+        """Rewrite the index with every record sorted, if enough records were appended."""
+        if len(self.appended) <= COMPACT_RATIO * max(self.sorted_count, 1):
+            return
+        records = dict(self.appended)
+        if self.sorted_count:
+            records.update(zip(self.words[0::2], self.words[1::2]))
+        self.close()
+        write_reference_index(self.index_path, records.items())
+        self.__init__(self.index_path)
+
+    def close(self):
+        if self.words is not None:
+            self.words.release()
+            self.size_words.release()
+            self.words = None
+            self.size_words = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+
+
+def add_moved_file(reference_index, file_hash, path, calculate_hash):
+    """Add a file moved into the indexed library, hashing it first if its key isn't a full digest.
+
+    calculate_hash(path) should return None on errors, in which case the file is skipped.
+    """
+    if digest_to_int(file_hash) is None:
+        # Proven unique by size or sample, so it was never fully hashed
+        file_hash = calculate_hash(path)
+    if file_hash:
+        reference_index.add(file_hash, os.stat(path).st_size)
+
+
+def write_reference_index(index_path, records):
+    """Atomically write a sorted index from (digest, size) pairs; digests may be hex or int."""
+    table = {}
+    for file_hash, size in records:
+        digest = file_hash if isinstance(file_hash, int) else digest_to_int(file_hash)
+        if digest is not None:
+            table[digest] = size
+
+    columns = array('Q')
+    for digest in sorted(table):
+        columns.append(digest)
+        columns.append(table[digest])
+    sizes = array('Q', sorted(set(table.values())))
+    if columns.itemsize != 8:
+        raise RuntimeError("array('Q') is not 64 bits on this platform")
+    if sys.byteorder != 'little':
+        columns.byteswap()
+        sizes.byteswap()
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(table), len(sizes)))
+        columns.tofile(f)
+        sizes.tofile(f)
+    os.replace(tmp_path, index_path)
+
+
+def open_reference_index(index_path):
+    """Open an existing reference index, or return None if there isn't a usable one."""
+    try:
+        return ReferenceIndex(index_path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable reference index {index_path}: {e}")
+        return None
+
+
+def default_index_path(root_dir):
+    """Return where the reference index of a library is kept, named after the library's path."""
+    name = os.path.abspath(root_dir).strip(os.sep).replace(os.sep, '__') or 'root'
+    return os.path.join(INDEX_DIR, f"{name}.idx")
+
+
+def refresh_reference_index(root_dir, index_path, predicate, calculate_hash, prune=None):
+    """Open the reference index of root_dir, rewriting it first if anything below root_dir changed.
+
+    Changes are found by rescanning root_dir against its incremental scan snapshot, which
+    only lists directories whose mtime changed, and only new or modified files are hashed.
+    The index is rewritten from the snapshot when the rescan finds a change, when the
+    snapshot was refreshed by another script since the index was written, or when the
+    index is missing, so changes made to root_dir by other scripts never leave it stale.
+    calculate_hash is called as calculate_hash(path, st) and should return None on errors.
+    """
+    walk_stats = new_walk_stats()
+    old_snapshot = load_snapshot(root_dir)
+    snapshot, delta = rescan_snapshot(root_dir, old_snapshot, predicate, prune, walk_stats)
+    print_walk_stats(walk_stats)
+    print(f"{len(delta['added'])} added, {len(delta['modified'])} modified, "
+          f"{len(delta['removed'])} removed since the last scan")
+    hash_delta(snapshot, delta, calculate_hash)
+    save_snapshot(snapshot)
+
+    try:
+        stale = any(delta.values()) or os.stat(index_path).st_mtime_ns < old_snapshot['taken_ns']
+    except FileNotFoundError:
+        stale = True
+    reference_index = None if stale else open_reference_index(index_path)
+    if reference_index is None:
+        write_reference_index(index_path, ((file_hash, size)
+                                           for info in snapshot['dirs'].values()
+                                           for size, _, file_hash in info['files'].values() if file_hash))
+        reference_index = open_reference_index(index_path)
+    return reference_index
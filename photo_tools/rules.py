@@ -0,0 +1,115 @@
+import os
+from photo_tools.metrics import log
+from photo_tools.walker import make_prune, new_walk_stats, print_walk_stats, walk_entries
+
+# Returned by a rule to delete the file
+DELETE = object()
+
+
+def is_under(path, dir_path):
+    """Check if a path is dir_path or somewhere below it."""
+    return path == dir_path or path.startswith(dir_path.rstrip(os.sep) + os.sep)
+
+
+def _mark_with_parents(dirs, dir_path, stop_dir):
+    """Add a directory and its parents up to stop_dir to a set."""
+    while dir_path not in dirs and is_under(dir_path, stop_dir):
+        dirs.add(dir_path)
+        parent = os.path.dirname(dir_path)
+        if parent == dir_path:
+            break
+        dir_path = parent
+
+
+def plan_rules(root_dir, rules, plan, keep_dirs=(), cleanup_dirs=(), prune=None):
+    """Walk root_dir once and plan what an ordered list of (name, rule) pairs does to every file.
+
+    A rule is called with the file's current path and returns None to leave it alone,
+    a new path to move it, or DELETE. Rules run in order, each seeing the path the
+    previous rules moved the file to, so the result is the same as running them one
+    after another; the first DELETE wins. A move whose destination already exists or
+    is taken by an earlier move is dropped and the file stays. Folders
+    left empty by the plan are removed, as are empty folders below cleanup_dirs;
+    keep_dirs and folders holding a pruned folder are never removed.
+    Returns a dict of counts per rule name plus 'conflicts'.
+    """
+    root_dir = os.path.normpath(root_dir)
+    keep_dirs = {os.path.normpath(path) for path in keep_dirs} | {root_dir}
+    cleanup_dirs = [os.path.normpath(path) for path in cleanup_dirs]
+    skip = prune or make_prune()
+    counts = {name: 0 for name, _ in rules}
+    counts['conflicts'] = 0
+    walk_stats = new_walk_stats()
+
+    has_pruned = set()
+
+    def prune_and_track(entry):
+        if skip(entry):
+            has_pruned.add(os.path.dirname(entry.path))
+            return True
+        return False
+
+    moves = []
+    deletes = []
+    # Directories that still hold a file once the plan has run, and ones something left
+    occupied = set()
+    emptied = set()
+    walked_dirs = []
+
+    for dirpath, _, file_entries in walk_entries(root_dir, prune=prune_and_track, topdown=False,
+                                                 stats=walk_stats):
+        walked_dirs.append(dirpath)
+        for entry in file_entries:
+            path = entry.path
+            for name, rule in rules:
+                result = rule(path)
+                if result is None:
+                    continue
+                counts[name] += 1
+                if result is DELETE:
+                    path = None
+                    break
+                path = result
+            if path is None:
+                deletes.append(entry.path)
+                emptied.add(dirpath)
+            elif path != entry.path:
+                moves.append((entry.path, path))
+            else:
+                occupied.add(dirpath)
+
+    claimed = set()
+    planned_moves = []
+    for src, dest in moves:
+        # Never overwrite, even a file that is itself moving away later in the plan
+        if dest in claimed or os.path.lexists(dest):
+            log(f"Conflict, leaving {src} in place: {dest} is already taken")
+            counts['conflicts'] += 1
+            occupied.add(os.path.dirname(src))
+            continue
+        claimed.add(dest)
+        planned_moves.append((src, dest))
+        occupied.add(os.path.dirname(dest))
+        emptied.add(os.path.dirname(src))
+
+    for src, dest in planned_moves:
+        plan.move(src, dest)
+    for path in deletes:
+        plan.delete(path)
+
+    occupied_all = set()
+    for dir_path in occupied | has_pruned:
+        _mark_with_parents(occupied_all, dir_path, root_dir)
+    emptied_all = set()
+    for dir_path in emptied:
+        _mark_with_parents(emptied_all, dir_path, root_dir)
+
+    # walk_entries is bottom-up here, so children are removed before their parents
+    for dir_path in walked_dirs:
+        if dir_path in keep_dirs or dir_path in occupied_all:
+            continue
+        if dir_path in emptied_all or any(is_under(dir_path, path) for path in cleanup_dirs):
+            plan.rmdir(dir_path)
+
+    print_walk_stats(walk_stats)
+    return counts
@@ -0,0 +1,219 @@
+import gzip
+import json
+import os
+import time
+from collections import defaultdict
+from photo_tools.parallel import imap_ordered
+from photo_tools.walker import is_dir_symlink
+
+# Directory holding one snapshot file per scanned root
+SNAPSHOT_DIR = os.path.expanduser('~/.photo_scan_snapshots')
+
+# Directories modified this close to the previous snapshot are always rescanned, since
+# exFAT and HFS+ timestamps are too coarse to tell a later change apart
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+SNAPSHOT_VERSION = 1
+
+
+def snapshot_path(root_dir):
+    """Return the snapshot file used for a root directory."""
+    name = os.path.abspath(root_dir).strip(os.sep).replace(os.sep, '__') or 'root'
+    return os.path.join(SNAPSHOT_DIR, f"{name}.json.gz")
+
+
+def empty_snapshot(root_dir):
+    """Return a snapshot with no directories, so every directory counts as changed."""
+    return {'version': SNAPSHOT_VERSION, 'root': root_dir, 'taken_ns': 0, 'dirs': {}}
+
+
+def load_snapshot(root_dir):
+    """Load the previous snapshot of a root directory, or an empty one if there isn't one."""
+    path = snapshot_path(root_dir)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return empty_snapshot(root_dir)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable snapshot {path}: {e}")
+        return empty_snapshot(root_dir)
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('root') != root_dir:
+        return empty_snapshot(root_dir)
+    return snapshot
+
+
+def save_snapshot(snapshot):
+    """Atomically write a snapshot next to the others."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = snapshot_path(snapshot['root'])
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=3) as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def files_by_hash_from_snapshot(snapshot):
+    """Build a files_by_hash dict from the file hashes recorded in a snapshot."""
+    files_by_hash = defaultdict(list)
+    for dirpath, info in snapshot['dirs'].items():
+        for name, (_, _, file_hash) in info['files'].items():
+            if file_hash:
+                files_by_hash[file_hash].append(os.path.join(dirpath, name))
+    return files_by_hash
+
+
+def _forget_tree(old_dirs, dirpath, delta):
+    """Record every file below a directory that disappeared as removed."""
+    stack = [dirpath]
+    while stack:
+        dirpath = stack.pop()
+        info = old_dirs.get(dirpath)
+        if info is None:
+            continue
+        for name, (_, _, file_hash) in info['files'].items():
+            delta['removed'].append((os.path.join(dirpath, name), file_hash))
+        stack.extend(os.path.join(dirpath, subdir) for subdir in info['subdirs'])
+
+
+def rescan_snapshot(root_dir, snapshot, predicate, prune=None, stats=None):
+    """Rescan a root against its previous snapshot, only listing directories whose mtime changed.
+
+    Unchanged directories are checked with a single stat and their recorded entries are
+    reused. Returns (new_snapshot, delta) where delta holds an 'added' list of
+    (path, stat_result) and a 'modified' list of (path, stat_result, old_hash) that
+    still need hashing, and a 'removed' list of (path, old_hash). Files edited in place
+    without touching their directory are only noticed when that directory is rescanned.
+    """
+    old_dirs = snapshot['dirs']
+    new_dirs = {}
+    delta = {'added': [], 'modified': [], 'removed': []}
+    taken_ns = time.time_ns()
+    racy_after = snapshot['taken_ns'] - RACY_WINDOW_NS
+
+    stack = [root_dir]
+    while stack:
+        dirpath = stack.pop()
+        old = old_dirs.get(dirpath)
+        try:
+            if stats is not None:
+                stats['stat_calls'] += 1
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            if stats is not None:
+                stats['errors'] += 1
+            if old is not None:
+                _forget_tree(old_dirs, dirpath, delta)
+            continue
+        if stats is not None:
+            stats['dirs'] += 1
+
+        unhashed = old is not None and any(file_hash is None for _, _, file_hash in old['files'].values())
+        if old is not None and old['mtime_ns'] == mtime_ns and mtime_ns < racy_after and not unhashed:
+            # Unchanged directory, reuse its recorded entries without listing it
+            new_dirs[dirpath] = old
+            stack.extend(os.path.join(dirpath, subdir) for subdir in old['subdirs'])
+            continue
+
+        subdirs = []
+        files = {}
+        old_files = old['files'] if old is not None else {}
+        try:
+            if stats is not None:
+                stats['scandir_calls'] += 1
+            with os.scandir(dirpath) as it:
+                entries = list(it)
+        except OSError:
+            if stats is not None:
+                stats['errors'] += 1
+            if old is not None:
+                _forget_tree(old_dirs, dirpath, delta)
+            continue
+
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if prune is not None and prune(entry):
+                    if stats is not None:
+                        stats['pruned'] += 1
+                    continue
+                subdirs.append(entry.name)
+                continue
+            if not predicate(entry.name) or is_dir_symlink(entry, stats):
+                continue
+            try:
+                if stats is not None:
+                    stats['stat_calls'] += 1
+                st = entry.stat()
+            except OSError:
+                continue
+            if stats is not None:
+                stats['files'] += 1
+            previous = old_files.get(entry.name)
+            if previous is None:
+                delta['added'].append((entry.path, st))
+                files[entry.name] = [st.st_size, st.st_mtime_ns, None]
+            elif previous[:2] != [st.st_size, st.st_mtime_ns] or previous[2] is None:
+                delta['modified'].append((entry.path, st, previous[2]))
+                files[entry.name] = [st.st_size, st.st_mtime_ns, None]
+            else:
+                files[entry.name] = previous
+
+        for name, (_, _, file_hash) in old_files.items():
+            if name not in files:
+                delta['removed'].append((os.path.join(dirpath, name), file_hash))
+        if old is not None:
+            for subdir in old['subdirs']:
+                if subdir not in subdirs:
+                    _forget_tree(old_dirs, os.path.join(dirpath, subdir), delta)
+
+        subdirs.sort()
+        new_dirs[dirpath] = {'mtime_ns': mtime_ns, 'subdirs': subdirs, 'files': files}
+        stack.extend(os.path.join(dirpath, subdir) for subdir in reversed(subdirs))
+
+    new_snapshot = {'version': SNAPSHOT_VERSION, 'root': root_dir, 'taken_ns': taken_ns, 'dirs': new_dirs}
+    return new_snapshot, delta
+
+
+def hash_delta(snapshot, delta, calculate_hash):
+    """Hash the added and modified files of a delta and record the hashes in the snapshot.
+
+    calculate_hash is called as calculate_hash(path, st) and should return None on errors;
+    those files stay unhashed and are retried on the next rescan.
+    """
+    to_hash = [(path, st) for path, st in delta['added']]
+    to_hash += [(path, st) for path, st, _ in delta['modified']]
+    hashes = {}
+    results = imap_ordered(lambda item: calculate_hash(*item), to_hash, device=lambda item: item[1].st_dev)
+    for (path, _), file_hash in results:
+        hashes[path] = file_hash
+        dirpath, name = os.path.split(path)
+        snapshot['dirs'][dirpath]['files'][name][2] = file_hash
+    return hashes
+
+
+def apply_delta(files_by_hash, delta, hashes):
+    """Update a files_by_hash dict in place from a rescan delta and the new hashes."""
+    for path, old_hash in delta['removed']:
+        _discard(files_by_hash, old_hash, path)
+    for path, _, old_hash in delta['modified']:
+        _discard(files_by_hash, old_hash, path)
+    for path, file_hash in hashes.items():
+        if file_hash:
+            files_by_hash[file_hash].append(path)
+    return files_by_hash
+
+
+def _discard(files_by_hash, file_hash, path):
+    paths = files_by_hash.get(file_hash)
+    if not paths:
+        return
+    try:
+        paths.remove(path)
+    except ValueError:
+        return
+    if not paths:
+        del files_by_hash[file_hash]
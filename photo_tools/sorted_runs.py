@@ -0,0 +1,97 @@
+import heapq
+import itertools
+import json
+import os
+
+# Records held in memory before they are sorted and written out as one run
+RUN_RECORDS = 500000
+
+# Maximum number of runs read at once; more runs are first merged into longer ones
+MERGE_FAN_IN = 64
+
+
+def _write_run(records, run_path):
+    records.sort()
+    with open(run_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    records.clear()
+    return run_path
+
+
+def read_run(run_path):
+    """Stream the (digest, size, path, ...) records of a run file."""
+    with open(run_path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def iter_sorted(run_paths):
+    """Stream the records of several run files as one sorted sequence."""
+    return heapq.merge(*(read_run(run_path) for run_path in run_paths))
+
+
+def sort_into_runs(records, work_dir, run_records=RUN_RECORDS):
+    """Write a stream of (digest, size, path, ...) records to sorted run files, returning their paths.
+
+    At most run_records records are held in memory; each batch is sorted and written
+    to its own run in work_dir. Records without a digest (files that failed to hash)
+    are dropped. If there are more than MERGE_FAN_IN runs they are merged into longer
+    runs, so reading them back never holds more than MERGE_FAN_IN files open.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    run_paths = []
+    batch = []
+    for record in records:
+        if record[0] is None:
+            continue
+        batch.append(tuple(record))
+        if len(batch) >= run_records:
+            run_paths.append(_write_run(batch, os.path.join(work_dir, f"run-{len(run_paths)}.jsonl")))
+    if batch or not run_paths:
+        run_paths.append(_write_run(batch, os.path.join(work_dir, f"run-{len(run_paths)}.jsonl")))
+
+    generation = 0
+    while len(run_paths) > MERGE_FAN_IN:
+        generation += 1
+        merged = []
+        for start in range(0, len(run_paths), MERGE_FAN_IN):
+            group = run_paths[start:start + MERGE_FAN_IN]
+            merged_path = os.path.join(work_dir, f"merged-{generation}-{len(merged)}.jsonl")
+            with open(merged_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                for record in iter_sorted(group):
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            for run_path in group:
+                os.unlink(run_path)
+            merged.append(merged_path)
+        run_paths = merged
+    return run_paths
+
+
+def _digest_groups(records):
+    for digest, group in itertools.groupby(records, key=lambda record: record[0]):
+        yield digest, list(group)
+
+
+def merge_join(left_runs, right_runs):
+    """Stream two sorted sides and yield (digest, left_records, right_records) for every digest.
+
+    One of the record lists is empty for a digest found on only one side. Both sides
+    are read in a single sorted pass, so memory holds one digest group per side rather
+    than either library.
+    """
+    left = _digest_groups(iter_sorted(left_runs))
+    right = _digest_groups(iter_sorted(right_runs))
+    left_group = next(left, None)
+    right_group = next(right, None)
+    while left_group is not None or right_group is not None:
+        if right_group is None or (left_group is not None and left_group[0] < right_group[0]):
+            yield left_group[0], left_group[1], []
+            left_group = next(left, None)
+        elif left_group is None or right_group[0] < left_group[0]:
+            yield right_group[0], [], right_group[1]
+            right_group = next(right, None)
+        else:
+            yield left_group[0], left_group[1], right_group[1]
+            left_group = next(left, None)
+            right_group = next(right, None)
@@ -0,0 +1,251 @@
+import os
+import struct
+import sys
+import xxhash
+from array import array
+from photo_tools.file_groups import FileGroups
+from photo_tools.hash_cache import get_hash_cache
+from photo_tools.metrics import get_metrics, log_error
+from photo_tools.parallel import imap_ordered, path_device
+
+# Containers made of ISO base media boxes (QuickTime atoms), the only ones the fingerprint parses
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.m4v', '.3gp'}
+
+# Key frames hashed from the start of the video track
+FRAME_SAMPLES = 3
+
+# Bytes hashed from the start of each sampled key frame
+FRAME_BYTES = 64 * 1024
+
+# Videos whose moov box is bigger than this are not fingerprinted
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# Boxes that only hold other boxes, on the way from moov to the sample tables
+CONTAINER_BOXES = {b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def is_video(path):
+    """Check if a path is a video the fingerprint can parse."""
+    return os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def _box_size(size, header, offset, end):
+    """Resolve the 32-bit size field of a box header, returning (size, header size)."""
+    if size == 1:
+        return struct.unpack_from('>Q', header, offset + 8)[0], 16
+    if size == 0:
+        return end - offset, 8
+    return size, 8
+
+
+def iter_boxes(data, start, end):
+    """Yield (type, body start, body end) for the boxes in data[start:end]."""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        size, header_size = _box_size(size, data, offset, end)
+        if size < header_size or offset + size > end:
+            raise ValueError(f"corrupt {box_type!r} box at offset {offset}")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def iter_file_boxes(f, start, end):
+    """Yield (type, body start, box end) for the boxes of a file between start and end, reading only their headers."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack_from('>I4s', header)
+        size, header_size = _box_size(size, header, 0, end - offset)
+        if size < header_size:
+            raise ValueError(f"corrupt {box_type!r} box at offset {offset}")
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def read_moov(f, file_size):
+    """Find the moov box by reading only top-level box headers, returning its bytes."""
+    for box_type, body, box_end in iter_file_boxes(f, 0, file_size):
+        if box_type == b'moov':
+            if box_end - body > MAX_MOOV_SIZE:
+                raise ValueError(f"moov box of {box_end - body} bytes is too big")
+            f.seek(body)
+            return f.read(box_end - body)
+    raise ValueError("no moov box")
+
+
+def _uint_array(data, start, count, typecode):
+    values = array(typecode, data[start:start + count * array(typecode).itemsize])
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+
+def _parse_track(data, start, end, track):
+    for box_type, body, box_end in iter_boxes(data, start, end):
+        if box_type in CONTAINER_BOXES:
+            _parse_track(data, body, box_end, track)
+        elif box_type == b'tkhd':
+            width_offset = body + (88 if data[body] == 1 else 76)
+            track['width'], track['height'] = struct.unpack_from('>II', data, width_offset)
+        elif box_type == b'mdhd':
+            if data[body] == 1:
+                track['timescale'], track['duration'] = struct.unpack_from('>IQ', data, body + 20)
+            else:
+                track['timescale'], track['duration'] = struct.unpack_from('>II', data, body + 12)
+        elif box_type == b'hdlr':
+            track['handler'] = data[body + 8:body + 12]
+        elif box_type == b'stsd':
+            track['codec'] = data[body + 12:body + 16]
+        elif box_type == b'stsz':
+            sample_size, count = struct.unpack_from('>II', data, body + 4)
+            track['sample_count'] = count
+            track['sample_sizes'] = sample_size or _uint_array(data, body + 12, count, 'I')
+        elif box_type in (b'stco', b'co64'):
+            count = struct.unpack_from('>I', data, body + 4)[0]
+            track['chunk_offsets'] = _uint_array(data, body + 8, count, 'I' if box_type == b'stco' else 'Q')
+        elif box_type == b'stsc':
+            count = struct.unpack_from('>I', data, body + 4)[0]
+            entries = _uint_array(data, body + 8, count * 3, 'I')
+            track['sample_to_chunk'] = [(entries[i], entries[i + 1]) for i in range(0, len(entries), 3)]
+        elif box_type == b'stss':
+            count = struct.unpack_from('>I', data, body + 4)[0]
+            track['sync_samples'] = _uint_array(data, body + 8, count, 'I')
+
+
+def parse_moov(moov):
+    """Parse a moov box into its movie header fields and a dict per track."""
+    info = {'tracks': []}
+    for box_type, body, box_end in iter_boxes(moov, 0, len(moov)):
+        if box_type == b'mvhd':
+            if moov[body] == 1:
+                info['creation_time'], _, info['timescale'], info['duration'] = \
+                    struct.unpack_from('>QQIQ', moov, body + 4)
+            else:
+                info['creation_time'], _, info['timescale'], info['duration'] = \
+                    struct.unpack_from('>IIII', moov, body + 4)
+        elif box_type == b'trak':
+            track = {}
+            _parse_track(moov, body, box_end, track)
+            info['tracks'].append(track)
+    return info
+
+
+def sample_location(track, index):
+    """Return (offset, size) of a sample of a track, from its chunk and sample tables."""
+    sizes = track['sample_sizes']
+    chunk_offsets = track['chunk_offsets']
+    runs = track['sample_to_chunk']
+
+    def size_of(sample):
+        return sizes if isinstance(sizes, int) else sizes[sample]
+
+    first_sample = 0
+    for run, (first_chunk, per_chunk) in enumerate(runs):
+        last_chunk = runs[run + 1][0] - 1 if run + 1 < len(runs) else len(chunk_offsets)
+        run_samples = (last_chunk - first_chunk + 1) * per_chunk
+        if index < first_sample + run_samples:
+            chunk = first_chunk + (index - first_sample) // per_chunk
+            first_in_chunk = index - (index - first_sample) % per_chunk
+            offset = chunk_offsets[chunk - 1] + sum(size_of(sample) for sample in range(first_in_chunk, index))
+            return offset, size_of(index)
+        first_sample += run_samples
+    raise ValueError(f"sample {index} is not in any chunk")
+
+
+def calculate_fingerprint(file_path):
+    """Fingerprint a video from its container and a few key frames, or None if none of its frames could be read.
+
+    Only the top-level box headers, the moov box and the first FRAME_BYTES of the
+    first FRAME_SAMPLES key frames are read. The fingerprint covers the codec, the
+    frame size and those key frames, which survive re-muxing into another container
+    layout and trimming the end of the video; duration and creation time don't, so
+    they are left out.
+    """
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        moov = read_moov(f, file_size)
+        bytes_read = len(moov)
+        info = parse_moov(moov)
+        track = next((track for track in info['tracks'] if track.get('handler') == b'vide'), None)
+        if track is None or not track.get('sample_count') or 'chunk_offsets' not in track:
+            return None
+
+        hash_xx = xxhash.xxh64()
+        hash_xx.update(track.get('codec', b''))
+        hash_xx.update(struct.pack('>II', track.get('width', 0), track.get('height', 0)))
+        sync_samples = track.get('sync_samples')
+        if sync_samples:
+            frames = [sample - 1 for sample in sync_samples[:FRAME_SAMPLES]]
+        else:
+            # Without a sync sample table, or with an empty one, every sample is a key frame
+            frames = range(min(FRAME_SAMPLES, track['sample_count']))
+        frames_hashed = 0
+        for frame in frames:
+            offset, size = sample_location(track, frame)
+            f.seek(offset)
+            data = f.read(min(size, FRAME_BYTES))
+            bytes_read += len(data)
+            hash_xx.update(struct.pack('>Q', size))
+            hash_xx.update(data)
+            frames_hashed += bool(data)
+    metrics = get_metrics()
+    metrics.add('video_bytes_read', bytes_read)
+    metrics.add('video_bytes_total', file_size)
+    # The codec and frame size alone would match every video shot on the same camera
+    if not frames_hashed:
+        return None
+    return hash_xx.hexdigest()
+
+
+def fingerprint_file(file_path):
+    """Calculate the fingerprint of a video, reusing the persistent hash cache. Returns None on errors."""
+    try:
+        cache = get_hash_cache()
+        if cache is None:
+            return calculate_fingerprint(file_path)
+        st = os.stat(file_path)
+        cached = cache.lookup(file_path, st, 'video_fingerprint')
+        if cached is not None:
+            return cached or None
+        fingerprint = calculate_fingerprint(file_path)
+        # An empty string records that the video has no video track
+        cache.store(file_path, st, fingerprint or '', 'video_fingerprint')
+        return fingerprint
+    except Exception as e:
+        log_error(f"Error reading video {file_path}: {e}")
+        return None
+
+
+def merge_video_duplicates(files_by_hash):
+    """Merge groups of files_by_hash holding the same video into 'video:' groups.
+
+    One video per exact group is fingerprinted. Groups sharing a fingerprint get a
+    'video:<fingerprint>' key and everything else keeps its exact key.
+    """
+    representatives = []
+    for file_hash, paths in files_by_hash.items():
+        video_path = next((path for path in paths if is_video(path)), None)
+        if video_path is not None:
+            representatives.append((file_hash, video_path))
+
+    groups_by_fingerprint = {}
+    results = imap_ordered(lambda item: fingerprint_file(item[1]), representatives,
+                           device=path_device(lambda item: item[1]))
+    for (file_hash, _), fingerprint in results:
+        if fingerprint is not None:
+            groups_by_fingerprint.setdefault(fingerprint, []).append(file_hash)
+
+    video_keys = {}
+    for fingerprint, file_hashes in groups_by_fingerprint.items():
+        if len(file_hashes) > 1:
+            for file_hash in file_hashes:
+                video_keys[file_hash] = f"video:{fingerprint}"
+
+    merged = FileGroups()
+    for file_hash, path, size in files_by_hash.rows():
+        merged.add(video_keys.get(file_hash, file_hash), path, size)
+    return merged
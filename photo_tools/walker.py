@@ -0,0 +1,150 @@
+import os
+from photo_tools.metrics import get_metrics
+
+# macOS system folders that are never worth descending into
+PROTECTED_FOLDERS = {'.Spotlight-V100', '.Trashes', '.fseventsd', '.TemporaryItems'}
+
+
+def new_walk_stats():
+    """Return a fresh counter of directories, files and syscalls made by a walk."""
+    return {
+        'dirs': 0,
+        'files': 0,
+        'pruned': 0,
+        'scandir_calls': 0,
+        'stat_calls': 0,
+        'errors': 0,
+    }
+
+
+def print_walk_stats(stats):
+    """Print the directory, file and syscall counts of a walk, and add them to the run's metrics."""
+    metrics = get_metrics()
+    for key, value in stats.items():
+        metrics.add(f"walk_{key}", value)
+    metrics.add('syscalls', stats['scandir_calls'] + stats['stat_calls'])
+    print(f"Walked {stats['dirs']} directories and {stats['files']} files "
+          f"({stats['pruned']} directories pruned, {stats['errors']} unreadable): "
+          f"{stats['scandir_calls']} scandir calls, {stats['stat_calls']} stat calls")
+
+
+def make_prune(names=PROTECTED_FOLDERS, paths=(), name_contains=(), pattern=None):
+    """Build a prune rule for walk_entries.
+
+    A directory is pruned when its name is in names, its path is one of paths (or
+    below one), its lowercased name contains any of name_contains, or its name
+    matches the compiled regex pattern.
+    """
+    names = set(names)
+    paths = [os.path.normpath(path) for path in paths]
+    name_contains = [text.lower() for text in name_contains]
+
+    def prune(entry):
+        if entry.name in names:
+            return True
+        if pattern is not None and pattern.match(entry.name):
+            return True
+        lowered = entry.name.lower()
+        if any(text in lowered for text in name_contains):
+            return True
+        entry_path = os.path.normpath(entry.path)
+        return any(entry_path == path or entry_path.startswith(path + os.sep) for path in paths)
+
+    return prune
+
+
+def entry_stat(entry, stats=None):
+    """Return the stat result of a DirEntry, counting the syscall it costs in stats, or in the run's metrics.
+
+    DirEntry caches the result, so later entry.stat() calls on the same entry are free.
+    """
+    if stats is not None:
+        stats['stat_calls'] += 1
+    else:
+        get_metrics().add('syscalls')
+    return entry.stat()
+
+
+def is_dir_symlink(entry, stats=None):
+    """Return whether a DirEntry is a symlink to a directory, counting the stat it costs to follow the link."""
+    try:
+        if not entry.is_symlink():
+            return False
+        if stats is not None:
+            stats['stat_calls'] += 1
+        return entry.is_dir()
+    except OSError:
+        return False
+
+
+def walk_entries(root_dir, prune=None, topdown=True, stats=None):
+    """Walk a tree with os.scandir, yielding (dirpath, dir_entries, file_entries) like os.walk.
+
+    Entries are os.DirEntry objects, so type checks reuse the information returned by
+    the directory listing and stat results are cached on the entry. Directories for
+    which prune(entry) is true are never listed. With topdown=True the caller may
+    remove entries from dir_entries to stop the walk from descending into them.
+    Symlinks to directories are neither followed nor listed as files. Unreadable
+    directories are skipped and counted as errors.
+    """
+    if stats is None:
+        stats = new_walk_stats()
+
+    stack = [root_dir]
+    while stack:
+        dirpath = stack.pop()
+        if isinstance(dirpath, tuple):
+            # Bottom-up: all children have been yielded, now yield the parent
+            yield dirpath[1]
+            continue
+
+        dir_entries = []
+        file_entries = []
+        try:
+            stats['scandir_calls'] += 1
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if prune is not None and prune(entry):
+                            stats['pruned'] += 1
+                            continue
+                        dir_entries.append(entry)
+                    elif not is_dir_symlink(entry, stats):
+                        file_entries.append(entry)
+        except OSError:
+            stats['errors'] += 1
+            continue
+
+        stats['dirs'] += 1
+        stats['files'] += len(file_entries)
+        dir_entries.sort(key=lambda entry: entry.name)
+        file_entries.sort(key=lambda entry: entry.name)
+
+        if topdown:
+            yield dirpath, dir_entries, file_entries
+            stack.extend(entry.path for entry in reversed(dir_entries))
+        else:
+            stack.append(('after', (dirpath, dir_entries, file_entries)))
+            stack.extend(entry.path for entry in reversed(dir_entries))
+
+
+def iter_file_entries(root_dir, predicate=None, prune=None, stats=None, with_stat=False):
+    """Yield the DirEntry of every file below root_dir whose name passes predicate.
+
+    With with_stat, every entry is stat'ed through entry_stat before it is yielded, so
+    the call is counted on the walking thread and entry.stat() is free for the consumer.
+    """
+    for _, _, file_entries in walk_entries(root_dir, prune=prune, stats=stats):
+        for entry in file_entries:
+            if predicate is None or predicate(entry.name):
+                if with_stat:
+                    try:
+                        entry_stat(entry, stats)
+                    except OSError:
+                        # Left for the consumer's own entry.stat() to report
+                        pass
+                yield entry
@@ -0,0 +1,279 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from photo_tools.hash_cache import flush_hash_cache
+from photo_tools.metrics import get_metrics, log
+from photo_tools.snapshot import empty_snapshot, rescan_snapshot
+from photo_tools.walker import entry_stat, iter_file_entries, walk_entries
+
+# Seconds a new file's size and mtime must stay the same before it counts as fully written
+SETTLE_SECONDS = float(os.environ.get('PHOTO_WATCH_SETTLE', 5))
+
+# Seconds a file seen being created but never closed must stay the same, e.g. a hard link
+# or a file its writer holds open between bursts
+UNCLOSED_SETTLE_SECONDS = 60
+
+# Seconds between rescans when inotify isn't available, e.g. on macOS or network mounts
+POLL_INTERVAL = float(os.environ.get('PHOTO_WATCH_POLL_INTERVAL', 10))
+
+# Rescan instead of using inotify, for mounts where other machines write (SMB, NFS)
+FORCE_POLLING = os.environ.get('PHOTO_WATCH_POLLING', '') not in ('', '0')
+
+# Seconds between checks of files that are still settling
+SETTLE_TICK = 1.0
+
+# inotify event bits, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+EVENT = struct.Struct('iIII')
+EVENT_BUFFER_SIZE = 64 * 1024
+
+
+class Inotify:
+    """Recursive-by-hand inotify watches on directories, through libc."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError("this platform has no inotify")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        # Watch descriptor -> directory path
+        self.dirs = {}
+
+    def add_watch(self, dir_path):
+        wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), dir_path)
+        self.dirs[wd] = dir_path
+
+    def remove_tree(self, dir_path):
+        """Stop watching a directory and everything below it, e.g. after it was moved away."""
+        prefix = dir_path + os.sep
+        for wd, path in list(self.dirs.items()):
+            if path == dir_path or path.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read_events(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) and return a list of (mask, path)."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, EVENT_BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0'))
+            offset += EVENT.size + length
+            dir_path = self.dirs.get(wd)
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            if mask & IN_Q_OVERFLOW:
+                events.append((mask, None))
+            elif dir_path is not None:
+                events.append((mask, os.path.join(dir_path, name) if name else dir_path))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SettlingFiles:
+    """Files that changed recently, each held until it looks fully written.
+
+    A file is settled once its size and mtime have stayed the same for SETTLE_SECONDS
+    and, for files seen being created through inotify, its writer has closed it (or
+    UNCLOSED_SETTLE_SECONDS have passed without a close).
+    """
+
+    def __init__(self):
+        # Path -> [size, mtime_ns, unchanged since, closed]
+        self.files = {}
+
+    def __len__(self):
+        return len(self.files)
+
+    def touch(self, path, closed=True):
+        state = self.files.get(path)
+        if state is None:
+            self.files[path] = [None, None, 0.0, closed]
+        else:
+            state[3] = closed
+
+    def discard(self, path):
+        self.files.pop(path, None)
+
+    def pop_settled(self):
+        """Stat every settling file, returning and forgetting the ones that have settled."""
+        now = time.monotonic()
+        settled = []
+        for path, state in list(self.files.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.files[path]
+                continue
+            except OSError:
+                continue
+            if state[0] != st.st_size or state[1] != st.st_mtime_ns:
+                state[0], state[1], state[2] = st.st_size, st.st_mtime_ns, now
+            elif now - state[2] >= (SETTLE_SECONDS if state[3] else UNCLOSED_SETTLE_SECONDS):
+                settled.append(path)
+                del self.files[path]
+        return settled
+
+
+def _eligible(predicate):
+    # Dot files are AppleDouble sidecars or the temp files of rsync and browsers, which get renamed when done
+    return lambda name: not name.startswith('.') and (predicate is None or predicate(name))
+
+
+def watch_new_files(root_dir, handle, predicate=None, prune=None):
+    """Call handle(paths) with each batch of files written below root_dir, once they have settled.
+
+    Files already there when the watch starts are handled first. inotify is used where
+    the platform has it, so an idle watch costs no CPU; otherwise root_dir is rescanned
+    every POLL_INTERVAL seconds, which only lists directories whose mtime changed. Files
+    handled and left in place are not handled again unless they change; when polling,
+    a file rewritten in place is only seen once something else changes its directory.
+    Runs until interrupted.
+    """
+    eligible = _eligible(predicate)
+    inotify = None
+    if not FORCE_POLLING:
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            print(f"inotify is not available ({e}), rescanning every {POLL_INTERVAL:g} seconds instead")
+    if inotify is None:
+        _poll(root_dir, handle, eligible, prune)
+        return
+    try:
+        _watch_inotify(inotify, root_dir, handle, eligible, prune)
+    finally:
+        inotify.close()
+
+
+def _watch_inotify(inotify, root_dir, handle, eligible, prune):
+    settling = SettlingFiles()
+    # Path -> (size, mtime_ns) of files handled but left in place
+    handled = {}
+    metrics = get_metrics()
+
+    def scan(dir_path):
+        # Watch every directory first, so nothing written during the listing below is missed
+        for dirpath, _, _ in walk_entries(dir_path, prune=prune):
+            try:
+                inotify.add_watch(dirpath)
+            except OSError as e:
+                log(f"Can't watch {dirpath}: {e}")
+        for entry in iter_file_entries(dir_path, eligible, prune=prune):
+            try:
+                st = entry_stat(entry)
+            except OSError:
+                continue
+            if handled.get(entry.path) != (st.st_size, st.st_mtime_ns):
+                settling.touch(entry.path)
+
+    print(f"Watching {root_dir} with inotify")
+    scan(root_dir)
+    while True:
+        if not inotify.dirs:
+            # The watched directory is gone, e.g. its drive was ejected
+            flush_hash_cache()
+            time.sleep(POLL_INTERVAL)
+            if os.path.isdir(root_dir):
+                print(f"{root_dir} is back, watching it again")
+                scan(root_dir)
+            continue
+
+        if not settling:
+            # Nothing left to handle, so nothing hashed waits in memory while the watch sleeps
+            flush_hash_cache()
+        for mask, path in inotify.read_events(SETTLE_TICK if settling else None):
+            metrics.add('watch_events')
+            if mask & IN_Q_OVERFLOW:
+                log(f"Missed some changes, rescanning {root_dir}")
+                scan(root_dir)
+            elif mask & IN_UNMOUNT:
+                inotify.remove_tree(root_dir)
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if prune is None or not prune(_DirName(path)):
+                        scan(path)
+                elif mask & IN_MOVED_FROM:
+                    inotify.remove_tree(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                settling.discard(path)
+                handled.pop(path, None)
+            elif eligible(os.path.basename(path)):
+                settling.touch(path, closed=not (mask & IN_CREATE))
+
+        settled = settling.pop_settled()
+        if settled:
+            metrics.add('watch_files_settled', len(settled))
+            handle(settled)
+            for path in settled:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                handled[path] = (st.st_size, st.st_mtime_ns)
+
+
+class _DirName:
+    """Stand-in for the DirEntry a prune rule expects, for a directory reported by inotify."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+
+def _poll(root_dir, handle, eligible, prune):
+    settling = SettlingFiles()
+    snapshot = empty_snapshot(root_dir)
+    metrics = get_metrics()
+    print(f"Watching {root_dir} by rescanning it")
+    while True:
+        snapshot, delta = rescan_snapshot(root_dir, snapshot, eligible, prune)
+        for path, _ in delta['added']:
+            settling.touch(path)
+        for path, _, _ in delta['modified']:
+            settling.touch(path)
+
+        settled = settling.pop_settled()
+        if settled:
+            metrics.add('watch_files_settled', len(settled))
+            handle(settled)
+            for path in settled:
+                dirpath, name = os.path.split(path)
+                entry = snapshot['dirs'].get(dirpath, {}).get('files', {}).get(name)
+                if entry is not None:
+                    # Not a hash, but no longer None, so the directory isn't relisted for this file
+                    entry[2] = ''
+        if not settling:
+            flush_hash_cache()
+        time.sleep(SETTLE_TICK if settling else POLL_INTERVAL)
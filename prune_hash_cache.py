@@ -0,0 +1,24 @@
+from photo_tools.hash_cache import get_hash_cache
+
+# Drop cache rows that haven't been hashed or looked up in this many days
+MAX_AGE_DAYS = 365
+
+
+def main():
+    cache = get_hash_cache()
+    if cache is None:
+        print("Hash cache is disabled (PHOTO_HASH_CACHE is empty).")
+        return
+
+    print(f"Pruning hash cache at '{cache.db_path}'...")
+    removed = cache.prune_missing()
+    print(f"Removed {removed} rows for deleted or changed files.")
+
+    removed = cache.evict_unseen(MAX_AGE_DAYS)
+    print(f"Removed {removed} rows not seen in {MAX_AGE_DAYS} days.")
+
+    print("\nOperation complete!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 import shutil
 import re
+from photo_tools.metrics import log, log_error
 
 # Base directory containing the photo folders
 PHOTOS_DIR = '/Volumes/Photo backup/photos'
@@ -8,6 +9,9 @@ PHOTOS_DIR = '/Volumes/Photo backup/photos'
 # Valid year range
 VALID_YEAR_RANGE = range(1990, 2025)
 
+# Regex to match names like 'December 2012', 'christmas 2007', 'feb 2003'
+EVENT_YEAR_PATTERN = re.compile(r'^(.+?)\s*(\d{4})$', re.IGNORECASE)
+
 
 def format_folder_name(name):
     """Format the folder name by converting it to lowercase and removing extra spaces."""
@@ -23,8 +27,7 @@ def move_folders_by_year(base_dir):
         if not os.path.isdir(folder_path):
             continue
 
-        # Regex to match names like 'December 2012', 'christmas 2007', 'feb 2003'
-        match = re.match(r'^(.+?)\s*(\d{4})$', folder_name, re.IGNORECASE)
+        match = EVENT_YEAR_PATTERN.match(folder_name)
 
         if match:
             event_name, year_str = match.groups()
@@ -45,9 +48,9 @@ def move_folders_by_year(base_dir):
                 dest_path = os.path.join(dest_dir, os.path.basename(folder_path))
                 try:
                     shutil.move(folder_path, dest_path)
-                    print(f"Moved: {folder_path} -> {dest_path}")
+                    log(f"Moved: {folder_path} -> {dest_path}")
                 except Exception as e:
-                    print(f"Error moving {folder_path}: {e}")
+                    log_error(f"Error moving {folder_path}: {e}")
 
 
 def main():
@@ -1,6 +1,9 @@
 import os
-import shutil
 import re
+from photo_tools.dest_names import DestinationNames
+from photo_tools.metrics import log, log_error
+from photo_tools.mover import move_files, new_journal_path
+from photo_tools.walker import make_prune, new_walk_stats, print_walk_stats, walk_entries
 
 # Paths
 ROOT_DIR = '/Volumes/Photo backup/final'  # Directory where your final folders are
@@ -18,37 +21,64 @@ def create_thumbnails_dir():
 def is_thumbnail_folder(folder_name):
     """Check if a folder name matches the thumbnail folder pattern (exactly 21 characters, no spaces or underscores)."""
     match = bool(THUMBNAIL_FOLDER_PATTERN.match(folder_name))
-    print(f"Checking folder: '{folder_name}' - {'MATCH' if match else 'NO MATCH'}")
+    log(f"Checking folder: '{folder_name}' - {'MATCH' if match else 'NO MATCH'}")
     return match
 
 
 def move_files_from_thumbnail_folders(root_dir, thumbnails_dir):
     """Find thumbnail folders, move their files, and delete the folders."""
-    for dirpath, dirnames, _ in os.walk(root_dir):
-        for folder in dirnames:
-            folder_path = os.path.join(dirpath, folder)
-            if is_thumbnail_folder(folder):
-                print(f"Processing thumbnail folder: {folder_path}")
-
-                # Move all files from the thumbnail folder to the thumbnails directory
-                for filename in os.listdir(folder_path):
-                    file_path = os.path.join(folder_path, filename)
-                    if os.path.isfile(file_path):
-                        dest_path = os.path.join(thumbnails_dir, filename)
-                        os.makedirs(thumbnails_dir, exist_ok=True)
-                        try:
-                            shutil.move(file_path, dest_path)
-                            print(f"Moved: {file_path} -> {dest_path}")
-                        except Exception as e:
-                            print(f"Error moving {file_path}: {e}")
-
-                # Check if the folder is empty and delete it
-                if not os.listdir(folder_path):
-                    try:
-                        os.rmdir(folder_path)
-                        print(f"Deleted empty folder: {folder_path}")
-                    except Exception as e:
-                        print(f"Error deleting {folder_path}: {e}")
+    walk_stats = new_walk_stats()
+    # Never descend into the thumbnails directory itself or macOS system folders
+    prune = make_prune(paths=(thumbnails_dir,))
+
+    moves = []
+    names = DestinationNames()
+    # Thumbnail folders with nothing but files, which can be deleted once all of them have moved
+    emptied_folders = []
+    for dirpath, dir_entries, _ in walk_entries(root_dir, prune=prune, stats=walk_stats):
+        for folder_entry in list(dir_entries):
+            folder_path = folder_entry.path
+            if is_thumbnail_folder(folder_entry.name):
+                log(f"Processing thumbnail folder: {folder_path}")
+
+                # Queue all files from the thumbnail folder for the thumbnails directory
+                remaining = 0
+                try:
+                    walk_stats['scandir_calls'] += 1
+                    with os.scandir(folder_path) as it:
+                        entries = list(it)
+                except OSError as e:
+                    log_error(f"Error reading {folder_path}: {e}")
+                    continue
+                for entry in entries:
+                    dest = names.destination(entry.path, thumbnails_dir) if entry.is_file() else None
+                    if dest is None:
+                        # A folder, or a thumbnail the thumbnails directory already has
+                        remaining += 1
+                        continue
+                    moves.append((entry.path, dest))
+
+                if not remaining:
+                    emptied_folders.append(folder_path)
+                    dir_entries.remove(folder_entry)
+
+    print_walk_stats(walk_stats)
+
+    failed_folders = set()
+    for src, _, error, _ in move_files(moves, new_journal_path('thumbnail_cleaner')):
+        if error:
+            log_error(f"Error moving {src}: {error}")
+            failed_folders.add(os.path.dirname(src))
+
+    # Delete the thumbnail folders that are now empty
+    for folder_path in emptied_folders:
+        if folder_path in failed_folders:
+            continue
+        try:
+            os.rmdir(folder_path)
+            log(f"Deleted empty folder: {folder_path}")
+        except Exception as e:
+            log_error(f"Error deleting {folder_path}: {e}")
 
 
 def main():
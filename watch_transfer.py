@@ -0,0 +1,100 @@
+import os
+from find_duplicates import (FINAL_DIR, ROOT_DIR, TRANSFER_DIR, final_path, get_preferred_folder,
+                             is_photo_or_video)
+from photo_tools.dest_names import DestinationNames
+from photo_tools.hash_cache import flush_hash_cache
+from photo_tools.hashing import hash_file_or_none
+from photo_tools.metrics import get_metrics, log, log_error
+from photo_tools.mover import move_files, new_journal_path
+from photo_tools.parallel import imap_ordered
+from photo_tools.reference_index import add_moved_file, refresh_reference_index
+from photo_tools.walker import make_prune
+from photo_tools.watcher import watch_new_files
+
+# Digest index of ROOT_DIR, memory-mapped while the daemon runs and rebuilt from the
+# incremental scan snapshot every time it starts
+INDEX_PATH = os.path.expanduser('~/.photo_watch_final.idx')
+
+# Only log where new files would go, without moving them
+DRY_RUN = False
+
+
+def calculate_hash(file_path, st=None):
+    """Calculate xxHash of a file, using the persistent hash cache."""
+    return hash_file_or_none(file_path, st)
+
+
+def load_final_index(root_dir, index_path):
+    """Bring the snapshot of root_dir up to date, hashing only what changed, and open its digests as an index.
+
+    The snapshot is the one find_duplicates.py keeps with INCREMENTAL_SCAN, so either
+    keeps it fresh for the other. Only the index stays in memory afterwards.
+    """
+    reference_index = refresh_reference_index(root_dir, index_path, is_photo_or_video, calculate_hash, make_prune())
+    print(f"Loaded index with {len(reference_index)} digests of {root_dir}.")
+    return reference_index
+
+
+def route_new_files(paths, reference_index):
+    """Hash newly landed transfer files and move the ones the final directory doesn't have yet.
+
+    Errors are logged per file, so one unreadable file or folder never stops the watch.
+    """
+    # Destination folders are listed afresh for every batch, so files put there since are never overwritten
+    names = DestinationNames()
+    moves = []
+    batch_hashes = set()
+    for file_path, file_hash in imap_ordered(calculate_hash, paths):
+        if not file_hash:
+            continue
+        if file_hash in reference_index or file_hash in batch_hashes:
+            log(f"Duplicate found, keeping in transfer: {file_path}")
+            continue
+        folder_name = get_preferred_folder(file_path) or "unsorted"
+        try:
+            dest = final_path(file_path, folder_name, names, file_hash)
+        except OSError as e:
+            log_error(f"Error picking a destination for {file_path}: {e}")
+            continue
+        if dest is None:
+            continue
+        batch_hashes.add(file_hash)
+        moves.append((file_path, dest, file_hash))
+
+    if DRY_RUN:
+        for src, dest, _ in moves:
+            log(f"Would move {src} -> {dest}")
+        return
+
+    results = move_files(moves, new_journal_path('watch_transfer'))
+    for (src, dest, error, _), (_, _, file_hash) in zip(results, moves):
+        if error:
+            log_error(f"Error moving {src}: {error}")
+            continue
+        log(f"Moved: {src} -> {dest}")
+        try:
+            add_moved_file(reference_index, file_hash, dest, calculate_hash)
+        except OSError as e:
+            log_error(f"Error indexing {dest}: {e}")
+    reference_index.compact()
+    # The daemon keeps the cache open for good, other scripts must not wait on its writes
+    flush_hash_cache()
+    get_metrics().add('watch_batches')
+
+
+def main():
+    os.makedirs(FINAL_DIR, exist_ok=True)
+    print(f"Indexing {ROOT_DIR}...")
+    reference_index = load_final_index(ROOT_DIR, INDEX_PATH)
+    print(f"Watching {TRANSFER_DIR} for new photos, press Ctrl+C to stop...")
+    try:
+        watch_new_files(TRANSFER_DIR, lambda paths: route_new_files(paths, reference_index),
+                        is_photo_or_video, make_prune())
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    finally:
+        reference_index.close()
+
+
+if __name__ == "__main__":
+    main()